@@ -28,6 +28,9 @@ urlpatterns = [
         r"(?P<repo_name>[-_.\w]+)/view/(?P<oid>\w+)/(?P<path>\S*)/?", views.view, name="view"
     ),
     re_path(r"(?P<repo_name>[-_.\w]+)/view/?$", views.view_default, name="view_default"),
+    re_path(
+        r"(?P<repo_name>[-_.\w]+)/raw/(?P<oid>\w+)/(?P<path>\S*)/?", views.raw, name="raw"
+    ),
     re_path(r"(?P<repo_name>[-_.\w]+)/info/(?P<oid>\w+)/?", views.info, name="info"),
     re_path(r"(?P<repo_name>[-_.\w]+)/chain/(?P<oid>\w+)/?", views.chain, name="chain"),
     re_path(r"(?P<repo_name>[-_.\w]+)/chain/?$", views.chain_default, name="chain_default"),
@@ -0,0 +1,679 @@
+import collections
+import time
+
+from mpygit import mpygit
+
+# Minimum similarity (in percent) for two files to be paired up, like git
+RENAME_SCORE = 50
+# Similarity is only estimated when there are at most this many sources times
+# this many destinations, like git's diff.renameLimit
+RENAME_LIMIT = 100
+# Files are compared in chunks of a line, or of this many bytes for long lines
+CHUNK_SIZE = 64
+# Files larger than this (on either side of a change) are not diffed
+MAX_DIFF_SIZE = 1 << 20
+# Seconds a single file may spend being diffed before giving up on it
+DIFF_TIMEOUT = 0.5
+# Lines of context around each hunk
+DIFF_CONTEXT = 3
+
+
+def _is_blob(mode):
+    return mode is not None and (mode & mpygit.S_IFMT) != mpygit.S_IFMOD
+
+
+def _chunk_counts(data):
+    """Count how many bytes of a file are in each distinct chunk.
+
+    This is the same estimate git's diffcore-delta uses: the bytes two files
+    have in common chunks are roughly the bytes a delta between them copies.
+    """
+    data = bytes(data)
+    counts = collections.Counter()
+    pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos, pos + CHUNK_SIZE)
+        end = pos + CHUNK_SIZE if end < 0 else end + 1
+        chunk = data[pos:end]
+        counts[chunk] += len(chunk)
+        pos = end
+    return counts
+
+
+def _similarity(src_counts, src_size, dst_counts, dst_size):
+    copied = 0
+    for chunk, count in src_counts.items():
+        dst_count = dst_counts.get(chunk)
+        if dst_count is not None:
+            copied += min(count, dst_count)
+    return copied * 100 // max(src_size, dst_size)
+
+
+def detect_renames(
+    changes,
+    blobs,
+    rename_limit=RENAME_LIMIT,
+    rename_score=RENAME_SCORE,
+    timeout=DIFF_TIMEOUT,
+):
+    """Pair up added files with the deleted or modified files they came from.
+
+    Files with the same object ID are paired first, which is cheap. The
+    remaining files are then compared by chunk hashing, as long as there are
+    few enough of them that the cost stays bounded on large reorganisations.
+    Files too large to diff are left out of the comparison, and it is given
+    up on altogether once it takes longer than a diff may, keeping only the
+    pairs with the same object ID. The first use of a deleted file is a
+    rename (and hides the deletion), everything else is a copy.
+
+    Args:
+        changes: mpygit.TreeChange objects in path order.
+        blobs: {oid: blob} of the blobs on both sides of the changes, files
+            whose blob is left out (e.g. as it is too large to diff) are only
+            paired with files that have the same object ID.
+        rename_limit: skip the similarity estimate when there are more than
+            rename_limit * rename_limit pairs of files to compare.
+        rename_score: minimum similarity in percent.
+        timeout: seconds to spend comparing files.
+
+    Returns:
+        List of mpygit.TreeChange objects in path order.
+    """
+
+    def size(oid):
+        blob = blobs.get(oid)
+        return 0 if blob is None else blob.size
+
+    sources = [
+        change
+        for change in changes
+        if change.status in ("D", "M") and _is_blob(change.old_mode)
+    ]
+    dests = [
+        change
+        for change in changes
+        if change.status == "A" and _is_blob(change.new_mode)
+    ]
+    if len(sources) == 0 or len(dests) == 0:
+        return changes
+    # prefer renaming deleted files over copying modified ones
+    sources.sort(key=lambda change: change.status != "D")
+
+    paired = {}
+    renamed = set()
+
+    def pair(src, dst, score):
+        if src.status == "D" and src.path not in renamed:
+            status = "R"
+            renamed.add(src.path)
+        else:
+            status = "C"
+        paired[dst.path] = mpygit.TreeChange(
+            status,
+            dst.path,
+            src.old_mode,
+            dst.new_mode,
+            src.old_oid,
+            dst.new_oid,
+            src.path,
+            score,
+        )
+
+    def same_type(src, dst):
+        return (src.old_mode & mpygit.S_IFMT) == (dst.new_mode & mpygit.S_IFMT)
+
+    by_oid = collections.defaultdict(list)
+    for src in sources:
+        by_oid[src.old_oid].append(src)
+    for dst in dests:
+        candidates = [src for src in by_oid[dst.new_oid] if same_type(src, dst)]
+        if len(candidates) > 0:
+            unused = [src for src in candidates if src.path not in renamed]
+            pair((unused or candidates)[0], dst, 100)
+
+    # NOTE: empty files are all similar to each other, so only pair them up
+    # when they have the exact same object ID
+    def comparable(oid):
+        return oid in blobs and 0 < size(oid) <= MAX_DIFF_SIZE
+
+    sources = [src for src in sources if comparable(src.old_oid)]
+    dests = [dst for dst in dests if dst.path not in paired and comparable(dst.new_oid)]
+    if (
+        len(sources) == 0
+        or len(dests) == 0
+        or len(sources) * len(dests) > rename_limit * rename_limit
+    ):
+        return _apply_pairs(changes, paired, renamed)
+
+    deadline = time.monotonic() + timeout
+    chunk_counts = {}
+
+    def counts(oid):
+        if oid not in chunk_counts:
+            if time.monotonic() > deadline:
+                raise DiffTooLarge()
+            chunk_counts[oid] = _chunk_counts(blobs[oid].data)
+        return chunk_counts[oid]
+
+    scores = []
+    try:
+        for i, dst in enumerate(dests):
+            dst_size = size(dst.new_oid)
+            for j, src in enumerate(sources):
+                if not same_type(src, dst):
+                    continue
+                src_size = size(src.old_oid)
+                # the common bytes can't be more than the size of the smaller
+                # file
+                if min(src_size, dst_size) * 100 < rename_score * max(
+                    src_size, dst_size
+                ):
+                    continue
+                score = _similarity(
+                    counts(src.old_oid), src_size, counts(dst.new_oid), dst_size
+                )
+                if score >= rename_score:
+                    scores.append((-score, j, i))
+            if time.monotonic() > deadline:
+                raise DiffTooLarge()
+    except DiffTooLarge:
+        return _apply_pairs(changes, paired, renamed)
+
+    scores.sort()
+    for score, j, i in scores:
+        dst = dests[i]
+        if dst.path not in paired:
+            pair(sources[j], dst, -score)
+    return _apply_pairs(changes, paired, renamed)
+
+
+def _apply_pairs(changes, paired, renamed):
+    result = []
+    for change in changes:
+        if change.status == "D" and change.path in renamed:
+            continue
+        if change.status == "A":
+            change = paired.get(change.path, change)
+        result.append(change)
+    return result
+
+
+class DiffTooLarge(Exception):
+    """A file was too large or took too long to diff"""
+
+
+def _intern(old_lines, new_lines):
+    """Replace lines by integers, leaving out lines only one side has.
+
+    Lines that are only on one side can never match, so dropping them gives
+    the same matches for less work, which matters most for rewritten files.
+
+    Returns:
+        (a, a_index, b, b_index) where a and b are the integer sequences and
+        the index lists map their positions back to line numbers.
+    """
+    ids = {}
+    old_ids = [ids.setdefault(line, len(ids)) for line in old_lines]
+    new_ids = [ids.setdefault(line, len(ids)) for line in new_lines]
+    common = set(old_ids).intersection(new_ids)
+    a_index = [i for i, line in enumerate(old_ids) if line in common]
+    b_index = [j for j, line in enumerate(new_ids) if line in common]
+    return (
+        [old_ids[i] for i in a_index],
+        a_index,
+        [new_ids[j] for j in b_index],
+        b_index,
+    )
+
+
+def _bisect(a, alo, ahi, b, blo, bhi, deadline):
+    """Find the middle of a shortest edit script between two ranges.
+
+    This is Myers' linear space refinement: edit paths are extended from both
+    ends at once, and where they meet splits the problem in two halves that
+    can be diffed independently.
+
+    Returns:
+        (x, y) split point, as positions in a and b, or None if the ranges
+        have no lines in common.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    v1 = [-1] * (2 * max_d + 2)
+    v1[offset + 1] = 0
+    v2 = list(v1)
+    delta = n - m
+    # with an odd delta the paths meet while extending the forward path
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        if time.monotonic() > deadline:
+            raise DiffTooLarge()
+
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                # ran off the right of the grid
+                k1end += 2
+            elif y1 > m:
+                # ran off the bottom of the grid
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < len(v2) and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return alo + x1, blo + y1
+
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < len(v1) and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= n - x2:
+                        return alo + x1, blo + x1 - (k1_offset - offset)
+
+    # NOTE: the paths only fail to meet when the ranges have nothing in common
+    return None
+
+
+def _diff_range(a, alo, ahi, b, blo, bhi, deadline, blocks):
+    start_a, start_b = alo, blo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    if alo > start_a:
+        blocks.append((start_a, start_b, alo - start_a))
+
+    end_a = ahi
+    while ahi > alo and bhi > blo and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+
+    if alo < ahi and blo < bhi:
+        split = _bisect(a, alo, ahi, b, blo, bhi, deadline)
+        if split is not None:
+            x, y = split
+            _diff_range(a, alo, x, b, blo, y, deadline, blocks)
+            _diff_range(a, x, ahi, b, y, bhi, deadline, blocks)
+
+    if ahi < end_a:
+        blocks.append((ahi, bhi, end_a - ahi))
+
+
+def matching_blocks(old_lines, new_lines, timeout=DIFF_TIMEOUT):
+    """Find the lines two versions of a file have in common.
+
+    Lines are matched with Myers' algorithm, so the matches are a longest
+    common subsequence and the diff is as small as possible.
+
+    Args:
+        old_lines: lines of the old version.
+        new_lines: lines of the new version.
+        timeout: seconds to spend before raising DiffTooLarge.
+
+    Returns:
+        [(i, j, size), ...] where old_lines[i:i + size] is the same as
+        new_lines[j:j + size], ending with (len(old_lines), len(new_lines), 0)
+        just like difflib's get_matching_blocks.
+    """
+    a, a_index, b, b_index = _intern(old_lines, new_lines)
+    interned = []
+    _diff_range(a, 0, len(a), b, 0, len(b), time.monotonic() + timeout, interned)
+
+    # Map the matches back to line numbers, the lines that were left out split
+    # up some of the blocks
+    blocks = []
+    for i, j, size in interned:
+        for k in range(size):
+            old, new = a_index[i + k], b_index[j + k]
+            if len(blocks) > 0:
+                last_i, last_j, last_size = blocks[-1]
+                if last_i + last_size == old and last_j + last_size == new:
+                    blocks[-1] = (last_i, last_j, last_size + 1)
+                    continue
+            blocks.append((old, new, 1))
+    blocks.append((len(old_lines), len(new_lines), 0))
+    return blocks
+
+
+def _format_range(start, stop):
+    # the same way difflib and GNU diff number hunks
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if length == 0:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def _line(prefix, text):
+    # the last line of a file may be missing its newline
+    return prefix + text if text.endswith("\n") else prefix + text + "\n"
+
+
+class Hunk:
+    """Changes close enough together to share their context lines.
+
+    Attributes:
+        old_start, old_end: range of the old lines the hunk covers.
+        new_start, new_end: range of the new lines the hunk covers.
+        changes: [(i1, i2, j1, j2), ...] where old lines i1:i2 are replaced by
+            new lines j1:j2, everything in between is context.
+        insertions: number of lines added.
+        deletions: number of lines removed.
+    """
+
+    __slots__ = (
+        "old_start",
+        "old_end",
+        "new_start",
+        "new_end",
+        "changes",
+        "insertions",
+        "deletions",
+    )
+
+    def __init__(self, changes, context, n_old):
+        first, last = changes[0], changes[-1]
+        self.old_start = max(first[0] - context, 0)
+        self.old_end = min(last[1] + context, n_old)
+        self.new_start = first[2] - (first[0] - self.old_start)
+        self.new_end = last[3] + (self.old_end - last[1])
+        self.changes = changes
+        self.insertions = sum(j2 - j1 for _, _, j1, j2 in changes)
+        self.deletions = sum(i2 - i1 for i1, i2, _, _ in changes)
+
+    def lines(self, old_lines, new_lines):
+        """Unified diff lines of the hunk, starting with its @@ header"""
+        lines = [
+            f"@@ -{_format_range(self.old_start, self.old_end)} "
+            f"+{_format_range(self.new_start, self.new_end)} @@\n"
+        ]
+        i = self.old_start
+        for i1, i2, j1, j2 in self.changes:
+            lines.extend(_line(" ", text) for text in old_lines[i:i1])
+            lines.extend(_line("-", text) for text in old_lines[i1:i2])
+            lines.extend(_line("+", text) for text in new_lines[j1:j2])
+            i = i2
+        lines.extend(_line(" ", text) for text in old_lines[i : self.old_end])
+        return lines
+
+    def __repr__(self):
+        return (
+            f"Hunk(-{self.old_start},{self.old_end} +{self.new_start},{self.new_end})"
+        )
+
+
+def diff_hunks(old_lines, new_lines, context=DIFF_CONTEXT, timeout=DIFF_TIMEOUT):
+    """Diff two versions of a file into hunks.
+
+    Raises:
+        DiffTooLarge: the diff took more than timeout seconds.
+
+    Returns:
+        List of Hunk objects, empty if the versions are the same.
+    """
+    blocks = matching_blocks(old_lines, new_lines, timeout)
+    return _group_hunks(blocks, len(old_lines), context)
+
+
+def _group_hunks(blocks, n_old, context):
+    # Find the changed regions between the matches
+    changes = []
+    i = j = 0
+    for block_i, block_j, size in blocks:
+        if i < block_i or j < block_j:
+            changes.append((i, block_i, j, block_j))
+        i, j = block_i + size, block_j + size
+
+    groups = []
+    for change in changes:
+        if len(groups) > 0 and change[0] - groups[-1][-1][1] <= 2 * context:
+            groups[-1].append(change)
+        else:
+            groups.append([change])
+    return [Hunk(group, context, n_old) for group in groups]
+
+
+def unified_diff(
+    old_lines,
+    new_lines,
+    old_name,
+    new_name,
+    context=DIFF_CONTEXT,
+    timeout=DIFF_TIMEOUT,
+):
+    """Diff two versions of a file in unified format.
+
+    A drop-in replacement for difflib's unified_diff, which is slow and uses a
+    lot of memory on long files with many repeated lines. Lines missing their
+    newline (at the end of a file) get one.
+
+    Raises:
+        DiffTooLarge: the diff took more than timeout seconds.
+
+    Returns:
+        List of the lines of the diff, empty if the versions are the same.
+    """
+    hunks = diff_hunks(old_lines, new_lines, context, timeout)
+    if len(hunks) == 0:
+        return []
+    lines = [f"--- {old_name}\n", f"+++ {new_name}\n"]
+    for hunk in hunks:
+        lines.extend(hunk.lines(old_lines, new_lines))
+    return lines
+
+
+def _blob_lines(blob, size, mode, oid):
+    """Split the contents at one side of a change into lines for diffing.
+
+    Returns None for binary blobs, raises DiffTooLarge for large ones.
+    """
+    if mode is None:
+        return []
+    if (mode & mpygit.S_IFMT) == mpygit.S_IFMOD:
+        # submodules have no blob, git shows the commit they point at instead
+        return [f"Subproject commit {oid}\n"]
+    if size is not None and size > MAX_DIFF_SIZE:
+        raise DiffTooLarge()
+    if blob is None or blob.is_binary:
+        return None
+    # NOTE: like git, only split on newlines, str.splitlines would also split
+    # on carriage returns, form feeds and other line boundaries
+    lines = blob.text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+class FileDiff:
+    """The diff of a single changed file.
+
+    The line counts are known as soon as the file is diffed, but the text of
+    the patch is only put together the first time it is used. In stat-only
+    mode, so are the hunks.
+
+    Attributes:
+        change: mpygit.TreeChange of the file.
+        hunks: list of Hunk objects, None for binary files, files that were
+            too large to diff, and in stat-only mode until the patch is used.
+        insertions: number of lines added, None if unknown.
+        deletions: number of lines removed, None if unknown.
+        binary: one side of the change is a binary file.
+        too_large: the file was too large or took too long to diff.
+        stat_only: only the line counts were computed up front.
+    """
+
+    def __init__(self, change, stat_only=False):
+        self.change = change
+        self.stat_only = stat_only
+        self.hunks = None
+        self.insertions = None
+        self.deletions = None
+        self.binary = False
+        self.too_large = False
+        self._lines = None
+        self._blocks = None
+        self._patch = None
+
+    def _header(self):
+        change = self.change
+        header = ""
+        if change.status in ("R", "C"):
+            verb = "rename" if change.status == "R" else "copy"
+            header = (
+                f"similarity index {change.score}%\n"
+                f"{verb} from {change.old_path}\n"
+                f"{verb} to {change.path}\n"
+            )
+        if change.status in ("M", "R", "C") and change.old_mode != change.new_mode:
+            header += f"old mode {change.old_mode:o}\nnew mode {change.new_mode:o}\n"
+        return header
+
+    @property
+    def patch(self):
+        """Text of the patch"""
+        if self._patch is None:
+            old_path, path = self.change.old_path, self.change.path
+            if self._blocks is not None:
+                # the diff was already done for the counts
+                self.hunks = _group_hunks(
+                    self._blocks, len(self._lines[0]), DIFF_CONTEXT
+                )
+                self._blocks = None
+            if self.binary:
+                body = f"Binary files a/{old_path} and b/{path} differ\n"
+            elif self.too_large:
+                body = "Large diff, not shown\n"
+            elif len(self.hunks) == 0:
+                body = ""
+            else:
+                old_lines, new_lines = self._lines
+                lines = [f"--- a/{old_path}\n", f"+++ b/{path}\n"]
+                for hunk in self.hunks:
+                    lines.extend(hunk.lines(old_lines, new_lines))
+                body = "".join(lines)
+            self._patch = self._header() + body
+            self._lines = None
+        return self._patch
+
+
+def _diff_file(change, blobs, sizes, stat_only):
+    file_diff = FileDiff(change, stat_only)
+    if change.status in ("R", "C") and change.old_oid == change.new_oid:
+        # identical contents, the header says it all
+        file_diff.insertions = file_diff.deletions = 0
+        if stat_only:
+            file_diff._blocks = []
+            file_diff._lines = [], []
+        else:
+            file_diff.hunks = []
+        return file_diff
+
+    try:
+        old_lines = _blob_lines(
+            blobs.get(change.old_oid),
+            sizes.get(change.old_oid),
+            change.old_mode,
+            change.old_oid,
+        )
+        new_lines = _blob_lines(
+            blobs.get(change.new_oid),
+            sizes.get(change.new_oid),
+            change.new_mode,
+            change.new_oid,
+        )
+        if old_lines is None or new_lines is None:
+            file_diff.binary = True
+        elif stat_only:
+            # the counts fall straight out of the matches, hunks are only
+            # needed once the patch is
+            blocks = matching_blocks(old_lines, new_lines)
+            matched = sum(size for _, _, size in blocks)
+            file_diff.insertions = len(new_lines) - matched
+            file_diff.deletions = len(old_lines) - matched
+            file_diff._blocks = blocks
+            file_diff._lines = old_lines, new_lines
+        else:
+            file_diff.hunks = diff_hunks(old_lines, new_lines)
+            file_diff.insertions = sum(hunk.insertions for hunk in file_diff.hunks)
+            file_diff.deletions = sum(hunk.deletions for hunk in file_diff.hunks)
+            file_diff._lines = old_lines, new_lines
+    except DiffTooLarge:
+        file_diff.too_large = True
+    return file_diff
+
+
+def diff_commits(
+    repo, old, new, find_renames=True, rename_limit=RENAME_LIMIT, stat_only=False
+):
+    """Diff two commits.
+
+    Only the trees that differ between the commits are read. The blobs of
+    the changed files are then read together in a single batch, leaving out
+    those too large to be diffed, whose size is all that is needed.
+
+    Args:
+        repo: mpygit Repository object.
+        old: commit to diff from, None to diff against an empty tree.
+        new: commit to diff to.
+        find_renames: pair up renamed and copied files.
+        rename_limit: see detect_renames.
+        stat_only: only count the lines added and removed up front, each
+            patch is worked out the first time it is used.
+
+    Returns:
+        List of FileDiff objects in path order.
+    """
+    changes = list(repo.diff_trees(old.tree if old is not None else None, new.tree))
+
+    oids = set()
+    for change in changes:
+        if _is_blob(change.old_mode):
+            oids.add(change.old_oid)
+        if _is_blob(change.new_mode):
+            oids.add(change.new_oid)
+    sizes = {}
+    for oid in oids:
+        info = repo.object_info(oid)
+        sizes[oid] = None if info is None else info[1]
+    blobs = dict(
+        repo.get_many(
+            oid
+            for oid, size in sizes.items()
+            if size is not None and size <= MAX_DIFF_SIZE
+        )
+    )
+
+    if find_renames:
+        changes = detect_renames(changes, blobs, rename_limit)
+
+    return [_diff_file(change, blobs, sizes, stat_only) for change in changes]
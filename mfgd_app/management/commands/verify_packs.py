@@ -0,0 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mpygit import mpygit
+
+from mfgd_app.models import Repository
+
+
+class Command(BaseCommand):
+    help = "Check the integrity of the packs of every repository."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "repos", nargs="*", help="names of the repositories to check (default: all)"
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="also check the SHA-1 of every object, this is a lot slower",
+        )
+        parser.add_argument(
+            "--jobs", type=int, default=None, help="number of worker processes"
+        )
+
+    def handle(self, *args, **options):
+        db_repos = Repository.objects.all()
+        if options["repos"]:
+            db_repos = db_repos.filter(name__in=options["repos"])
+
+        n_bad = 0
+        with ProcessPoolExecutor(options["jobs"]) as executor:
+            # Start on every repository before waiting on any of them, so the
+            # pool is kept busy across all of them
+            pending = []
+            for db_repo in db_repos:
+                # A repository that can't be opened at all is reported like any
+                # other problem, the others still get checked
+                try:
+                    repo = mpygit.Repository(db_repo.path)
+                    try:
+                        verifications = repo.verify(executor, options["full"])
+                    finally:
+                        # The checks open the packs themselves, so nothing
+                        # needs to stay mapped while they run
+                        repo.close()
+                except Exception as e:
+                    pending.append((db_repo.name, {}, [f"cannot open repository: {e}"]))
+                    continue
+                pending.append((db_repo.name, verifications, []))
+
+            for name, verifications, problems in pending:
+                problems += [
+                    f"{pack_name}: {problem}"
+                    for pack_name, verification in verifications.items()
+                    for problem in verification.problems()
+                ]
+                if problems:
+                    n_bad += 1
+                    self.stderr.write(f"{name}: {len(problems)} problem(s)")
+                    for problem in problems:
+                        self.stderr.write(f"  {problem}")
+                else:
+                    self.stdout.write(f"{name}: ok ({len(verifications)} pack(s))")
+
+        if n_bad > 0:
+            raise CommandError(f"{n_bad} repositories failed verification")
@@ -4,7 +4,7 @@ import difflib
 import re
 import string
 
-from mpygit import mpygit, gitutil
+from mpygit import mpygit
 
 from pygments import highlight
 from pygments.lexers import get_lexer_for_filename
@@ -16,7 +16,6 @@ from mfgd_app.models import Repository, UserProfile, CanAccess
 # Pre-compiled regex for speed
 split_path_re = re.compile(r"/?([^/]+)/?")
 
-
 def split_path(path):
     """Robust, regex-based, path splitter
     """
@@ -29,26 +28,36 @@ def normalize_path(path):
     return "/".join(split_path(path))
 
 
-def resolve_path(repo, oid, path):
-    """Find object at specified path in Git repository.
-    """
-    # Resolve tree id
-    tree = repo[oid]
+def resolve_oid(repo, oid, path):
+    """Find object ID at specified path in Git repository.
 
+    Only the trees leading up to the path are read, not the object itself.
+    """
     # Check for root of tree
     path = path.strip("/")
     if path == "":
-        return tree
+        return oid
 
-    for path_entry in path.split("/"):
+    tree = repo[oid]
+    parts = path.split("/")
+    for i, path_entry in enumerate(parts):
         if not isinstance(tree, mpygit.Tree):
             return None
         tree_entry = tree[path_entry]
         if tree_entry == None:
             return None
+        if i == len(parts) - 1:
+            return tree_entry.oid
         tree = repo[tree_entry.oid]
 
-    return tree
+
+def resolve_path(repo, oid, path):
+    """Find object at specified path in Git repository.
+    """
+    oid = resolve_oid(repo, oid, path)
+    if oid is None:
+        return None
+    return repo[oid]
 
 def hex_dump(binary):
     """Create a hex-dump of binary data.
@@ -95,6 +104,26 @@ def hex_dump(binary):
     return rows
 
 
+class ListingEntry:
+    """Tree entry along with the details shown for it in a tree listing.
+
+    Trees and their entries may be shared between requests, so the extra
+    details are kept here instead of being set on the entries themselves.
+    """
+
+    def __init__(self, entry, last_change, is_binary=False):
+        self.entry = entry
+        self.name = entry.name
+        self.last_change = last_change
+        self.is_binary = is_binary
+
+    def isdir(self):
+        return self.entry.isdir()
+
+    def issubmod(self):
+        return self.entry.issubmod()
+
+
 def tree_entries(repo, target, path, tree):
     """Get tree entries (depth=1) with their latest involved commits.
 
@@ -104,16 +133,34 @@ def tree_entries(repo, target, path, tree):
         path: path to subtree to get listing.
 
     Returns:
-        List of non-dir non-submodule entries.
+        List of ListingEntry objects, directories first.
     """
+    entries = list(tree)
+
+    # Only the start of a blob is needed to tell if it's binary, so that's
+    # all that is read, even of blobs stored as deltas
+    is_binary = {}
+    for entry in entries:
+        if entry.isdir() or entry.issubmod():
+            continue
+        head = repo.blob_head(entry.oid, mpygit.BINARY_SNIFF_SIZE)
+        # NOTE: a missing blob is listed as text, viewing it tells what went
+        # wrong
+        if head is not None:
+            is_binary[entry.oid] = b"\x00" in head
+
+    # history is walked once for the whole directory
+    prefix = tuple(split_path(path))
+    last_changes = repo.last_changes(
+        target.oid, [(*prefix, entry.name) for entry in entries]
+    )
+
     clean_entries = []
-    for entry in tree:
-        entry.last_change = gitutil.get_latest_change(repo, \
-                                target.oid, (*split_path(path), entry.name))
-        if not entry.isdir() and not entry.issubmod():
-            blob = repo[entry.oid]
-            entry.is_binary = blob.is_binary
-        clean_entries.append(entry)
+    for entry in entries:
+        last_change = last_changes[(*prefix, entry.name)]
+        clean_entries.append(
+            ListingEntry(entry, last_change, is_binary.get(entry.oid, False))
+        )
 
     # secondary sort by name
     clean_entries.sort(key=lambda entry: entry.name)
@@ -1,10 +1,9 @@
 import binascii
 import json
-import re
 
 from pathlib import Path
 
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, HttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django import urls
@@ -15,11 +14,19 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import requires_csrf_token
 from mpygit import mpygit, gitutil
 
-from mfgd_app import utils
+from mfgd_app import diff, utils
 from mfgd_app.utils import verify_user_permissions, Permission
 from mfgd_app.models import Repository, CanAccess, UserProfile
 from mfgd_app.forms import RegisterForm, RepoForm, UserUpdateForm, ProfileUpdateForm
 
+# 100K
+MAX_BLOB_SIZE = 100 * 5 << 10
+# Blobs are streamed to raw downloads in chunks of this size
+RAW_CHUNK_SIZE = 64 << 10
+# Patches are shown on the commit page up to this many changed lines in
+# total, the rest are only built once asked for
+MAX_INLINE_DIFF_LINES = 2000
+
 def default_branch(db_repo_obj):
     """Get default branch for a Repository database object.
     """
@@ -68,18 +75,36 @@ def read_blob(blob):
     Returns:
         (template, None) if blob exceeds 100K else (template, contents).
     """
-    # 100K
-    MAX_BLOB_SIZE = 100 * 5 << 10
-
-    content = blob.data
     if blob.is_binary:
         if blob.size > MAX_BLOB_SIZE:
             return "blob_binary.html", None
-        return "blob_binary.html", utils.hex_dump(content)
+        return "blob_binary.html", utils.hex_dump(blob.data)
     else:
         if blob.size > MAX_BLOB_SIZE:
             return "blob.html", None
-    return "blob.html", content.decode()
+    return "blob.html", blob.text
+
+
+def lookup_commit(repo, oid):
+    """Find the commit a revision from a URL refers to.
+
+    Args:
+        repo: mpygit repository object of Git repository on disk.
+        oid: branch, tag, HEAD, or (abbreviated) commit object ID.
+
+    Returns:
+        Commit object, or None if oid doesn't refer to a commit.
+
+    Raises:
+        mpygit.AmbiguousRevision: oid is an ambiguous abbreviated object ID.
+    """
+    commit_oid = repo.resolve(oid, peel=True)
+    if commit_oid is None:
+        return None
+    commit = repo[commit_oid]
+    if not isinstance(commit, mpygit.Commit):
+        return None
+    return commit
 
 
 def gen_crumbs(repo_name, oid, path):
@@ -129,11 +154,19 @@ def gen_branches(repo_name, repo, oid):
             self.name = name
             self.url = url
 
-    l = list(repo.heads)
+    heads = repo.heads
+    l = list(heads)
     if oid not in l:
         l.append(oid)
 
-    return [Branch(name, f"/{repo_name}/view/" + name) for name in l]
+    branches = []
+    for name in l:
+        # NOTE: a nested branch name (e.g. feature/x) can't be told apart from
+        # the path that follows it in the URL, so link to its commit instead
+        rev = heads[name] if "/" in name and name in heads else name
+        url = urls.reverse("view", kwargs={"repo_name": repo_name, "oid": rev, "path": ""})
+        branches.append(Branch(name, url))
+    return branches
 
 
 def view_default(request, repo_name):
@@ -166,28 +199,37 @@ def view(request, permission, repo_name, oid, path):
         return HttpResponseNotFound("no matching repository")
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = mpygit.open_repository(db_repo_obj.path)
 
     # First we normalize the path so libgit2 doesn"t choke
     path = utils.normalize_path(path)
 
     try:
-        commit = repo[oid]
-    except KeyError:
-        # TODO use Http404
-        return HttpResponseNotFound("invalid head")
+        commit = lookup_commit(repo, oid)
+    except mpygit.AmbiguousRevision:
+        return HttpResponse("Ambiguous commit ID")
 
-    if commit is None or not isinstance(commit, mpygit.Commit):
+    if commit is None:
         return HttpResponse("Invalid commit ID")
 
     # Resolve path inside commit
-    obj = utils.resolve_path(repo, commit.tree, path)
-    if obj == None:
+    obj_oid = utils.resolve_oid(repo, commit.tree, path)
+    obj_info = repo.object_info(obj_oid) if obj_oid != None else None
+    if obj_info == None:
         return HttpResponse("Invalid path")
 
+    # Don't bother reading blobs which are too large to display anyway
+    obj_type, obj_size = obj_info
+    if obj_type == "blob" and obj_size > MAX_BLOB_SIZE:
+        obj = None
+    else:
+        obj = repo[obj_oid]
+
     context = {
         "repo_name": repo_name,
         "oid": oid,
+        # branch names can contain slashes, raw downloads link to the commit
+        "commit_oid": commit.oid,
         "path": path,
         "branches": gen_branches(repo_name, repo, oid),
         "crumbs": gen_crumbs(repo_name, oid, path),
@@ -198,14 +240,21 @@ def view(request, permission, repo_name, oid, path):
     if isinstance(obj, mpygit.Tree):
         template = "tree.html"
         context["entries"] = utils.tree_entries(repo, commit, path, obj)
-    elif isinstance(obj, mpygit.Blob):
-        template, code = read_blob(obj)
+    elif isinstance(obj, mpygit.Blob) or obj_type == "blob":
+        if obj is None:
+            # sniff the start of oversized blobs to pick the right template
+            head = repo.blob_head(obj_oid, mpygit.BINARY_SNIFF_SIZE)
+            is_binary = b"\x00" in head
+            template = "blob_binary.html" if is_binary else "blob.html"
+            code = None
+        else:
+            template, code = read_blob(obj)
         if template == "blob.html":
             # highlight code in textual blobs
             context["code"] = utils.highlight_code(path, code)
         else:
             context["code"] = code
-        commit = gitutil.get_latest_change(repo, commit.oid, utils.split_path(path))
+        commit = repo.last_change(commit.oid, utils.split_path(path))
         context["change"] = commit
     else:
         return HttpResponse("Unsupported object type")
@@ -213,6 +262,56 @@ def view(request, permission, repo_name, oid, path):
     return render(request, template, context=context)
 
 
+@verify_user_permissions
+def raw(request, permission, repo_name, oid, path):
+    """Download raw blob contents.
+
+    The blob is streamed to the client as it is inflated, so the memory used
+    does not depend on the size of the blob.
+
+    Args:
+        permission: permission rights of accessing user.
+        repo_name: name of repository to inspect.
+        oid: commit object ID to read the blob from.
+        path: path to blob.
+    """
+    if permission == permission.NO_ACCESS:
+        # TODO use Http404
+        return HttpResponseNotFound("no matching repository")
+
+    db_repo_obj = get_object_or_404(Repository, name=repo_name)
+    repo = mpygit.open_repository(db_repo_obj.path)
+
+    path = utils.normalize_path(path)
+
+    try:
+        commit = lookup_commit(repo, oid)
+    except mpygit.AmbiguousRevision:
+        return HttpResponse("Ambiguous commit ID")
+
+    if commit is None:
+        return HttpResponse("Invalid commit ID")
+
+    obj_oid = utils.resolve_oid(repo, commit.tree, path)
+    blob = repo.open_blob(obj_oid) if obj_oid != None else None
+    if blob is None:
+        return HttpResponse("Invalid path")
+
+    filename = utils.split_path(path)[-1]
+    # closing the response closes the blob
+    response = FileResponse(
+        blob,
+        as_attachment=True,
+        filename=filename,
+        content_type="application/octet-stream",
+    )
+    response.block_size = RAW_CHUNK_SIZE
+    # NOTE: FileResponse can only find out the size of files on disk
+    response["Content-Length"] = blob.size
+    response["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
 def user_login(request):
     """Create new user session.
     """
@@ -315,40 +414,73 @@ def info(request, permission, repo_name, oid):
     - modified blobs
     - deltas (including highlighted diffs)
 
+    Line counts are shown for every file, but patches only as long as their
+    changed lines add up to at most MAX_INLINE_DIFF_LINES, the others are
+    only built and highlighted once requested with the "path" query
+    parameter.
+
     Args:
         permission: permission rights of accessing user.
         repo_name: name of managed repository.
         oid: commit object ID to inspect.
     """
     class FileChange:
-        def __init__(self, path, patch, status):
-            self.path = path
-            self.patch = utils.highlight_code("name.diff", patch)
-            self.status = status
-            self.deleted = status == "D"
-
-            # The line stats are not very elegant but difflib is kind of limited
-            insert = len(re.findall(r"^\+", patch, re.MULTILINE)) - 1
-            delete = len(re.findall(r"^-", patch, re.MULTILINE)) - 1
-            self.insertion = f"++{insert}"
-            self.deletion = f"--{delete}"
+        def __init__(self, file_diff):
+            self.file_diff = file_diff
+            self.path = file_diff.change.path
+            self.old_path = file_diff.change.old_path
+            self.status = file_diff.change.status
+            self.deleted = self.status == "D"
+            self.expanded = False
+            self._patch = None
+
+            # binary files and files too large to diff have no line counts
+            if file_diff.insertions is None:
+                self.insertion = self.deletion = "-"
+            else:
+                self.insertion = f"++{file_diff.insertions}"
+                self.deletion = f"--{file_diff.deletions}"
+
+        @property
+        def n_lines(self):
+            return (self.file_diff.insertions or 0) + (self.file_diff.deletions or 0)
+
+        @property
+        def patch(self):
+            # only generated and highlighted once the template shows it
+            if self._patch is None and self.expanded and self.file_diff.patch:
+                self._patch = utils.highlight_code("name.diff", self.file_diff.patch)
+            return self._patch
 
     if permission == permission.NO_ACCESS:
         # TODO return Http404 properly
         return HttpResponseNotFound("no  matching repository")
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = mpygit.open_repository(db_repo_obj.path)
+
+    try:
+        commit = lookup_commit(repo, oid)
+    except mpygit.AmbiguousRevision:
+        return HttpResponse("Ambiguous commit ID")
 
-    commit = repo[oid]
-    if commit is None or not isinstance(commit, mpygit.Commit):
+    if commit is None:
         return HttpResponse("Invalid branch or commit ID")
 
-    changes = []
     parent = repo[commit.parents[0]] if len(commit.parents) > 0 else None
-    diffs = gitutil.diff_commits(repo, parent, commit)
-    for path, patch, status in diffs:
-        changes.append(FileChange(path, patch, status))
+    diffs = diff.diff_commits(repo, parent, commit, stat_only=True)
+    changes = [FileChange(file_diff) for file_diff in diffs]
+
+    # in large commits, patches that don't fit in what's left of the budget
+    # are left out
+    requested = request.GET.get("path")
+    budget = MAX_INLINE_DIFF_LINES
+    for change in changes:
+        if change.n_lines <= budget:
+            change.expanded = True
+            budget -= change.n_lines
+        else:
+            change.expanded = change.path == requested
 
     context = {
         "repo_name": repo_name,
@@ -384,7 +516,7 @@ def chain(request, permission, repo_name, oid):
         return HttpResponseNotFound("no matching repository")
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = mpygit.open_repository(db_repo_obj.path)
 
     context = {
         "repo_name": repo_name,
@@ -393,13 +525,13 @@ def chain(request, permission, repo_name, oid):
     }
 
     try:
-        obj = repo[oid]
-        if obj is None:
-            return HttpResponse("Invalid branch or commit ID")
-    except KeyError:
-        pass
-    else:
-        context["commits"] = gitutil.walk(repo, obj.oid, 100)
+        obj = lookup_commit(repo, oid)
+    except mpygit.AmbiguousRevision:
+        return HttpResponse("Ambiguous commit ID")
+
+    if obj is None:
+        return HttpResponse("Invalid branch or commit ID")
+    context["commits"] = gitutil.walk(repo, obj.oid, 100)
 
     return render(request, "chain.html", context=context)
 
@@ -595,7 +727,10 @@ def delete_repo(request, permisson, repo_name):
         repo_name: Repository name (PK) to remove from database.
     """
     if request.user.is_superuser or permission.CAN_MANAGE:
-        get_object_or_404(Repository, name=repo_name).delete()
+        db_repo_obj = get_object_or_404(Repository, name=repo_name)
+        db_repo_obj.delete()
+        # let go of the packs mapped for the repository
+        mpygit.close_repository(db_repo_obj.path)
     return redirect("index")
 
 def add_repo(request):
@@ -22,24 +22,51 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import array
 import binascii
+import bisect
+import collections
 import configparser
+import errno
+import hashlib
+import heapq
+import io
+import mmap
+import os
 import pathlib
 import re
 import struct
+import sys
+import threading
+import time
+import weakref
 import zlib
 
+# Like git, only this many bytes at the start of a blob are checked for NULs to
+# decide if it is binary
+BINARY_SNIFF_SIZE = 8000
+
 
 class Blob:
+    __slots__ = ("oid", "data", "size", "_text")
+
     def __init__(self, oid, data):
         self.oid = oid
         self.data = data
         self.size = len(data)
-        try:
-            self.text = data.decode("utf-8")
-            self.is_binary = False
-        except:
-            self.is_binary = True
+        self._text = None
+
+    @property
+    def is_binary(self):
+        """Does the blob look binary"""
+        return self.data.find(b"\x00", 0, BINARY_SNIFF_SIZE) >= 0
+
+    @property
+    def text(self):
+        """Contents of the blob decoded as UTF-8, only decoded on first use"""
+        if self._text is None:
+            self._text = self.data.decode("utf-8", errors="replace")
+        return self._text
 
 
 S_IFMT = 0o170000
@@ -50,10 +77,17 @@ S_IFMOD = 0o160000  # submodule
 
 
 class TreeEntry:
-    def __init__(self, name, mode, oid):
+    __slots__ = ("name", "mode", "raw_oid")
+
+    def __init__(self, name, mode, raw_oid):
         self.name = name
         self.mode = mode
-        self.oid = oid
+        self.raw_oid = raw_oid
+
+    @property
+    def oid(self):
+        """Hex object ID of the entry"""
+        return binascii.hexlify(self.raw_oid).decode()
 
     def isdir(self):
         """Is this entry a directory"""
@@ -76,73 +110,285 @@ class TreeEntry:
 
 
 class Tree:
+    """A tree object, entries are only parsed when they are used
+
+    The raw tree is kept as is and the first lookup records where each entry
+    starts. Git sorts tree entries by name (with directories compared as if
+    their name ended in "/"), so single names are found by bisecting.
+    """
+
+    __slots__ = ("oid", "_data", "_offsets")
+
     def __init__(self, oid, data):
         self.oid = oid
-        self._entries = {}
-
-        while len(data) > 0:
-            meta, rest = data.split(b"\x00", 1)
-            meta = meta.decode()
-            mode, name = meta.split(" ", 1)
-            self._entries[name] = TreeEntry(
-                name, int(mode, 8), binascii.hexlify(rest[:20]).decode()
-            )
-            data = rest[20:]
+        self._data = data
+        self._offsets = None
+
+    def _index(self):
+        if self._offsets is None:
+            data = self._data
+            offsets = array.array("L")
+            pos = 0
+            while pos < len(data):
+                offsets.append(pos)
+                # entries are "<mode> <name>\0<20 byte oid>"
+                pos = data.index(b"\x00", pos) + 21
+            self._offsets = offsets
+        return self._offsets
+
+    def _sort_key(self, pos):
+        data = self._data
+        space = data.index(b" ", pos)
+        nul = data.index(b"\x00", space)
+        if data[pos:space] == b"40000":
+            return data[space + 1 : nul] + b"/"
+        return data[space + 1 : nul]
+
+    def _entry_at(self, pos):
+        data = self._data
+        space = data.index(b" ", pos)
+        nul = data.index(b"\x00", space)
+        return TreeEntry(
+            data[space + 1 : nul].decode(),
+            int(data[pos:space], 8),
+            bytes(data[nul + 1 : nul + 21]),
+        )
 
     def __getitem__(self, key):
-        return self._entries.get(key, None)
+        offsets = self._index()
+        name = key.encode()
+        # NOTE: "foo/" would otherwise match the sort key of directory "foo"
+        if b"/" in name:
+            return None
+        # we don't know if the name is a directory, so try both orders
+        for probe in (name, name + b"/"):
+            lo, hi = 0, len(offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._sort_key(offsets[mid]) < probe:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(offsets) and self._sort_key(offsets[lo]) == probe:
+                return self._entry_at(offsets[lo])
+        return None
+
+    def __contains__(self, key):
+        return self[key] is not None
+
+    def _raw_entries(self):
+        """Sort key, raw bytes and offset of every entry, in tree order"""
+        data = self._data
+        offsets = self._index()
+        for i, pos in enumerate(offsets):
+            end = offsets[i + 1] if i + 1 < len(offsets) else len(data)
+            yield self._sort_key(pos), data[pos:end], pos
+
+    def __len__(self):
+        return len(self._index())
 
     def __iter__(self):
-        return iter(self._entries.values())
+        for pos in self._index():
+            yield self._entry_at(pos)
+
+    def __repr__(self):
+        return f"Tree{repr(list(self))}"
+
+
+class TreeChange:
+    """A file that differs between two trees
+
+    The status is one of "A" (added), "D" (deleted), "M" (contents or mode
+    modified) or "T" (type changed, e.g. a file replaced by a symlink). The
+    old side of an added file and the new side of a deleted file are None.
+
+    Rename detection can also pair files up as "R" (renamed) or "C" (copied),
+    in which case the old path differs from the path and the score is the
+    similarity of the two files in percent.
+    """
+
+    __slots__ = (
+        "status",
+        "path",
+        "old_path",
+        "old_mode",
+        "new_mode",
+        "old_oid",
+        "new_oid",
+        "score",
+    )
+
+    def __init__(
+        self,
+        status,
+        path,
+        old_mode,
+        new_mode,
+        old_oid,
+        new_oid,
+        old_path=None,
+        score=None,
+    ):
+        self.status = status
+        self.path = path
+        self.old_path = path if old_path is None else old_path
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        self.old_oid = old_oid
+        self.new_oid = new_oid
+        self.score = score
 
     def __repr__(self):
-        return f"Tree{repr(self._entries.values())}"
+        if self.old_path != self.path:
+            return f"({self.status} {self.old_path} -> {self.path})"
+        return f"({self.status} {self.path})"
 
 
 class CommitStamp:
+    __slots__ = ("name", "email", "timestamp", "tz")
+
     def __init__(self, val):
-        # Parse commit stamp
-        m = re.match(r"([\s\S]*) \<([\s\S]*)\> ([\s\S]*) ([\s\S]*)", val)
+        # Parse commit stamp of the form "name <email> timestamp tz", the name
+        # and email are allowed to contain spaces so split from the right
+        ident, timestamp, self.tz = val.rsplit(" ", 2)
+        email_start = ident.rfind(" <")
         # Make sure the format was correct
-        assert m is not None
-        self.name, self.email, self.timestamp, self.tz = (
-            m.group(1),
-            m.group(2),
-            int(m.group(3)),
-            m.group(4),
-        )
+        assert email_start >= 0 and ident.endswith(">")
+        self.name = ident[:email_start]
+        self.email = ident[email_start + 2 : -1]
+        self.timestamp = int(timestamp)
 
     def __repr__(self):
         return f"{self.name} <{self.email}>"
 
 
 class Commit:
+    """A commit object
+
+    Only the tree, parents and commit time are parsed up front, which is all
+    walking history needs. The author, committer and message are decoded from
+    the raw commit the first time they are used.
+    """
+
+    __slots__ = (
+        "oid",
+        "tree",
+        "parents",
+        "commit_time",
+        "_data",
+        "_header_end",
+        "_loader",
+        "_author",
+        "_committer",
+        "_message",
+    )
+
     def __init__(self, oid, data):
         self.oid = oid
+        self._loader = None
+        self._parse(data)
+
+    @classmethod
+    def from_node(cls, node, loader):
+        """Create a commit from a commit-graph node, the commit itself is only
+        read by calling loader once a field missing from the node is used
+        """
+        commit = cls.__new__(cls)
+        commit.oid = node.oid
+        commit.tree = node.tree
+        commit.parents = list(node.parents)
+        commit.commit_time = node.timestamp
+        commit._data = None
+        commit._loader = loader
+        commit._author = commit._committer = commit._message = None
+        return commit
+
+    def _parse(self, data):
+        self._data = data
+        self._author = self._committer = self._message = None
+
+        # Headers end at the first empty line
+        self._header_end = data.find(b"\n\n")
+        if self._header_end < 0:
+            self._header_end = len(data)
+
+        # The tree and parents always come first, in that order
+        assert data.startswith(b"tree ")
+        self.tree = data[5:45].decode()
+        pos = 46
+        # NOTE: commits are shared through the object cache, and one created
+        # from the commit-graph is parsed again while others may be walking
+        # its parents, so the list is replaced as a whole
+        parents = []
+        while data.startswith(b"parent ", pos):
+            parents.append(data[pos + 7 : pos + 47].decode())
+            pos += 48
+        self.parents = parents
+
+        # Only the commit time is needed from the committer for now
+        line = self._header(b"committer ")
+        assert line is not None
+        self.commit_time = int(line.rsplit(b" ", 2)[1])
+
+    def _header(self, key):
+        """Find the value of a header line in the raw commit"""
+        data = self._data
+        pos = data.find(b"\n" + key, 0, self._header_end)
+        if pos < 0:
+            return None
+        pos += len(key) + 1
+        end = data.find(b"\n", pos)
+        if end < 0:
+            end = len(data)
+        return data[pos:end]
+
+    def _load(self):
+        """Read the rest of a commit created from a commit-graph node"""
+        if self._loader is not None:
+            self._parse(self._loader())
+            self._loader = None
+
+    def _decode(self, raw):
+        """Decode part of the commit with the encoding it declares, UTF-8 if
+        it declares none (or one Python doesn't know)
+        """
+        encoding = self._header(b"encoding ")
+        if encoding is not None:
+            try:
+                return raw.decode(encoding.decode("ascii"), errors="replace")
+            except (UnicodeDecodeError, LookupError):
+                pass
+        return raw.decode(errors="replace")
+
+    def _stamp(self, key):
+        self._load()
+        line = self._header(key)
+        if line is None:
+            return None
+        return CommitStamp(self._decode(line))
 
-        data_str = data.decode()
-        lines = data_str.split("\n")
-        if lines[-1] == "":
-            lines.pop(-1)
-
-        # Create list for parent commits
-        self.parents = []
+    @property
+    def author(self):
+        if self._author is None:
+            self._author = self._stamp(b"author ")
+        return self._author
 
-        # Parse metadata
-        for i, line in enumerate(lines):
-            if line == "":
-                self.message = "\n".join(lines[i + 1 :])
-                break
+    @property
+    def committer(self):
+        if self._committer is None:
+            self._committer = self._stamp(b"committer ")
+        return self._committer
 
-            key, val = line.split(" ", 1)
-            if key == "tree":
-                self.tree = val
-            elif key == "parent":
-                self.parents.append(val)
-            elif key == "author":
-                self.author = CommitStamp(val)
-            elif key == "committer":
-                self.committer = CommitStamp(val)
+    @property
+    def message(self):
+        if self._message is None:
+            self._load()
+            message = self._data[self._header_end + 2 :]
+            # Drop the newline ending the last line
+            if message.endswith(b"\n"):
+                message = message[:-1]
+            self._message = self._decode(message)
+        return self._message
 
     @property
     def short_oid(self):
@@ -154,275 +400,2121 @@ class Commit:
         return self.oid == other.oid
 
     def __lt__(self, other):
-        return self.committer.timestamp < other.committer.timestamp
+        return self.commit_time < other.commit_time
 
     def __repr__(self):
         return f"{self.author} {self.message}"
 
 
+# Generation number of commits missing from the commit-graph
+GENERATION_INFINITY = 0xFFFFFFFFFFFFFFFF
+
+
+class CommitNode:
+    """Lightweight view of a commit as stored in the commit-graph, everything
+    needed to walk history without reading the commit itself
+    """
+
+    __slots__ = ("oid", "tree", "parents", "generation", "timestamp")
+
+    def __init__(self, oid, tree, parents, generation, timestamp):
+        self.oid = oid
+        self.tree = tree
+        self.parents = parents
+        self.generation = generation
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f"CommitNode({self.oid} gen={self.generation})"
+
+
+# NOTE: a mapping keeps its own duplicate of the file descriptor open for as
+# long as it lives, unless told not to (only possible since Python 3.13)
+_MMAP_OPTIONS = {"trackfd": False} if sys.version_info >= (3, 13) else {}
+
+
+# What opening or mapping a file fails with when the process is out of
+# resources, as opposed to the file being unreadable
+_RESOURCE_ERRNOS = (errno.EMFILE, errno.ENFILE, errno.ENOMEM)
+
+
+def _map_file(path):
+    """Map a file into memory read-only, or read it if it can't be mapped"""
+    with open(path, "rb") as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ, **_MMAP_OPTIONS)
+        except ValueError:
+            # Empty files can't be mapped
+            return b""
+        except OSError as e:
+            # Neither can files on some more exotic filesystems, fall back to
+            # keeping a copy in memory
+            # NOTE: anything else (e.g. running out of descriptors or address
+            # space) must not quietly turn into reading whole packs
+            if e.errno != errno.ENODEV:
+                raise
+            return file.read()
+
+
+class _OidTable:
+    """Sequence view of a table of binary object IDs inside a buffer, this
+    lets the bisect module search the table without copying it
+    """
+
+    def __init__(self, buf, base, count):
+        self.buf = buf
+        self.base = base
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        off = self.base + idx * 20
+        return bytes(self.buf[off : off + 20])
+
+    def prefix_matches(self, fanout, prefix):
+        """Find the object IDs starting with a hex prefix (of at least two
+        digits) with the help of the fanout table of the table
+        """
+        lower = binascii.unhexlify(prefix.ljust(40, "0"))
+        first = lower[0]
+        left = fanout[first - 1] if first > 0 else 0
+        right = fanout[first]
+        matches = []
+        for idx in range(bisect.bisect_left(self, lower, left, right), right):
+            oid = self[idx].hex()
+            if not oid.startswith(prefix):
+                break
+            matches.append(oid)
+        return matches
+
+
+def _decode_delta_header(delta):
+    """Decode the base and result sizes at the start of a delta, returns them
+    together with the index of the first opcode
+    """
+    idx = 0
+    sizes = []
+    for _ in range(2):
+        num = 0
+        shift = 0
+        while True:
+            b = delta[idx]
+            idx += 1
+            num |= (b & 0x7F) << shift
+            shift += 7
+            if (b & 0x80) == 0:
+                break
+        sizes.append(num)
+    return sizes[0], sizes[1], idx
+
+
+def apply_delta(base_data, delta_data):
+    """Apply a delta to the provided base data
+
+    The result is written into a bytearray preallocated to the length declared
+    by the delta, so this runs in time linear to the size of the result.
+    """
+    base_len, result_len, idx = _decode_delta_header(delta_data)
+    assert base_len == len(base_data)
+
+    base = memoryview(base_data)
+    delta = memoryview(delta_data)
+    result = bytearray(result_len)
+    out = 0
+    end = len(delta_data)
+    while idx < end:
+        # Read opcode
+        op = delta_data[idx]
+        idx += 1
+        if op & 0x80 != 0:
+            # Copy from base object, the opcode tells which bytes of the
+            # offset and size operands follow it
+            offs = 0
+            if op & 0x01:
+                offs = delta_data[idx]
+                idx += 1
+            if op & 0x02:
+                offs |= delta_data[idx] << 8
+                idx += 1
+            if op & 0x04:
+                offs |= delta_data[idx] << 16
+                idx += 1
+            if op & 0x08:
+                offs |= delta_data[idx] << 24
+                idx += 1
+            size = 0
+            if op & 0x10:
+                size = delta_data[idx]
+                idx += 1
+            if op & 0x20:
+                size |= delta_data[idx] << 8
+                idx += 1
+            if op & 0x40:
+                size |= delta_data[idx] << 16
+                idx += 1
+            if size == 0:
+                # NOTE: this is a "lovely" undocumented special case I
+                # found out about after banging my head into the table
+                # for 5 hours, than finally deciding to read the sources
+                size = 0x10000
+            assert offs + size <= base_len
+            result[out : out + size] = base[offs : offs + size]
+        else:
+            # Add from delta data
+            assert op != 0
+            size = op
+            assert idx + size <= end
+            result[out : out + size] = delta[idx : idx + size]
+            idx += size
+        out += size
+        assert out <= result_len
+
+    # Verify result length, than return result
+    assert out == result_len
+    return result
+
+
+def _parse_delta(delta_data, limit=None):
+    """Decode a delta into a list of operations, returns the base size, the
+    result size and the operations, copies from the base are represented by
+    (offset, size) tuples, and inserts by the inserted bytes
+
+    With a limit, only the operations building the first limit bytes of the
+    result are decoded, so delta_data may be just the start of the delta.
+    """
+    base_len, result_len, idx = _decode_delta_header(delta_data)
+    ops = []
+    end = len(delta_data)
+    out = 0
+    if limit is None:
+        limit = sys.maxsize
+    while idx < end and out < limit:
+        op = delta_data[idx]
+        idx += 1
+        if op & 0x80 != 0:
+            offs = 0
+            size = 0
+            for bit, shift in ((0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)):
+                if op & bit:
+                    offs |= delta_data[idx] << shift
+                    idx += 1
+            for bit, shift in ((0x10, 0), (0x20, 8), (0x40, 16)):
+                if op & bit:
+                    size |= delta_data[idx] << shift
+                    idx += 1
+            if size == 0:
+                size = 0x10000
+            assert offs + size <= base_len
+            size = min(size, limit - out)
+            ops.append((offs, size))
+        else:
+            assert op != 0
+            size = min(op, limit - out)
+            ops.append(delta_data[idx : idx + size])
+            idx += op
+        out += size
+    return base_len, result_len, ops
+
+
+def compose_deltas(deltas):
+    """Merge a chain of deltas into a single list of operations
+
+    The first delta applies to the base object, every following one to the
+    result of its predecessor. Composing only ever touches the operations of
+    the deltas, so none of the intermediate objects have to be built.
+
+    Returns:
+        (base_len, result_len, ops) in the format used by _parse_delta
+    """
+    base_len, result_len, ops = _parse_delta(deltas[0])
+    for delta_data in deltas[1:]:
+        # Output offsets at which each operation of the lower delta starts
+        starts = []
+        pos = 0
+        for op in ops:
+            starts.append(pos)
+            pos += op[1] if type(op) is tuple else len(op)
+
+        upper_base_len, result_len, upper_ops = _parse_delta(delta_data)
+        assert upper_base_len == pos
+
+        # Rewrite copies from the intermediate object in terms of the
+        # operations of the lower delta that produced those bytes
+        merged = []
+        for op in upper_ops:
+            if type(op) is not tuple:
+                merged.append(op)
+                continue
+            offs, size = op
+            i = bisect.bisect_right(starts, offs) - 1
+            while size > 0:
+                lower = ops[i]
+                skip = offs - starts[i]
+                if type(lower) is tuple:
+                    take = min(lower[1] - skip, size)
+                    merged.append((lower[0] + skip, take))
+                else:
+                    take = min(len(lower) - skip, size)
+                    merged.append(lower[skip : skip + take])
+                offs += take
+                size -= take
+                i += 1
+        ops = merged
+
+    return base_len, result_len, ops
+
+
+def apply_delta_chain(base_data, deltas):
+    """Apply a chain of deltas to the provided base data in one go by
+    composing them first
+    """
+    base_len, result_len, ops = compose_deltas(deltas)
+    assert base_len == len(base_data)
+
+    base = memoryview(base_data)
+    result = bytearray(result_len)
+    out = 0
+    for op in ops:
+        if type(op) is tuple:
+            offs, size = op
+            result[out : out + size] = base[offs : offs + size]
+        else:
+            size = len(op)
+            result[out : out + size] = op
+        out += size
+
+    assert out == result_len
+    return result
+
+
+class PackError(Exception):
+    """A pack or its index is corrupt"""
+
+
+class CommitGraphError(Exception):
+    """A commit-graph file is corrupt"""
+
+
+class DeltaBaseCache:
+    """Byte bounded LRU cache of inflated delta bases
+
+    This works the same way as git's own delta base cache (see
+    core.deltaBaseCacheLimit), entries are keyed by pack and offset, so
+    the cache can be shared between all packs of a repository, or even
+    between repositories.
+    """
+
+    def __init__(self, limit=96 << 20):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pack, offset):
+        """Lookup a cached base, returns its type and data"""
+        with self._lock:
+            entry = self._entries.get((pack, offset))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end((pack, offset))
+            return entry
+
+    def put(self, pack, offset, obj_type, data):
+        """Remember a base, evicting the least recently used ones if needed"""
+        # Caching something that would evict everything else is pointless
+        if len(data) > self.limit:
+            return
+
+        key = (pack, offset)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = obj_type, data
+            self.size += len(data)
+            while self.size > self.limit:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, packs):
+        """Forget every base cached from some packs"""
+        packs = set(packs)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in packs]:
+                _, data = self._entries.pop(key)
+                self.size -= len(data)
+
+    def __repr__(self):
+        return (
+            f"DeltaBaseCache({self.size}/{self.limit} bytes, "
+            f"{self.hits} hits, {self.misses} misses)"
+        )
+
+
+class PackMappingPool:
+    """Bounded set of mapped files, shared by all repositories of a process
+
+    Each mapping holds on to a file descriptor (see _map_file) and address
+    space, so what needs bounding with many repositories open is the number
+    of mappings. Packs, pack indexes, multi-pack-indexes and commit-graphs
+    are all mapped through the pool, so it bounds the descriptors of the
+    whole process however many repositories and packs there are.
+    Once there are too many, the least recently used file is dropped from
+    the pool and mapped again the next time it's read. Reads in progress hold
+    on to the mapping they started with, so they are never cut short.
+    """
+
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.maps = 0
+        self.unmaps = 0
+        self._mappings = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, mapped):
+        """Get the mapping of a _PooledFile, mapping it if needed"""
+        with self._lock:
+            data = self._mappings.get(mapped)
+            if data is not None:
+                self._mappings.move_to_end(mapped)
+                return data
+
+            data = memoryview(_map_file(mapped.path))
+            self.maps += 1
+            self._mappings[mapped] = data
+            while len(self._mappings) > self.limit:
+                self._mappings.popitem(last=False)
+                self.unmaps += 1
+            return data
+
+    def release(self, mapped):
+        """Drop the mapping of a file that is no longer used"""
+        with self._lock:
+            if self._mappings.pop(mapped, None) is not None:
+                self.unmaps += 1
+
+    def __repr__(self):
+        return (
+            f"PackMappingPool({len(self._mappings)}/{self.limit} mapped, "
+            f"{self.maps} maps, {self.unmaps} unmaps)"
+        )
+
+
+_mapping_pool = PackMappingPool()
+
+
+class _PooledFile:
+    """A file mapped through a PackMappingPool
+
+    Readers get the mapping from acquire (or the data property) and keep a
+    reference to it for as long as they read from it, which keeps it mapped
+    even if the pool drops it in the meantime.
+    """
+
+    def __init__(self, path, pool=None):
+        self.path = pathlib.Path(path)
+        self.pool = _mapping_pool if pool is None else pool
+        self._ref = None
+
+    def acquire(self):
+        """Get the mapping, marking it as the most recently used"""
+        data = self.pool.acquire(self)
+        self._ref = weakref.ref(data)
+        return data
+
+    @property
+    def data(self):
+        """The mapping, without going through the pool while it is alive"""
+        data = self._ref() if self._ref is not None else None
+        if data is None:
+            data = self.acquire()
+        return data
+
+    def close(self):
+        """Unmap the file once nobody is reading from it anymore"""
+        self.pool.release(self)
+
+
+class _BatchBases:
+    """Delta bases shared by the objects of a batch read from a pack
+
+    Every base that more than one delta chain of the batch goes through is
+    kept until the last object needing it has been read, whatever the delta
+    base cache decides to evict in the meantime.
+    """
+
+    def __init__(self, chains):
+        self._uses = collections.Counter()
+        for chain in chains:
+            self._uses.update(chain[1:])
+        self._bases = {}
+
+    def get(self, obj_offs):
+        return self._bases.get(obj_offs)
+
+    def keep(self, obj_offs, obj_type, obj_data):
+        if self._uses[obj_offs] > 0:
+            self._bases[obj_offs] = obj_type, obj_data
+
+    def done(self, chain):
+        """Forget bases no other object of the batch needs anymore"""
+        for obj_offs in chain[1:]:
+            self._uses[obj_offs] -= 1
+            if self._uses[obj_offs] == 0:
+                self._bases.pop(obj_offs, None)
+
+
 class PackFile:
-    def __init__(self, idxpath, packpath):
+    # Number of recently resolved offsets to remember
+    OFFSET_CACHE_SIZE = 1024
+    # Objects are verified in segments of about this many bytes
+    VERIFY_SEGMENT_SIZE = 32 << 20
+
+    def __init__(
+        self,
+        idxpath,
+        packpath,
+        base_cache=None,
+        compose_deltas=False,
+        mapping_pool=None,
+    ):
         self.idxpath = pathlib.Path(idxpath)
         self.packpath = pathlib.Path(packpath)
-
-        # Load pack index
+        # Packs and their indexes are only mapped while they are in the pool
+        self._idx_file = _PooledFile(self.idxpath, mapping_pool)
+        self._pack_file = _PooledFile(self.packpath, mapping_pool)
+        # Delta bases might be shared with the other packs of a repository
+        self.base_cache = DeltaBaseCache() if base_cache is None else base_cache
+        # Merge delta chains before applying them instead of building (and
+        # caching) every intermediate object, this pays off for long chains
+        # of large objects that are rarely read twice
+        self.compose_deltas = compose_deltas
+
+        # Map the pack index, all lookups are served from the mapping
         # Please note that for now we only support the v2 idx format
-        with self.idxpath.open("rb") as idxfile:
-            # Check magic number
-            assert idxfile.read(4) == b"\377tOc"
-            # Check version number
-            assert idxfile.read(4) == b"\x00\x00\x00\x02"
-            # Read fan-out table
-            self.fanout = struct.unpack(">256I", idxfile.read(256 * 4))
+        idx = self._idx
+        # Header, fan-out table and the two checksums at the end
+        if len(idx) < 1072:
+            raise PackError(f"{self.idxpath.name}: truncated index")
+        # Check magic number and version number
+        if idx[:4] != b"\377tOc" or idx[4:8] != b"\x00\x00\x00\x02":
+            raise PackError(f"{self.idxpath.name}: not a version 2 pack index")
+        # Read fan-out table
+        self.fanout = struct.unpack_from(">256I", idx, 8)
+        self.count = self.fanout[-1]
+        if len(idx) < 1072 + self.count * 28:
+            raise PackError(f"{self.idxpath.name}: truncated index")
+
+        # Locate the tables following the fan-out table
+        self._crc_base = 1032 + self.count * 20
+        self._off_base = self._crc_base + self.count * 4
+        self._bigoff_base = self._off_base + self.count * 4
+
+        # Tree and log pages tend to look up the same objects over and over
+        self._offset_cache = {}
+        self._offset_lock = threading.Lock()
+
+        # Map the pack itself, objects are inflated straight out of the
+        # mapping through zero-copy slices
+        pack = self._acquire()
+        # Header and the checksum at the end
+        if len(pack) < 32:
+            raise PackError(f"{self.packpath.name}: truncated pack")
+        # Check magic number and version number
+        if pack[:4] != b"PACK" or pack[4:8] not in (
+            b"\x00\x00\x00\x02",
+            b"\x00\x00\x00\x03",
+        ):
+            raise PackError(f"{self.packpath.name}: not a version 2 or 3 pack")
 
-    def _get_offset(self, oid):
-        """Resolve an object ID into an offset into the file"""
-        oid_bytes = binascii.unhexlify(oid)
+    @property
+    def mapping_pool(self):
+        return self._pack_file.pool
 
-        # Find previous fanout entry
-        prev_cnt = self.fanout[oid_bytes[0] - 1] if oid_bytes[0] > 0 else 0
-        # Count of hashes starting with our first byte
-        cnt = self.fanout[oid_bytes[0]] - prev_cnt
-        if cnt == 0:
-            return None
+    @mapping_pool.setter
+    def mapping_pool(self, pool):
+        self.close()
+        self._idx_file.pool = self._pack_file.pool = pool
+
+    def _acquire(self):
+        """Get the mapping of the pack, callers keep a reference to it for as
+        long as they read from it, see _PooledFile
+        """
+        return self._pack_file.acquire()
 
-        # Binary search the index file for our hash
-        def hash_offs(idx):
-            return 1032 + (prev_cnt + idx) * 20
+    @property
+    def _pack(self):
+        return self._pack_file.data
 
-        def entry_off(idx):
-            return 1032 + self.fanout[-1] * 24 + (prev_cnt + idx) * 4
+    @property
+    def _idx(self):
+        return self._idx_file.data
 
-        def bigentry_off(idx):
-            return 1032 + self.fanout[-1] * 28 + idx * 8
+    @property
+    def _oids(self):
+        return _OidTable(self._idx, 1032, self.count)
 
-        def compare_hash(h1, h2):
-            idx = 0
-            while idx < 20 and h1[idx] == h2[idx]:
-                idx += 1
-            if idx == 20:
-                return 0
-            if h1[idx] < h2[idx]:
-                return -1
-            else:
-                return 1
-
-        def bsearch_hash(file):
-            left = 0
-            right = cnt - 1
-            while left <= right:
-                mid = (left + right) // 2
-                idxfile.seek(hash_offs(mid))
-                cur_hash = idxfile.read(20)
-                result = compare_hash(cur_hash, oid_bytes)
-                if result < 0:
-                    left = mid + 1
-                elif result > 0:
-                    right = mid - 1
-                else:
-                    return mid
+    def close(self):
+        """Unmap the pack and its index once nobody is reading from them"""
+        self._pack_file.close()
+        self._idx_file.close()
+
+    def _get_offset(self, oid):
+        """Resolve an object ID into an offset into the file"""
+        with self._offset_lock:
+            off = self._offset_cache.get(oid)
+        if off is not None:
+            return off
+
+        oid_bytes = binascii.unhexlify(oid)
+
+        # Hashes starting with our first byte are between these entries
+        first = oid_bytes[0]
+        left = self.fanout[first - 1] if first > 0 else 0
+        right = self.fanout[first]
+
+        # Binary search the mapped hash table for our hash
+        data = self._idx
+        oids = _OidTable(data, 1032, self.count)
+        idx = bisect.bisect_left(oids, oid_bytes, left, right)
+        if idx == right or oids[idx] != oid_bytes:
             return None
 
-        with self.idxpath.open("rb") as idxfile:
-            entry_idx = bsearch_hash(idxfile)
-            if entry_idx is None:
-                return None
-            idxfile.seek(entry_off(entry_idx))
-            (off,) = struct.unpack(">I", idxfile.read(4))
-            if off > 0x7fffffff:
-                idxfile.seek(bigentry_off(off & 0x7fffffff))
-            if off > 0x7FFFFFFF:
-                idxfile.seek(bigentry_off(off & 0x7FFFFFFF))
-                (off,) = struct.unpack(">Q", idxfile.read(8))
+        (off,) = struct.unpack_from(">I", data, self._off_base + idx * 4)
+        if off & 0x80000000:
+            # Offsets past 2GiB are stored in a separate 64-bit table
+            (off,) = struct.unpack_from(
+                ">Q", data, self._bigoff_base + (off & 0x7FFFFFFF) * 8
+            )
 
+        with self._offset_lock:
+            if len(self._offset_cache) >= self.OFFSET_CACHE_SIZE:
+                # Evict the oldest entry, dicts remember insertion order
+                del self._offset_cache[next(iter(self._offset_cache))]
+            self._offset_cache[oid] = off
         return off
 
-    def _get_object(self, oid, obj_offs=None):
+    def prefix_matches(self, prefix):
+        """Object IDs in the pack starting with a hex prefix"""
+        return self._oids.prefix_matches(self.fanout, prefix)
+
+    def _read_header(self, pos):
+        """Decode the variable length object header at an offset, returns the
+        type, the size and the offset of the data following the header
+        """
+        b = self._pack[pos]
+        pos += 1
+        obj_type = (b & 0x70) >> 4
+        obj_size = b & 0xF
+        shift = 4
+        while b & 0x80:
+            b = self._pack[pos]
+            pos += 1
+            obj_size |= (b & 0x7F) << shift
+            shift += 7
+        return obj_type, obj_size, pos
+
+    def _read_delta_base(self, obj_type, obj_offs, pos):
+        """Decode the base reference of a delta whose header was followed by
+        pos, returns the offset of the base and of the delta data
+        """
+        if obj_type == 6:
+            # Read negative object offset
+            # NOTE: this is encoded in a completely unspecified way, that
+            # all blogposts get wrong, and the git documentation doesn't
+            # mention at all, the real decoding algorithm can be found in
+            # "builtin/index-pack.c" in the git source tree
+            b = self._pack[pos]
+            pos += 1
+            offset = b & 0x7F
+            while (b & 0x80) != 0:
+                offset += 1
+                b = self._pack[pos]
+                pos += 1
+                offset <<= 7
+                offset |= b & 0x7F
+            # Bases always come before their deltas, anything else would
+            # send us round in circles (or wrap around to the end)
+            if offset == 0 or offset > obj_offs:
+                raise PackError(f"bad delta base offset at {obj_offs}")
+            return obj_offs - offset, pos
+
+        # NOTE: packs on disk are never thin, so the base object must be in
+        # this very pack
+        base_offs = self._get_offset(self._pack[pos : pos + 20].hex())
+        if base_offs is None or base_offs == obj_offs:
+            raise PackError(f"bad delta base at {obj_offs}")
+        return base_offs, pos + 20
+
+    def _inflate_head(self, pos, size):
+        """Inflate no more than the first size bytes of the zlib stream at an
+        offset into the pack
+        """
+        inflater = zlib.decompressobj()
+        data = b""
+        while len(data) < size and not inflater.eof:
+            chunk = inflater.unconsumed_tail
+            if not chunk:
+                chunk = self._pack[pos : pos + 512]
+                assert len(chunk) > 0, "truncated pack"
+                pos += len(chunk)
+            data += inflater.decompress(chunk, size - len(data))
+        return data
+
+    def _inflate(self, pos, size):
+        """Inflate the zlib stream at an offset into the pack, size is the
+        inflated size from the object header, returns the data and the offset
+        of the first byte after the stream
+        """
+        inflater = zlib.decompressobj()
+        # Deflate grows incompressible data by only a few bytes per block, so
+        # sizing the input window from the header almost always lets us
+        # inflate the whole stream in a single call
+        window = size + (size >> 9) + 64
+        chunks = []
+        while not inflater.eof:
+            chunk = self._pack[pos : pos + window]
+            assert len(chunk) > 0, "truncated pack"
+            chunks.append(inflater.decompress(chunk))
+            pos += len(chunk)
+        # Whatever zlib didn't consume belongs to the next object
+        pos -= len(inflater.unused_data)
+
+        data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+        assert len(data) == size
+        return data, pos
+
+    def _chain_offsets(self, obj_offs):
+        """Offsets of an object and of every base in its delta chain, found
+        from the object headers alone
+        """
+        chain = [obj_offs]
+        while True:
+            obj_type, _, pos = self._read_header(obj_offs)
+            if obj_type != 6 and obj_type != 7:
+                return chain
+            obj_offs, _ = self._read_delta_base(obj_type, obj_offs, pos)
+            chain.append(obj_offs)
+
+    def _get_object(self, oid, obj_offs=None, batch=None):
         """Read the raw underlying data of an object"""
+        # Keeps the pack mapped until we are done
+        pack = self._acquire()
         if obj_offs is None:
             obj_offs = self._get_offset(oid)
             if obj_offs is None:
                 return None
 
-        def decode_obj_header(packfile):
-            """Decode the variable length object header"""
-            b = packfile.read(1)[0]
-            obj_type = (b & 0x70) >> 4
-            obj_size = b & 0xF
-            shift = 4
-            while b & 0x80:
-                b = packfile.read(1)[0]
-                obj_size |= (b & 0x7F) << shift
-                shift += 7
-            return obj_type, obj_size
-
-        def decompress_stream(stream):
-            """Decompress zlib data from a stream without knowing the
-            compressed size of said data
-            """
-            CHUNK_SIZE = 1024
-            deflator = zlib.decompressobj()
-            defl_data = b""
-            while True:
-                chunk = stream.read(CHUNK_SIZE)
-                if chunk is None:
-                    break
-
-                # This is ugly, but as soon as we hit invalid data we break,
-                # this is the only way to decompress data without knowing its
-                # length using python's zlib library
-                try:
-                    defl_data += deflator.decompress(chunk)
-                    defl_data += deflator.flush()
-                except:
-                    break
-            return defl_data
-
-        def apply_delta(base_data, delta_data):
-            """Apply a delta to the provided base data"""
-
-            # Current index into the delta buffer
-            idx = 0
-
-            def decode_varint():
-                """Decode a variable length integer"""
-                nonlocal delta_data
-                nonlocal idx
-                num = 0
-                shift = 0
-                while True:
-                    b = delta_data[idx]
-                    idx += 1
-                    num |= (b & 0x7F) << shift
-                    shift += 7
-                    if (b & 0x80) == 0:
-                        break
-                return num
-
-            # Read base length and verify it
-            base_len = decode_varint()
-            assert base_len == len(base_data)
-
-            # Read expected result length
-            result_len = decode_varint()
-
-            def decode_copy_delta(mask):
-                """Decode a copy delta operand based on the provided mask"""
-                nonlocal delta_data
-                nonlocal idx
-                bit = 1
-                num = 0
-                shift = 0
-                while bit <= mask:
-                    if (mask & bit) != 0:
-                        num |= delta_data[idx] << shift
-                        idx += 1
-                    shift += 8
-                    bit <<= 1
-                return num
-
-            result = b""
-            while idx < len(delta_data):
-                # Read opcode
-                op = delta_data[idx]
-                idx += 1
-                if op & 0x80 != 0:
-                    # Copy from base object
-                    offs = decode_copy_delta(op & 0xF)
-                    size = decode_copy_delta((op & 0x70) >> 4)
-                    assert offs < len(base_data)
-                    assert offs + size <= len(base_data)
-                    if size == 0:
-                        # NOTE: this is a "lovely" undocumented special case I
-                        # found out about after banging my head into the table
-                        # for 5 hours, than finally deciding to read the sources
-                        size = 0x10000
-                    result += base_data[offs : offs + size]
-                else:
-                    # Add from delta data
-                    assert op != 0
-                    assert idx < len(delta_data)
-                    assert idx + op <= len(delta_data)
-                    result += delta_data[idx : idx + op]
-                    idx += op
-
-            # Verify result length, than return result
-            assert result_len == len(result)
-            return result
+        # Walk down the delta chain until we reach an object that is either
+        # cached or stored whole, remembering the deltas along the way
+        chain = []
+        while True:
+            cached = batch.get(obj_offs) if batch is not None else None
+            if cached is None:
+                cached = self.base_cache.get(self, obj_offs)
+            if cached is not None:
+                obj_type, obj_data = cached
+                break
 
-        with self.packpath.open("rb") as packfile:
-            packfile.seek(obj_offs)
-            obj_type, obj_size = decode_obj_header(packfile)
-
-            # De-deltify object if needed
-            if obj_type == 6:
-                # Read negative object offset
-                # NOTE: this is encoded in a completely unspecified way, that
-                # all blogposts get wrong, and the git documentation doesn't
-                # mention at all, the real decoding algorithm can be found in
-                # "builtin/index-pack.c" in the git source tree
-                b = packfile.read(1)[0]
-                offset = b & 0x7F
-                while (b & 0x80) != 0:
-                    offset += 1
-                    b = packfile.read(1)[0]
-                    offset <<= 7
-                    offset |= b & 0x7F
-                # Read base object
-                base_type, base_data = self._get_object(
-                    None, obj_offs=obj_offs - offset
-                )
-                # Apply deltas
-                obj_type = base_type
-                delta_data = decompress_stream(packfile)
-                assert obj_size == len(delta_data)
-                obj_data = apply_delta(base_data, delta_data)
-            elif obj_type == 7:
-                # Read base object
-                base_oid = binascii.hexlify(packfile.read(20)).decode()
-                base_type, base_data = self._get_object(base_oid)
-                # Apply deltas
-                obj_type = base_type
-                delta_data = decompress_stream(packfile)
-                assert obj_size == len(delta_data)
-                obj_data = apply_delta(base_data, delta_data)
+            obj_type, obj_size, pos = self._read_header(obj_offs)
+            if obj_type == 6 or obj_type == 7:
+                base_offs, pos = self._read_delta_base(obj_type, obj_offs, pos)
+                chain.append((obj_offs, pos, obj_size))
+                obj_offs = base_offs
             else:
                 # Just simple compressed data
-                obj_data = decompress_stream(packfile)
-                assert obj_size == len(obj_data)
+                obj_data, _ = self._inflate(pos, obj_size)
+                break
 
-            return obj_type, obj_data
+        if self.compose_deltas and len(chain) > 1:
+            deltas = [self._inflate(pos, size)[0] for _, pos, size in reversed(chain)]
+            return obj_type, apply_delta_chain(obj_data, deltas)
+
+        # Apply the deltas from the bottom of the chain upwards, every object
+        # we pass on the way serves as a base so remember it
+        for delta_offs, pos, delta_size in reversed(chain):
+            self.base_cache.put(self, obj_offs, obj_type, obj_data)
+            if batch is not None:
+                batch.keep(obj_offs, obj_type, obj_data)
+            delta_data, _ = self._inflate(pos, delta_size)
+            obj_data = apply_delta(obj_data, delta_data)
+            obj_offs = delta_offs
+
+        if batch is not None:
+            batch.keep(obj_offs, obj_type, obj_data)
+        return obj_type, obj_data
+
+    def _get_head(self, obj_offs, size):
+        """Read no more than the first size bytes of an object, returns its
+        type and the data
+
+        Deltas aren't applied whole: only the start of each delta in the
+        chain is inflated, and only as much of its base as that start copies
+        from, so the work is bounded by size rather than by the object.
+        """
+        # Keeps the pack mapped until we are done
+        pack = self._acquire()
+
+        # Walk down the delta chain, working out how much of each base the
+        # object above it needs
+        chain = []
+        while True:
+            cached = self.base_cache.get(self, obj_offs)
+            if cached is not None:
+                obj_type, obj_data = cached
+                obj_data = obj_data[:size]
+                break
+
+            obj_type, obj_size, pos = self._read_header(obj_offs)
+            if obj_type != 6 and obj_type != 7:
+                obj_data = self._inflate_head(pos, min(size, obj_size))
+                break
+
+            base_offs, pos = self._read_delta_base(obj_type, obj_offs, pos)
+            # The sizes take at most 20 bytes, and every operation at most 8
+            # bytes per byte of result it builds
+            delta_head = self._inflate_head(pos, min(obj_size, 20 + 8 * size))
+            _, _, ops = _parse_delta(delta_head, size)
+            chain.append(ops)
+            size = max((op[0] + op[1] for op in ops if type(op) is tuple), default=0)
+            obj_offs = base_offs
+
+        for ops in reversed(chain):
+            obj_data = b"".join(
+                obj_data[op[0] : op[0] + op[1]] if type(op) is tuple else op
+                for op in ops
+            )
+        return obj_type, obj_data
+
+    def _get_many(self, items):
+        """Read several objects in the order they are stored in the pack
+
+        Args:
+            items: (offset, key) pairs.
+
+        Yields:
+            (key, type, data) for every item.
+        """
+        pack = self._acquire()
+        items = sorted(items, key=lambda item: item[0])
+        chains = [self._chain_offsets(obj_offs) for obj_offs, _ in items]
+        batch = _BatchBases(chains)
+        for (obj_offs, key), chain in zip(items, chains):
+            obj_type, obj_data = self._get_object(key, obj_offs, batch)
+            batch.done(chain)
+            yield key, obj_type, obj_data
+
+    def _open_stream(self, obj_offs):
+        """Open a raw file object inflating an object as it is read, returns
+        the file object, the type and the size, or None for deltas (these can
+        only be built in one go)
+        """
+        pack = self._acquire()
+        obj_type, obj_size, pos = self._read_header(obj_offs)
+        if obj_type == 6 or obj_type == 7:
+            return None
+
+        def read(n):
+            nonlocal pos
+            chunk = pack[pos : pos + n]
+            pos += len(chunk)
+            return chunk
+
+        return _InflateStream(read), obj_type, obj_size
+
+    def _get_info(self, obj_offs):
+        """Find the type and size of an object without inflating it, for
+        deltas only the header of the delta is inflated to learn the size
+        """
+        pack = self._acquire()
+        obj_type, obj_size, pos = self._read_header(obj_offs)
+        if obj_type != 6 and obj_type != 7:
+            return obj_type, obj_size
+
+        # Both sizes at the start of a delta are at most 10 bytes long
+        base_offs, pos = self._read_delta_base(obj_type, obj_offs, pos)
+        _, obj_size, _ = _decode_delta_header(self._inflate_head(pos, 20))
+
+        # The type is that of the object at the bottom of the delta chain
+        while True:
+            obj_type, _, pos = self._read_header(base_offs)
+            if obj_type != 6 and obj_type != 7:
+                return obj_type, obj_size
+            base_offs, _ = self._read_delta_base(obj_type, base_offs, pos)
+
+    def _object_spans(self):
+        """Where every object is stored in the pack, as (index in the idx,
+        offset, end offset) in the order the objects are stored in
+        """
+        data = self._idx
+        offsets = list(struct.unpack_from(f">{self.count}I", data, self._off_base))
+        for idx, off in enumerate(offsets):
+            if off & 0x80000000:
+                (offsets[idx],) = struct.unpack_from(
+                    ">Q", data, self._bigoff_base + (off & 0x7FFFFFFF) * 8
+                )
+        order = sorted(range(self.count), key=offsets.__getitem__)
+        # Objects end where the next one starts, the last one at the trailer
+        ends = [offsets[idx] for idx in order[1:]] + [len(self._pack) - 20]
+        return [(idx, offsets[idx], end) for idx, end in zip(order, ends)]
+
+    def verify(self, executor, full=False):
+        """Start checking the integrity of the pack in a process pool
+
+        The trailers of the pack and of its index are checked, and so is the
+        CRC32 of every object. With full set, every object is also inflated
+        and hashed, which takes a lot longer. The objects are split into
+        segments of about VERIFY_SEGMENT_SIZE bytes checked in parallel.
+
+        Args:
+            executor: concurrent.futures executor to run the checks in.
+            full: also check the SHA-1 of every object.
+
+        Returns:
+            PackVerification to wait for the outcome with.
+        """
+        futures = [executor.submit(_verify_trailers, self.idxpath, self.packpath)]
+        segment = []
+        segment_size = 0
+        for span in self._object_spans():
+            segment.append(span)
+            segment_size += span[2] - span[1]
+            if segment_size >= self.VERIFY_SEGMENT_SIZE:
+                futures.append(
+                    executor.submit(
+                        _verify_objects, self.idxpath, self.packpath, segment, full
+                    )
+                )
+                segment = []
+                segment_size = 0
+        if segment:
+            futures.append(
+                executor.submit(
+                    _verify_objects, self.idxpath, self.packpath, segment, full
+                )
+            )
+        return PackVerification(futures)
 
     def __getitem__(self, oid):
         """Read an object from the pack file"""
         obj = self._get_object(oid)
         if obj is None:
             return None
-        obj_type, obj_data = obj
+        return _make_object(oid, *obj)
+
+
+class PackVerification:
+    """Checks of a pack running in a process pool, see PackFile.verify
+
+    The checks open the pack by path themselves, so nothing here keeps the
+    PackFile (or its repository) alive while they run.
+    """
+
+    def __init__(self, futures, problems=()):
+        self._futures = futures
+        # Problems found before any check could be started
+        self._problems = list(problems)
+
+    def problems(self):
+        """Wait for the checks to finish, returns a list of the problems found,
+        which is empty if the pack is fine
+        """
+        problems = list(self._problems)
+        for future in self._futures:
+            try:
+                problems.extend(future.result())
+            except Exception as e:
+                # NOTE: e.g. a worker process crashing, this must not take the
+                # checks of the other packs down with it
+                problems.append(f"check failed ({e!r})")
+        return problems
+
+
+# What reading a corrupt object can run into
+_PACK_READ_ERRORS = (
+    PackError,
+    zlib.error,
+    AssertionError,
+    IndexError,
+    KeyError,
+    ValueError,
+    struct.error,
+)
+
+
+def _verify_trailers(idxpath, packpath):
+    """Check the header and checksums of a pack and its index"""
+    problems = []
+    try:
+        pack = PackFile(idxpath, packpath, mapping_pool=PackMappingPool(limit=2))
+    except (PackError, OSError) as e:
+        return [f"unreadable ({e})"]
+    data = pack._acquire()
+    (count,) = struct.unpack_from(">I", data, 8)
+    if count != pack.count:
+        problems.append(f"pack has {count} objects, index has {pack.count}")
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        problems.append("pack checksum mismatch")
+    idx = pack._idx
+    if idx[-40:-20] != data[-20:]:
+        problems.append("index is for a different pack")
+    if hashlib.sha1(idx[:-20]).digest() != idx[-20:]:
+        problems.append("index checksum mismatch")
+    return problems
+
+
+def _verify_objects(idxpath, packpath, spans, full):
+    """Check the CRC32 of objects of a pack (and their SHA-1 if full)"""
+    problems = []
+    try:
+        pack = PackFile(idxpath, packpath, mapping_pool=PackMappingPool(limit=2))
+    except (PackError, OSError):
+        # already reported by _verify_trailers
+        return []
+    data = pack._acquire()
+    idx_data = pack._idx
+    oids = pack._oids
+    items = []
+    for idx, obj_offs, end in spans:
+        oid = oids[idx].hex()
+        (crc,) = struct.unpack_from(">I", idx_data, pack._crc_base + idx * 4)
+        if zlib.crc32(data[obj_offs:end]) != crc:
+            problems.append(f"{oid}: CRC32 mismatch")
+        elif full:
+            items.append((obj_offs, oid))
+
+    # NOTE: objects are read in pack order, so bases shared by several of
+    # them are only built once. Each object is read on its own, so a broken
+    # object is only blamed on the objects whose delta chain goes through it
+    chains = []
+    for obj_offs, oid in items:
+        try:
+            chains.append((obj_offs, oid, pack._chain_offsets(obj_offs)))
+        except _PACK_READ_ERRORS as e:
+            problems.append(f"{oid}: unreadable ({e})")
+    batch = _BatchBases([chain for _, _, chain in chains])
+    for obj_offs, oid, chain in chains:
+        try:
+            obj_type, obj_data = pack._get_object(oid, obj_offs, batch)
+            obj_hash = hashlib.sha1(
+                b"%s %d\x00" % (_TYPE_NAMES[obj_type].encode(), len(obj_data))
+            )
+        except _PACK_READ_ERRORS as e:
+            problems.append(f"{oid}: unreadable ({e})")
+            continue
+        finally:
+            batch.done(chain)
+        obj_hash.update(obj_data)
+        if obj_hash.hexdigest() != oid:
+            problems.append(f"{oid}: SHA-1 mismatch")
+    return problems
+
+
+def _read_chunks(data, name, table_offs, n_chunks, error):
+    """Read the table of contents of a chunked file (a commit-graph or a
+    multi-pack-index) and check every chunk lies inside the file
+
+    Returns:
+        {chunk ID: (offset, size)}
+
+    Raises:
+        error: the table or a chunk is out of bounds.
+    """
+    # Data ends where the checksum starts, and the table has an extra entry
+    # marking the end of the last chunk
+    end = len(data) - 20
+    if table_offs + (n_chunks + 1) * 12 > end:
+        raise error(f"{name}: truncated chunk table")
+    table = [
+        struct.unpack_from(">4sQ", data, table_offs + i * 12)
+        for i in range(n_chunks + 1)
+    ]
+    chunks = {}
+    for (chunk_id, offs), (_, next_offs) in zip(table, table[1:]):
+        if offs < table_offs + len(table) * 12 or next_offs < offs or next_offs > end:
+            raise error(f"{name}: chunk {chunk_id!r} out of bounds")
+        chunks[chunk_id] = offs, next_offs - offs
+    return chunks
+
+
+def _chunk(chunks, chunk_id, size, name, error):
+    """Offset of a chunk that must hold at least size bytes"""
+    if chunk_id not in chunks:
+        raise error(f"{name}: missing chunk {chunk_id!r}")
+    offs, chunk_size = chunks[chunk_id]
+    if chunk_size < size:
+        raise error(f"{name}: truncated chunk {chunk_id!r}")
+    return offs
+
+
+def _read_fanout(data, offs, name, error):
+    """Read a fan-out table, which must never decrease"""
+    fanout = struct.unpack_from(">256I", data, offs)
+    if any(a > b for a, b in zip(fanout, fanout[1:])):
+        raise error(f"{name}: bad fan-out table")
+    return fanout
+
+
+class MultiPackIndex:
+    """Reader for a multi-pack-index, which maps object IDs to the pack and
+    offset they are stored at for all packs it covers at once
+    """
+
+    def __init__(self, path, mapping_pool=None):
+        self.path = pathlib.Path(path)
+        self._file = _PooledFile(self.path, mapping_pool)
+        data = self._data
+        name = self.path.name
+
+        # Check magic number, version, and object ID version (SHA-1)
+        if len(data) < 12 or data[:4] != b"MIDX":
+            raise PackError(f"{name}: not a multi-pack-index")
+        if data[4] != 1 or data[5] != 1:
+            raise PackError(f"{name}: unsupported version")
+        n_chunks = data[6]
+        # NOTE: incremental multi-pack-index chains are not supported
+        if data[7] != 0:
+            raise PackError(f"{name}: incremental multi-pack-index")
+        (n_packs,) = struct.unpack_from(">I", data, 8)
+
+        # Read chunk table, and check every chunk is large enough for what we
+        # read from it, so lookups never go past the end
+        chunks = _read_chunks(data, name, 12, n_chunks, PackError)
+
+        # Names of the covered packs (sorted, so their position is their ID)
+        names_offs = _chunk(chunks, b"PNAM", 0, name, PackError)
+        names = bytes(data[names_offs : names_offs + chunks[b"PNAM"][1]])
+        names = names.split(b"\x00")
+        if len(names) <= n_packs:
+            raise PackError(f"{name}: truncated pack names")
+        try:
+            self.pack_names = [pack_name.decode() for pack_name in names[:n_packs]]
+        except UnicodeDecodeError:
+            raise PackError(f"{name}: bad pack names")
+
+        # Read fan-out table
+        self.fanout = _read_fanout(
+            data, _chunk(chunks, b"OIDF", 1024, name, PackError), name, PackError
+        )
+        self.count = self.fanout[-1]
+        self._oids_base = _chunk(chunks, b"OIDL", self.count * 20, name, PackError)
+        self._off_base = _chunk(chunks, b"OOFF", self.count * 8, name, PackError)
+        self._bigoff_base, self._bigoff_count = None, 0
+        if b"LOFF" in chunks:
+            self._bigoff_base, size = chunks[b"LOFF"]
+            self._bigoff_count = size // 8
+
+    @property
+    def _data(self):
+        return self._file.data
+
+    @property
+    def _oids(self):
+        return _OidTable(self._data, self._oids_base, self.count)
+
+    def close(self):
+        """Unmap the multi-pack-index once nobody is reading from it"""
+        self._file.close()
+
+    def prefix_matches(self, prefix):
+        """Object IDs in the indexed packs starting with a hex prefix"""
+        return self._oids.prefix_matches(self.fanout, prefix)
+
+    def lookup(self, oid):
+        """Resolve an object ID into the ID of a pack and an offset into it"""
+        oid_bytes = binascii.unhexlify(oid)
+
+        first = oid_bytes[0]
+        left = self.fanout[first - 1] if first > 0 else 0
+        right = self.fanout[first]
+        data = self._data
+        oids = _OidTable(data, self._oids_base, self.count)
+        idx = bisect.bisect_left(oids, oid_bytes, left, right)
+        if idx == right or oids[idx] != oid_bytes:
+            return None
+
+        pack_id, off = struct.unpack_from(">II", data, self._off_base + idx * 8)
+        if pack_id >= len(self.pack_names):
+            raise PackError(f"{self.path.name}: bad pack ID for {oid}")
+        if off & 0x80000000:
+            # Offsets past 2GiB are stored in a separate 64-bit table
+            if (off & 0x7FFFFFFF) >= self._bigoff_count:
+                raise PackError(f"{self.path.name}: bad offset for {oid}")
+            (off,) = struct.unpack_from(
+                ">Q", data, self._bigoff_base + (off & 0x7FFFFFFF) * 8
+            )
+        return pack_id, off
+
+
+def _murmur3(seed, data, signed=False):
+    """32-bit murmur3 hash as used by changed-path Bloom filters
+
+    NOTE: version 1 of the filters was computed by a git that (by accident)
+    sign extended every byte with the top bit set, so we need to be able to
+    replicate that to query such filters correctly
+    """
+    c1 = 0xCC9E2D51
+    c2 = 0x1B873593
+    mask = 0xFFFFFFFF
+
+    if signed:
+        data = [b | 0xFFFFFF00 if b & 0x80 else b for b in data]
+
+    h = seed
+    n_blocks = len(data) // 4
+    for i in range(n_blocks):
+        k = (
+            data[i * 4]
+            | (data[i * 4 + 1] << 8)
+            | (data[i * 4 + 2] << 16)
+            | (data[i * 4 + 3] << 24)
+        ) & mask
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & mask
+        h = (h * 5 + 0xE6546B64) & mask
+
+    tail = n_blocks * 4
+    k = 0
+    remaining = len(data) & 3
+    if remaining == 3:
+        k ^= data[tail + 2] << 16
+    if remaining >= 2:
+        k ^= data[tail + 1] << 8
+    if remaining >= 1:
+        k ^= data[tail]
+        k &= mask
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85EBCA6B) & mask
+    h ^= h >> 13
+    h = (h * 0xC2B2AE35) & mask
+    h ^= h >> 16
+    return h
+
+
+class _CommitGraphFile:
+    """A single commit-graph file, either the only one or a layer of a split
+    commit-graph chain
+    """
+
+    def __init__(self, path, mapping_pool=None):
+        self.path = pathlib.Path(path)
+        self._file = _PooledFile(self.path, mapping_pool)
+        data = self._data
+        name = self.path.name
+
+        # Check magic number, version, and hash version (SHA-1)
+        if len(data) < 8 or data[:4] != b"CGPH":
+            raise CommitGraphError(f"{name}: not a commit-graph")
+        if data[4] != 1 or data[5] != 1:
+            raise CommitGraphError(f"{name}: unsupported version")
+        n_chunks = data[6]
+
+        # Read chunk table, and check every chunk we use is large enough for
+        # what we read from it, so reads never go past the end
+        error = CommitGraphError
+        chunks = _read_chunks(data, name, 8, n_chunks, error)
+        self.fanout = _read_fanout(
+            data, _chunk(chunks, b"OIDF", 1024, name, error), name, error
+        )
+        self.count = self.fanout[-1]
+        self.chunks = {
+            b"OIDF": chunks[b"OIDF"][0],
+            b"OIDL": _chunk(chunks, b"OIDL", self.count * 20, name, error),
+            b"CDAT": _chunk(chunks, b"CDAT", self.count * 36, name, error),
+        }
+        for chunk_id, size in ((b"EDGE", 0), (b"GDA2", self.count * 4), (b"GDO2", 0)):
+            if chunk_id in chunks:
+                self.chunks[chunk_id] = _chunk(chunks, chunk_id, size, name, error)
+
+        # Changed-path Bloom filters are optional
+        self.bloom_settings = None
+        if b"BIDX" in chunks and b"BDAT" in chunks:
+            self.chunks[b"BIDX"] = _chunk(chunks, b"BIDX", self.count * 4, name, error)
+            self.chunks[b"BDAT"] = _chunk(chunks, b"BDAT", 12, name, error)
+            # Hash version, number of hashes, and bits per entry
+            self.bloom_settings = struct.unpack_from(">III", data, self.chunks[b"BDAT"])
+
+    @property
+    def _data(self):
+        return self._file.data
+
+    @property
+    def oids(self):
+        return _OidTable(self._data, self.chunks[b"OIDL"], self.count)
+
+    def close(self):
+        """Unmap the file once nobody is reading from it"""
+        self._file.close()
+
+    def bloom_filter(self, idx):
+        """Get the changed-path Bloom filter of the commit at a position"""
+        data = self._data
+        bidx = self.chunks[b"BIDX"]
+        start = 0
+        if idx > 0:
+            (start,) = struct.unpack_from(">I", data, bidx + (idx - 1) * 4)
+        (end,) = struct.unpack_from(">I", data, bidx + idx * 4)
+        bdat = self.chunks[b"BDAT"] + 12
+        return data[bdat + start : bdat + end]
+
+    def find(self, oid_bytes):
+        """Find the position of a commit in this file"""
+        first = oid_bytes[0]
+        left = self.fanout[first - 1] if first > 0 else 0
+        right = self.fanout[first]
+        oids = self.oids
+        idx = bisect.bisect_left(oids, oid_bytes, left, right)
+        if idx == right or oids[idx] != oid_bytes:
+            return None
+        return idx
+
+
+class CommitGraph:
+    """Reader for the commit-graph, including split commit-graph chains
+
+    Positions of commits are global, the commits of the base layer come first
+    followed by each layer built on top of it.
+    """
+
+    # Parent entries
+    PARENT_NONE = 0x70000000
+    PARENT_EXTRA = 0x80000000
+
+    def __init__(self, paths):
+        self.layers = [_CommitGraphFile(path) for path in paths]
+        self._bases = []
+        count = 0
+        for layer in self.layers:
+            self._bases.append(count)
+            count += layer.count
+        self.count = count
+        # Corrected commit dates are only meaningful if every layer has them
+        self._v2 = all(b"GDA2" in layer.chunks for layer in self.layers)
+        # Bloom filters are queried with the settings of the newest layer,
+        # just like git does, older layers with other settings are ignored
+        self.bloom_settings = None
+        for layer in reversed(self.layers):
+            if layer.bloom_settings is not None:
+                self.bloom_settings = layer.bloom_settings
+                break
 
-        if obj_type == 1:
-            return Commit(oid, obj_data)
-        elif obj_type == 2:
-            return Tree(oid, obj_data)
-        elif obj_type == 3:
-            return Blob(oid, obj_data)
+    @classmethod
+    def load(cls, objects_path):
+        """Load the commit-graph of an object directory if there is one
 
+        Like git, a commit-graph that can't be read is ignored, commits are
+        then read from the objects instead.
+        """
+        info = pathlib.Path(objects_path) / "info"
+        chain_path = info / "commit-graphs" / "commit-graph-chain"
+        try:
+            if chain_path.is_file():
+                hashes = chain_path.read_text().split()
+                if len(hashes) == 0 or not all(_HEX_OID.fullmatch(h) for h in hashes):
+                    return None
+                return cls(info / "commit-graphs" / f"graph-{h}.graph" for h in hashes)
+            if (info / "commit-graph").is_file():
+                return cls([info / "commit-graph"])
+        except (CommitGraphError, OSError, UnicodeDecodeError):
+            return None
         return None
 
+    def close(self):
+        """Unmap the files of the commit-graph once nobody is reading them"""
+        for layer in self.layers:
+            layer.close()
+
+    def _locate(self, pos):
+        """Turn a global position into a layer and a position inside it"""
+        i = bisect.bisect_right(self._bases, pos) - 1
+        return self.layers[i], pos - self._bases[i]
+
+    def _oid_at(self, pos):
+        layer, idx = self._locate(pos)
+        return layer.oids[idx].hex()
+
+    def position(self, oid):
+        """Find the global position of a commit, None if it is missing"""
+        oid_bytes = binascii.unhexlify(oid)
+        # Search newer layers first, they are usually the smaller ones
+        for i in range(len(self.layers) - 1, -1, -1):
+            idx = self.layers[i].find(oid_bytes)
+            if idx is not None:
+                return self._bases[i] + idx
+        return None
+
+    def node_at(self, pos):
+        """Create the node of the commit at a global position"""
+        layer, idx = self._locate(pos)
+        data = layer._data
+        cdat = layer.chunks[b"CDAT"] + idx * 36
+        tree = data[cdat : cdat + 20].hex()
+        parent1, parent2, gen_hi, time_lo = struct.unpack_from(">IIII", data, cdat + 20)
+
+        parents = []
+        if parent1 != self.PARENT_NONE:
+            parents.append(self._oid_at(parent1))
+        if parent2 & self.PARENT_EXTRA:
+            # Octopus merge, the rest of the parents are in the edge list
+            edge = layer.chunks[b"EDGE"] + (parent2 & 0x7FFFFFFF) * 4
+            while True:
+                (parent,) = struct.unpack_from(">I", data, edge)
+                parents.append(self._oid_at(parent & 0x7FFFFFFF))
+                if parent & 0x80000000:
+                    break
+                edge += 4
+        elif parent2 != self.PARENT_NONE:
+            parents.append(self._oid_at(parent2))
+
+        # Commit time is 34 bits split across the two words, the topological
+        # level occupies the remaining 30 bits
+        timestamp = ((gen_hi & 0x3) << 32) | time_lo
+        generation = gen_hi >> 2
+        if self._v2:
+            # Corrected commit date, stored as an offset from the commit time
+            (gen_offs,) = struct.unpack_from(
+                ">I", data, layer.chunks[b"GDA2"] + idx * 4
+            )
+            if gen_offs & 0x80000000:
+                (gen_offs,) = struct.unpack_from(
+                    ">Q", data, layer.chunks[b"GDO2"] + (gen_offs & 0x7FFFFFFF) * 8
+                )
+            generation = timestamp + gen_offs
+
+        return CommitNode(layer.oids[idx].hex(), tree, parents, generation, timestamp)
+
+    def bloom_keys(self, path):
+        """Compute the Bloom filter keys for a path (and each directory leading
+        to it, as these are also recorded as changed), None if the commit-graph
+        has no changed-path Bloom filters
+        """
+        if self.bloom_settings is None:
+            return None
+        version, n_hashes, _ = self.bloom_settings
+        if version not in (1, 2):
+            return None
+
+        keys = []
+        path = path.encode() if isinstance(path, str) else path
+        while path:
+            hash0 = _murmur3(0x293AE76F, path, signed=version == 1)
+            hash1 = _murmur3(0x7E646E2C, path, signed=version == 1)
+            for i in range(n_hashes):
+                keys.append((hash0 + i * hash1) & 0xFFFFFFFF)
+            path = path.rpartition(b"/")[0]
+        return keys
+
+    def maybe_changed(self, oid, keys):
+        """Check if a commit might have changed a path compared to its first
+        parent, returns False only if the Bloom filter of the commit proves the
+        path to be unchanged
+
+        Args:
+            oid: commit to check.
+            keys: Bloom filter keys of the path from bloom_keys.
+        """
+        if keys is None:
+            return True
+        pos = self.position(oid)
+        if pos is None:
+            return True
+        layer, idx = self._locate(pos)
+        if layer.bloom_settings != self.bloom_settings:
+            return True
+
+        bloom = layer.bloom_filter(idx)
+        # Empty filters mean the filter was never computed
+        n_bits = len(bloom) * 8
+        if n_bits == 0:
+            return True
+        for key in keys:
+            bit = key % n_bits
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def get(self, oid):
+        """Lookup the node of a commit, None if it is not in the graph"""
+        pos = self.position(oid)
+        if pos is None:
+            return None
+        return self.node_at(pos)
+
+    def __contains__(self, oid):
+        return self.position(oid) is not None
+
+
+# Loose objects name their type in the header
+_LOOSE_TYPES = {b"commit": 1, b"tree": 2, b"blob": 3, b"tag": 4}
+_TYPE_NAMES = {num: name.decode() for name, num in _LOOSE_TYPES.items()}
+
+
+def _make_object(oid, obj_type, obj_data):
+    """Create the object corresponding to a type number used in packs"""
+    if obj_type == 1:
+        return Commit(oid, obj_data)
+    elif obj_type == 2:
+        return Tree(oid, obj_data)
+    elif obj_type == 3:
+        return Blob(oid, obj_data)
+
+    return None
+
+
+class _InflateStream(io.RawIOBase):
+    """Raw file object that incrementally inflates a zlib stream
+
+    Args:
+        read: function returning the next (at most) n bytes of compressed
+              data when called with n, and an empty result at the end.
+        file: file to close together with the stream.
+    """
+
+    CHUNK_SIZE = 64 << 10
+
+    def __init__(self, read, file=None):
+        self._read = read
+        self._file = file
+        self._inflater = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        super().close()
+
+    def readinto(self, buf):
+        while not self._inflater.eof:
+            chunk = self._inflater.unconsumed_tail
+            if not chunk:
+                chunk = self._read(self.CHUNK_SIZE)
+                assert len(chunk) > 0, "truncated zlib stream"
+            # Never inflate more than the caller asked for, the rest of the
+            # input is kept around as the unconsumed tail
+            data = self._inflater.decompress(chunk, len(buf))
+            if data:
+                buf[: len(data)] = data
+                return len(data)
+        return 0
+
+
+class BlobReader(io.BufferedReader):
+    """Read-only file object for the contents of a blob, size is the total
+    size of the blob
+    """
+
+    def __init__(self, raw, size, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        super().__init__(raw, buffer_size)
+        self.size = size
+
+
+class ObjectCache:
+    """Byte bounded LRU cache of parsed objects
+
+    Object IDs are content addresses, so a cached object can never go stale
+    and the cache needs no invalidation. Every object type gets a budget of
+    its own, so e.g. a few large blobs can't push out the trees and commits
+    that nearly every page needs.
+
+    The cache can be shared by many repositories, each object is cached on
+    behalf of an owner so that a repository being closed can take its
+    objects out of the cache.
+
+    Hits are counted per object type, misses only in total, as the type of
+    an object that isn't cached is unknown.
+    """
+
+    DEFAULT_LIMITS = {"commit": 8 << 20, "tree": 32 << 20, "blob": 32 << 20}
+
+    def __init__(self, limits=None):
+        self.limits = dict(self.DEFAULT_LIMITS if limits is None else limits)
+        self.size = dict.fromkeys(self.limits, 0)
+        self.hits = dict.fromkeys(self.limits, 0)
+        self.misses = 0
+        self.evictions = dict.fromkeys(self.limits, 0)
+        self._entries = {name: collections.OrderedDict() for name in self.limits}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _type_name(obj):
+        if isinstance(obj, Commit):
+            return "commit"
+        elif isinstance(obj, Tree):
+            return "tree"
+        elif isinstance(obj, Blob):
+            return "blob"
+        return None
+
+    @staticmethod
+    def _approx_size(obj):
+        # NOTE: this only counts the raw object, which dominates anything
+        # parsed out of it
+        if isinstance(obj, Blob):
+            return obj.size
+        elif isinstance(obj, Tree):
+            return len(obj._data)
+        elif obj._data is not None:
+            return len(obj._data)
+        # Commits read from the commit-graph only hold their tree and parents
+        return 40 * (2 + len(obj.parents))
+
+    def _evict(self, name):
+        entries = self._entries[name]
+        while self.size[name] > self.limits[name]:
+            _, (_, evicted) = entries.popitem(last=False)
+            self.size[name] -= evicted
+            self.evictions[name] += 1
+
+    def get(self, oid, owner=None):
+        """Lookup a cached object, None if it isn't cached"""
+        key = (owner, oid)
+        with self._lock:
+            for name, entries in self._entries.items():
+                entry = entries.get(key)
+                if entry is not None:
+                    obj, size = entry
+                    entries.move_to_end(key)
+                    self.hits[name] += 1
+                    # Commits read from the commit-graph grow once the rest
+                    # of the commit is read, account for it
+                    new_size = self._approx_size(obj)
+                    if new_size != size:
+                        entries[key] = obj, new_size
+                        self.size[name] += new_size - size
+                        self._evict(name)
+                    return obj
+            self.misses += 1
+        return None
+
+    def put(self, obj, owner=None):
+        """Remember an object that had to be read, evicting the least recently
+        used objects of its type if needed
+        """
+        name = self._type_name(obj)
+        if name not in self._entries:
+            return
+        size = self._approx_size(obj)
+        key = (owner, obj.oid)
+        with self._lock:
+            entries = self._entries[name]
+            # Caching something that would evict most other objects of its
+            # type is pointless
+            if size > self.limits[name] // 4 or key in entries:
+                return
+            entries[key] = obj, size
+            self.size[name] += size
+            self._evict(name)
+
+    def discard(self, owner):
+        """Forget every object cached on behalf of an owner"""
+        with self._lock:
+            for name, entries in self._entries.items():
+                for key in [key for key in entries if key[0] is owner]:
+                    _, size = entries.pop(key)
+                    self.size[name] -= size
+
+    def stats(self):
+        """Statistics for each object type, see misses for the misses"""
+        with self._lock:
+            return {
+                name: {
+                    "entries": len(self._entries[name]),
+                    "size": self.size[name],
+                    "limit": self.limits[name],
+                    "hits": self.hits[name],
+                    "evictions": self.evictions[name],
+                }
+                for name in self.limits
+            }
+
+    def __repr__(self):
+        return (
+            "ObjectCache("
+            + ", ".join(
+                f"{name}: {self.size[name]}/{self.limits[name]} bytes "
+                f"{self.hits[name]} hits {self.evictions[name]} evictions"
+                for name in self.limits
+            )
+            + f", {self.misses} misses)"
+        )
+
+
+class RefDatabase:
+    """All references of a repository, kept in memory
+
+    packed-refs is only parsed again once its mtime changes, and loose refs
+    are found by walking refs/ recursively, listing and reading again only
+    the directories whose mtime changed. git updates a ref by renaming a new
+    file over it, which is what changes the mtime of its directory. Anything
+    that changed too recently for its mtime to tell is read again every time.
+
+    Like loose objects, nothing is checked on disk again until invalidate is
+    called (done by Repository.refresh).
+    """
+
+    # Give up following symbolic refs after this many levels
+    MAX_SYMREF_DEPTH = 5
 
-class Repository:
     def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._loaded = None
+        # packed-refs as (mtime, refs, peeled tags, whether it was read racily)
+        self._packed = (None, {}, {}, False)
+        # Directory under refs/ -> (mtime, refs in it, subdirectories, whether
+        # it was listed racily)
+        self._dirs = {}
+        # Everything a lookup needs, replaced as a whole: (refs, sorted ref
+        # names, peeled tags, contents of HEAD)
+        self._state = ({}, [], {}, None)
+
+    def invalidate(self):
+        """Check the refs on disk again on the next lookup"""
+        self._generation += 1
+
+    def _read_packed(self):
+        path = self.path / "packed-refs"
+        mtime = _mtime(path)
+        if mtime == self._packed[0] and not self._packed[3]:
+            return self._packed
+        racy = _is_racy(mtime, time.time_ns())
+
+        refs = {}
+        peeled = {}
+        if mtime is not None:
+            name = None
+            for line in path.read_text().split("\n"):
+                # Skip empty lines and comments
+                if line == "" or line[0] == "#":
+                    continue
+                # Peel lines hold the object an annotated tag (the ref on
+                # the line above) points to
+                if line[0] == "^":
+                    peeled[name] = line[1:]
+                    continue
+                val, name = line.split(" ", 1)
+                refs[name] = val
+        self._packed = mtime, refs, peeled, racy
+        return self._packed
+
+    def _read_loose(self):
+        refs = {}
+        dirs = {}
+        pending = ["refs"]
+        while pending:
+            rel = pending.pop()
+            path = self.path / rel
+            mtime = _mtime(path)
+            if mtime is None:
+                continue
+            entry = self._dirs.get(rel)
+            if entry is None or entry[0] != mtime or entry[3]:
+                racy = _is_racy(mtime, time.time_ns())
+                # NOTE: refs can be deleted (e.g. by git pack-refs) while they
+                # are being listed, those are read from packed-refs instead
+                files = {}
+                subdirs = []
+                try:
+                    dirents = list(os.scandir(path))
+                except FileNotFoundError:
+                    continue
+                for dirent in dirents:
+                    name = rel + "/" + dirent.name
+                    if dirent.is_dir():
+                        subdirs.append(name)
+                    elif not dirent.name.endswith(".lock"):
+                        try:
+                            value = pathlib.Path(dirent.path).read_text()
+                        except FileNotFoundError:
+                            continue
+                        files[name] = value.strip()
+                entry = mtime, files, subdirs, racy
+            dirs[rel] = entry
+            refs.update(entry[1])
+            pending.extend(entry[2])
+        self._dirs = dirs
+        return refs
+
+    def _current(self):
+        if self._loaded == self._generation:
+            return self._state
+        with self._lock:
+            generation = self._generation
+            if self._loaded != generation:
+                # NOTE: git pack-refs writes packed-refs before deleting the
+                # loose refs, so reading them in this order never misses a ref
+                loose = self._read_loose()
+                _, packed, packed_peeled, _ = self._read_packed()
+                # NOTE: packed refs do *not* take precedence over loose ones
+                refs = dict(packed)
+                refs.update(loose)
+                peeled = {
+                    name: oid
+                    for name, oid in packed_peeled.items()
+                    if name not in loose
+                }
+                head = (self.path / "HEAD").read_text().strip()
+                self._state = refs, sorted(refs), peeled, head
+                self._loaded = generation
+            return self._state
+
+    def _follow(self, refs, val):
+        """Follow a symbolic ref to an object ID"""
+        for _ in range(self.MAX_SYMREF_DEPTH):
+            if not val.startswith("ref:"):
+                return val
+            val = refs.get(val[4:].strip())
+            if val is None:
+                return None
+        return None
+
+    @property
+    def head(self):
+        """Contents of HEAD, an object ID or a symbolic ref ("ref: <name>")"""
+        return self._current()[3]
+
+    def get(self, name):
+        """Find the object ID a ref (e.g. "refs/heads/master" or "HEAD")
+        points to, None if there is no such ref
+        """
+        refs, _, _, head = self._current()
+        if name == "HEAD":
+            return self._follow(refs, head)
+        val = refs.get(name)
+        if val is None:
+            return None
+        return self._follow(refs, val)
+
+    def peeled(self, name):
+        """Object an annotated tag points to, if packed-refs recorded it"""
+        return self._current()[2].get(name)
+
+    def list(self, prefix=""):
+        """Refs starting with prefix, as a dict from the rest of their name to
+        the object ID they point to
+        """
+        refs, names, _, _ = self._current()
+        result = {}
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            oid = self._follow(refs, refs[name])
+            if oid is not None:
+                result[name[len(prefix) :]] = oid
+        return result
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+class _PackSet:
+    """The packs of a repository (and its multi-pack-index) as they were on
+    disk at one point in time
+
+    Repositories swap in a new pack set as a whole when packs are added or
+    removed, so a lookup never mixes a multi-pack-index with the pack list of
+    another pack set.
+    """
+
+    def __init__(self, packdir, base_cache, compose_deltas, previous=None):
+        # Packs never change once their index exists, so the ones already
+        # open are kept instead of reading their index again
+        reuse = {}
+        if previous is not None:
+            reuse = {pack.idxpath: pack for pack in previous.packs}
+
+        self.packs = []
+        # Packs that can't be opened are left out, rather than making the
+        # whole repository unreadable, and kept for verify to report
+        self.broken = {}
+        for idxpath in packdir.glob("*.idx"):
+            pack = reuse.pop(idxpath, None)
+            pack_name = idxpath.name[:-4] + ".pack"
+            if pack is None:
+                try:
+                    pack = PackFile(
+                        idxpath, packdir / pack_name, base_cache, compose_deltas
+                    )
+                except (PackError, OSError) as e:
+                    # NOTE: running out of descriptors or memory is no fault
+                    # of the pack
+                    if isinstance(e, OSError) and e.errno in _RESOURCE_ERRNOS:
+                        raise
+                    self.broken[pack_name] = e
+                    continue
+            self.packs.append(pack)
+        # Whatever is left was removed (e.g. by a repack)
+        for pack in reuse.values():
+            pack.close()
+        if previous is not None and previous.midx is not None:
+            previous.midx.close()
+
+        # A multi-pack-index resolves objects in all the packs it covers with
+        # a single lookup, only packs created since it was written need to be
+        # searched one by one
+        self.midx = None
+        self.midx_packs = []
+        self.unindexed_packs = self.packs
+        midx_path = packdir / "multi-pack-index"
+        if midx_path.is_file():
+            try:
+                self.midx = MultiPackIndex(midx_path)
+            except (PackError, OSError) as e:
+                if isinstance(e, OSError) and e.errno in _RESOURCE_ERRNOS:
+                    raise
+                # Like a broken pack, it's left out and kept for verify to
+                # report, the index of every pack is searched instead
+                self.broken[midx_path.name] = e
+        if self.midx is not None:
+            packs_by_name = {pack.idxpath.name: pack for pack in self.packs}
+            self.midx_packs = [packs_by_name.get(n) for n in self.midx.pack_names]
+            self.unindexed_packs = [
+                pack for pack in self.packs if pack not in self.midx_packs
+            ]
+
+    def close(self):
+        """Unmap the packs and the multi-pack-index"""
+        for pack in self.packs:
+            pack.close()
+        if self.midx is not None:
+            self.midx.close()
+
+
+_HEX_OID = re.compile(r"[0-9a-f]{40}")
+_HEX_PREFIX = re.compile(r"[0-9a-f]{1,40}")
+
+
+class AmbiguousRevision(Exception):
+    """An abbreviated object ID matched more than one object"""
+
+    def __init__(self, revspec, candidates):
+        super().__init__(f"short object ID {revspec} is ambiguous")
+        self.revspec = revspec
+        self.candidates = candidates
+
+
+class _LooseObjectCache:
+    """Which loose objects exist, kept as one listing per fan-out directory
+
+    Like git's loose object cache, a fan-out directory is listed once instead
+    of stat'ing every object looked up in it. Listings are checked against the
+    mtime of their directory again after every call to invalidate (done by
+    Repository.refresh), so at most once per request in a shared repository.
+    Directories that changed too recently for their mtime to tell are listed
+    again every time.
+    """
+
+    def __init__(self, objects_path):
+        self.path = objects_path
+        self._generation = 0
+        # Fan-out directory -> (generation, mtime, names of objects in it,
+        # whether the listing is racy)
+        # NOTE: entries are only ever replaced as a whole, so racing lookups
+        # at worst list a directory twice
+        self._dirs = {}
+
+    def invalidate(self):
+        """Check directory mtimes again on the next lookups"""
+        self._generation += 1
+
+    def _listing(self, fanout):
+        entry = self._dirs.get(fanout)
+        if entry is not None and entry[0] == self._generation:
+            return entry[2]
+
+        path = self.path / fanout
+        mtime = _mtime(path)
+        if entry is not None and entry[1] == mtime and not entry[3]:
+            names = entry[2]
+            racy = False
+        else:
+            racy = _is_racy(mtime, time.time_ns())
+            if mtime is None:
+                names = frozenset()
+            else:
+                try:
+                    names = frozenset(os.listdir(path))
+                except FileNotFoundError:
+                    names = frozenset()
+        self._dirs[fanout] = self._generation, mtime, names, racy
+        return names
+
+    def prefix_matches(self, prefix):
+        """Loose object IDs starting with a hex prefix (of at least two
+        digits)
+        """
+        fanout, rest = prefix[:2], prefix[2:]
+        return [
+            fanout + name
+            for name in self._listing(fanout)
+            if name.startswith(rest) and _HEX_OID.fullmatch(fanout + name)
+        ]
+
+    def __contains__(self, oid):
+        if _HEX_OID.fullmatch(oid) is None:
+            return False
+        return oid[2:] in self._listing(oid[:2])
+
+
+def _mtime(path):
+    """Modification time of a path in nanoseconds, None if it doesn't exist"""
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+# NOTE: mtimes can be as coarse as 2 seconds (FAT), so a change in the same
+# tick as a read leaves the mtime as it was, the same race as git's racily
+# clean index entries
+_RACY_MTIME_NS = 2 * 10**9
+
+
+def _is_racy(mtime, read_at):
+    """Could the path have changed since it was read at read_at (as given by
+    time.time_ns) without its mtime changing, in which case what was read
+    can't be trusted for as long as the mtime stays the same
+    """
+    return mtime is not None and read_at - mtime < _RACY_MTIME_NS
+
+
+class Repository:
+    # Abbreviated object IDs need at least this many digits, same as git
+    MIN_ABBREV = 4
+    # Where a name is looked for in the refs, in order
+    REF_RULES = (
+        "{}",
+        "refs/{}",
+        "refs/tags/{}",
+        "refs/heads/{}",
+        "refs/remotes/{}",
+        "refs/remotes/{}/HEAD",
+    )
+
+    def __init__(
+        self,
+        path,
+        compose_deltas=False,
+        cache_limits=None,
+        packs_first=True,
+        object_cache=None,
+        base_cache=None,
+    ):
         # Save repo path
         self.path = pathlib.Path(path)
         # Check for non-bare repo
         if (self.path / ".git").is_dir():
             self.path = self.path / ".git"
-        # Read packs
-        self.packs = []
-        packdir = self.path / "objects" / "pack"
-        for idxpath in packdir.glob("*.idx"):
-            pack_name = idxpath.name[:-4] + ".pack"
-            self.packs.append(PackFile(idxpath, packdir / pack_name))
+        # All packs share a single delta base cache, which might be shared
+        # with other repositories too
+        self.base_cache = DeltaBaseCache() if base_cache is None else base_cache
+        # Parsed objects, see ObjectCache.DEFAULT_LIMITS for cache_limits
+        if object_cache is None:
+            object_cache = ObjectCache(cache_limits)
+        self.object_cache = object_cache
+        # What objects of this repository are cached on behalf of
+        self._cache_owner = object()
+        # Most objects of a repository are packed, so by default packs are
+        # searched before loose objects (like git does)
+        self.packs_first = packs_first
+        self._loose = _LooseObjectCache(self.path / "objects")
+        self.refs = RefDatabase(self.path)
+        self._compose_deltas = compose_deltas
+        self._pack_set = None
+        self.commit_graph = None
+        self._refresh_lock = threading.Lock()
+        self._stamps = (None, None)
+        self.refresh()
+
+    def _read_stamps(self):
+        objects = self.path / "objects"
+        pack_stamp = _mtime(objects / "pack")
+        # Split commit-graph chains are replaced by rewriting the chain file
+        graph_stamp = (
+            _mtime(objects / "info" / "commit-graph"),
+            _mtime(objects / "info" / "commit-graphs" / "commit-graph-chain"),
+            _mtime(self.path / "shallow"),
+            _mtime(self.path / "info" / "grafts"),
+        )
+        return pack_stamp, graph_stamp
+
+    def refresh(self):
+        """Pick up packs and commit-graphs written since the repository was
+        opened (e.g. by a push or gc), this only costs a few stats when
+        nothing has changed
+
+        Returns:
+            True if anything was reloaded.
+        """
+        with self._refresh_lock:
+            self._loose.invalidate()
+            self.refs.invalidate()
+            pack_stamp, graph_stamp = self._read_stamps()
+            old_pack_stamp, old_graph_stamp = self._stamps
+            if self._pack_set is not None and (pack_stamp, graph_stamp) == self._stamps:
+                return False
+
+            if self._pack_set is None or pack_stamp != old_pack_stamp:
+                self._pack_set = _PackSet(
+                    self.path / "objects" / "pack",
+                    self.base_cache,
+                    self._compose_deltas,
+                    self._pack_set,
+                )
+
+            if graph_stamp != old_graph_stamp:
+                # The commit-graph lets history walks skip reading commits
+                # NOTE: git ignores it in shallow clones and with grafts, as
+                # parents in the graph would be wrong, and so do we
+                commit_graph = None
+                if graph_stamp[2] is None and graph_stamp[3] is None:
+                    commit_graph = CommitGraph.load(self.path / "objects")
+                if self.commit_graph is not None:
+                    self.commit_graph.close()
+                self.commit_graph = commit_graph
+
+            self._stamps = pack_stamp, graph_stamp
+            return True
+
+    def close(self):
+        """Drop the mappings of the repository from the pool and take its
+        objects out of the caches
+        """
+        self._pack_set.close()
+        if self.commit_graph is not None:
+            self.commit_graph.close()
+        # NOTE: commits read from the commit-graph refer back to the
+        # repository, so the cache would otherwise keep it alive until the
+        # garbage collector finds the cycle
+        self.object_cache.discard(self._cache_owner)
+        self.base_cache.discard(self.packs)
+
+    @property
+    def packs(self):
+        return self._pack_set.packs
+
+    @property
+    def midx(self):
+        return self._pack_set.midx
 
     @property
     def config(self):
@@ -430,46 +2522,15 @@ class Repository:
         config.read(self.path / "config")
         return config
 
-    def _read_packed_refs(self, tgt_dict, want):
-        packed_refs_path = self.path / "packed-refs"
-
-        # Return if packed references file is empty
-        if not packed_refs_path.exists():
-            return
-
-        for line in packed_refs_path.read_text().split("\n"):
-            # Skip empty lines and comments, and peel lines (we don't care
-            # about tags for now)
-            if line == "" or line[0] == "#" or line[0] == "^":
-                continue
-
-            # Add packed reference if desired
-            val, key = line.split(" ", 1)
-            if key.startswith(want):
-                realkey = key[len(want) :]
-                # NOTE: packed refs do *not* take precedence over unpacked ones
-                if realkey not in tgt_dict:
-                    tgt_dict[realkey] = val
-
     @property
     def tags(self):
         """List of tags"""
-        tags = {
-            ref.name: ref.read_text().strip()
-            for ref in (self.path / "refs" / "tags").iterdir()
-        }
-        self._read_packed_refs(tags, "refs/tags/")
-        return tags
+        return self.refs.list("refs/tags/")
 
     @property
     def heads(self):
         """List of heads (aka branches)"""
-        heads = {
-            ref.name: ref.read_text().strip()
-            for ref in (self.path / "refs" / "heads").iterdir()
-        }
-        self._read_packed_refs(heads, "refs/heads/")
-        return heads
+        return self.refs.list("refs/heads/")
 
     @property
     def HEAD(self):
@@ -477,36 +2538,592 @@ class Repository:
 
         # Please note that this is a symbolic reference so it might contain
         # either an object ID, or a pointer to an actual reference
-        sym_ref = (self.path / "HEAD").read_text()
-
-        m = re.match(r"ref:\s*(\S*)", sym_ref)
-        if m is not None:
-            return m.group(1)
+        head = self.refs.head
+        if head.startswith("ref:"):
+            return head[4:].strip()
+        return head
+
+    def _find_packed(self, oid):
+        """Find the pack storing an object, returns the pack and the offset
+        of the object in it, or (None, None) if the object isn't packed
+        """
+        pack_set = self._pack_set
+        packs = pack_set.unindexed_packs
+        if pack_set.midx is not None:
+            try:
+                found = pack_set.midx.lookup(oid)
+            except PackError:
+                # A corrupt entry, the packs have their own indexes
+                found = None
+                packs = pack_set.packs
+            if found is not None:
+                pack_id, offs = found
+                pack = pack_set.midx_packs[pack_id]
+                if pack is not None:
+                    return pack, offs
+                # The multi-pack-index refers to a pack that is gone, so fall
+                # back to searching everything
+                packs = pack_set.packs
+
+        for pack in packs:
+            offs = pack._get_offset(oid)
+            if offs is not None:
+                return pack, offs
+        return None, None
+
+    def _find(self, oid):
+        """Find where an object is stored
+
+        Returns:
+            (path, None, None) for loose objects, (None, pack, offset) for
+            packed ones and (None, None, None) if the object doesn't exist
+        """
+        if self.packs_first:
+            pack, offs = self._find_packed(oid)
+            if pack is not None:
+                return None, pack, offs
+            if oid in self._loose:
+                return self.path / "objects" / oid[:2] / oid[2:], None, None
         else:
-            return sym_ref
+            if oid in self._loose:
+                return self.path / "objects" / oid[:2] / oid[2:], None, None
+            pack, offs = self._find_packed(oid)
+            if pack is not None:
+                return None, pack, offs
+        return None, None, None
+
+    def verify(self, executor, full=False):
+        """Start checking the integrity of every pack, see PackFile.verify
+
+        Returns:
+            Dict of pack names to PackVerification objects, packs (or a
+            multi-pack-index) that can't even be opened are reported as such.
+        """
+        verifications = {}
+        for pack_name, error in self._pack_set.broken.items():
+            verifications[pack_name] = PackVerification([], [f"unreadable ({error})"])
+        for pack in self.packs:
+            try:
+                verification = pack.verify(executor, full)
+            except _PACK_READ_ERRORS as e:
+                verification = PackVerification([], [f"unreadable ({e})"])
+            verifications[pack.packpath.name] = verification
+        return verifications
+
+    def get_many(self, oids):
+        """Read many objects at once
+
+        Packed objects are read grouped by pack, in the order they are stored
+        in, so the pack is read sequentially and delta bases shared by the
+        objects are only built once.
+
+        Args:
+            oids: object IDs to read.
+
+        Yields:
+            (oid, object) pairs as soon as each object is ready, in no
+            particular order, object is None for missing objects.
+        """
+        by_pack = collections.defaultdict(list)
+        graph = self.commit_graph
+        for oid in dict.fromkeys(oids):
+            obj = self.object_cache.get(oid, self._cache_owner)
+            if obj is not None:
+                yield oid, obj
+                continue
+            # Commits in the commit-graph are read lazily anyway
+            if graph is not None and oid in graph:
+                yield oid, self[oid]
+                continue
+            obj_path, pack, offs = self._find(oid)
+            if pack is None:
+                # Loose and missing objects gain nothing from batching
+                yield oid, self[oid]
+            else:
+                by_pack[pack].append((offs, oid))
 
-    def __getitem__(self, oid):
-        """Lookup an object ID in the repository"""
+        for pack, items in by_pack.items():
+            for oid, obj_type, obj_data in pack._get_many(items):
+                obj = _make_object(oid, obj_type, obj_data)
+                if obj is not None:
+                    self.object_cache.put(obj, self._cache_owner)
+                yield oid, obj
+
+    def _prefix_matches(self, prefix):
+        pack_set = self._pack_set
+        matches = set()
+        if pack_set.midx is not None:
+            matches.update(pack_set.midx.prefix_matches(prefix))
+        for pack in pack_set.unindexed_packs:
+            matches.update(pack.prefix_matches(prefix))
+        matches.update(self._loose.prefix_matches(prefix))
+        return matches
+
+    def peel(self, oid):
+        """Follow annotated tags until reaching the object they point to"""
+        while True:
+            raw = self._read_raw(oid)
+            if raw is None or raw[0] != 4:
+                return oid
+            # Tags start with the "object" line
+            assert raw[1].startswith(b"object ")
+            oid = bytes(raw[1][7:47]).decode()
+
+    def resolve(self, revspec, peel=False):
+        """Find the object ID a revision refers to
+
+        The revision can be a full or abbreviated (at least MIN_ABBREV hex
+        digits) object ID, HEAD or a ref name. Refs are looked up the same
+        way git does it, e.g. "master" may be refs/tags/master or
+        refs/heads/master, and they win over object IDs they look like.
+
+        Args:
+            revspec: revision to resolve.
+            peel: follow annotated tags to the object they point to.
+
+        Returns:
+            Object ID, or None if nothing matches the revision.
+
+        Raises:
+            AmbiguousRevision: the abbreviated object ID matches several
+                objects.
+        """
+        if _HEX_OID.fullmatch(revspec.lower()):
+            oid = revspec.lower()
+            return self.peel(oid) if peel else oid
+
+        for rule in self.REF_RULES:
+            name = rule.format(revspec)
+            oid = self.refs.get(name)
+            if oid is not None:
+                if peel:
+                    # packed-refs already remembers where most tags point
+                    return self.refs.peeled(name) or self.peel(oid)
+                return oid
+
+        prefix = revspec.lower()
+        if len(prefix) < self.MIN_ABBREV or _HEX_PREFIX.fullmatch(prefix) is None:
+            return None
+        matches = self._prefix_matches(prefix)
+        if len(matches) > 1:
+            raise AmbiguousRevision(revspec, sorted(matches))
+        elif len(matches) == 0:
+            return None
+        oid = matches.pop()
+        return self.peel(oid) if peel else oid
 
-        # Expected location on disk
-        obj_path = self.path / "objects" / oid[:2] / oid[2:]
+    def _read_raw(self, oid):
+        """Read the type and data of an object"""
+        obj_path, pack, offs = self._find(oid)
+        if obj_path is not None:
+            obj_hdr, obj_data = zlib.decompress(obj_path.read_bytes()).split(b"\x00", 1)
+            obj_type, obj_size = obj_hdr.split(b" ")
+            return _LOOSE_TYPES.get(obj_type), obj_data
+        if pack is None:
+            return None
+        return pack._get_object(oid, offs)
+
+    def object_info(self, oid):
+        """Find the type and size of an object without reading all of it
+
+        Returns:
+            (type, size) where type is one of "commit", "tree", "blob" or
+            "tag", or None if the object doesn't exist
+        """
+        obj_path, pack, offs = self._find(oid)
+        if obj_path is not None:
+            # Only inflate enough of the loose object to see its header
+            inflater = zlib.decompressobj()
+            head = b""
+            with obj_path.open("rb") as obj_file:
+                while b"\x00" not in head and not inflater.eof:
+                    chunk = inflater.unconsumed_tail or obj_file.read(64)
+                    assert len(chunk) > 0, "truncated object"
+                    head += inflater.decompress(chunk, 64)
+            obj_type, obj_size = head.split(b"\x00", 1)[0].split(b" ")
+            return obj_type.decode(), int(obj_size)
+
+        if pack is None:
+            return None
+        obj_type, obj_size = pack._get_info(offs)
+        return _TYPE_NAMES.get(obj_type), obj_size
+
+    def open_blob(self, oid):
+        """Open a blob for reading as a file object, the blob is inflated
+        incrementally as it is read, so memory use is independent of its size
+
+        Returns:
+            BlobReader, or None if there is no blob with this object ID
+        """
+        obj_path, pack, offs = self._find(oid)
+        if obj_path is not None:
+            obj_file = obj_path.open("rb")
+            stream = _InflateStream(obj_file.read, obj_file)
+            # Skip the header, it is only a few bytes, so read it bytewise
+            head = b""
+            while not head.endswith(b"\x00"):
+                byte = stream.read(1)
+                assert len(byte) > 0, "truncated object"
+                head += byte
+            obj_type, obj_size = head[:-1].split(b" ")
+            if obj_type != b"blob":
+                stream.close()
+                return None
+            return BlobReader(stream, int(obj_size))
 
-        if not obj_path.is_file():
-            # Look for object in packs
-            for pack in self.packs:
-                obj = pack[oid]
-                if obj is not None:
-                    return obj
+        if pack is None:
+            return None
+        opened = pack._open_stream(offs)
+        if opened is not None:
+            stream, obj_type, obj_size = opened
+            if obj_type != 3:
+                return None
+            return BlobReader(stream, obj_size)
+
+        # Deltas need their base, so they have to be built in memory
+        obj_type, obj_data = pack._get_object(oid, offs)
+        if obj_type != 3:
+            return None
+        return BlobReader(io.BytesIO(obj_data), len(obj_data))
+
+    def blob_head(self, oid, size):
+        """Read the first size bytes of a blob, without building all of it
+        even when it is stored as a delta
+
+        Returns:
+            bytes, or None if there is no blob with this object ID
+        """
+        obj = self.object_cache.get(oid, self._cache_owner)
+        if obj is not None:
+            return bytes(obj.data[:size]) if isinstance(obj, Blob) else None
+
+        obj_path, pack, offs = self._find(oid)
+        if pack is None:
+            blob = self.open_blob(oid)
+            if blob is None:
+                return None
+            with blob:
+                return blob.read(size)
+        obj_type, obj_data = pack._get_head(offs, size)
+        return bytes(obj_data) if obj_type == 3 else None
+
+    def commit_node(self, oid):
+        """Get the commit-graph node of a commit
+
+        Commits missing from the commit-graph are read and turned into a node
+        with an infinite generation number, just like git does.
+        """
+        if self.commit_graph is not None:
+            node = self.commit_graph.get(oid)
+            if node is not None:
+                return node
+        commit = self[oid]
+        if not isinstance(commit, Commit):
+            return None
+        return CommitNode(
+            oid, commit.tree, commit.parents, GENERATION_INFINITY, commit.commit_time
+        )
+
+    def last_change(self, oid, path):
+        """Find the most recent commit that changed a path, walking history
+        from a commit
+
+        History is simplified the same way git log does it: a commit is only a
+        change if the path differs from all of its parents, and otherwise we
+        follow one parent the path is the same in. Commits whose changed-path
+        Bloom filter rules the path out are passed without reading any trees.
+
+        Args:
+            oid: object ID of the commit to start from.
+            path: sequence of path components.
+
+        Returns:
+            Commit that last changed the path, or None.
+        """
+        path = tuple(path)
+        return self.last_changes(oid, [path])[path]
+
+    def last_changes(self, oid, paths):
+        """Find the most recent commit that changed each of a set of paths,
+        walking history only once
+
+        Every path follows the same simplified history as in last_change, but
+        they are all carried down it together: commits are visited newest
+        first with the paths still looking for their change, a path is retired
+        as soon as its commit is found, and the walk stops once none are left.
+        Entries are looked up once per tree for all paths, so paths whose
+        directory is the same in a parent move on without being looked at.
+
+        Args:
+            oid: object ID of the commit to start from.
+            paths: iterable of sequences of path components.
+
+        Returns:
+            {path: Commit or None} with the paths as tuples.
+        """
+        result = {}
+        pending = set()
+        for path in paths:
+            path = tuple(path)
+            if len(path) == 0:
+                result[path] = self[oid]
+            else:
+                pending.add(path)
+        if len(pending) == 0:
+            return result
+
+        graph = self.commit_graph
+        keys = {}
+        if graph is not None:
+            keys = {path: graph.bloom_keys("/".join(path)) for path in pending}
+
+        # {tree: {path: (mode, oid) or None}}, dropped once the commit
+        # with the tree has been visited
+        entries = collections.defaultdict(dict)
+
+        def entry(tree_oid, path):
+            tree_entries = entries[tree_oid]
+            if path not in tree_entries:
+                if len(path) == 0:
+                    value = S_IFDIR, tree_oid
+                else:
+                    value = None
+                    parent = entry(tree_oid, path[:-1])
+                    if parent is not None and (parent[0] & S_IFMT) == S_IFDIR:
+                        tree = self[parent[1]]
+                        tree_entry = tree[path[-1]] if isinstance(tree, Tree) else None
+                        if tree_entry is not None:
+                            value = tree_entry.mode, tree_entry.oid
+                tree_entries[path] = value
+            return tree_entries[path]
+
+        def same(tree_oid, parent_tree_oid, path):
+            # a path can't differ if the directory it is in doesn't
+            if entry(tree_oid, path[:-1]) == entry(parent_tree_oid, path[:-1]):
+                return True
+            return entry(tree_oid, path) == entry(parent_tree_oid, path)
+
+        # Commits are visited children first (by generation number, then by
+        # commit time) so the paths from all children are visited together,
+        # with clock skew at worst a commit is visited twice
+        queue = []
+        waiting = {}
+
+        def push(commit_oid, commit_paths):
+            if commit_oid in waiting:
+                waiting[commit_oid] |= commit_paths
+                return
+            node = self.commit_node(commit_oid)
+            if node is None:
+                for path in commit_paths:
+                    result[path] = None
+                return
+            waiting[commit_oid] = set(commit_paths)
+            heapq.heappush(queue, (-node.generation, -node.timestamp, commit_oid, node))
+
+        push(oid, pending)
+        while len(queue) > 0:
+            _, _, commit_oid, node = heapq.heappop(queue)
+            commit_paths = waiting.pop(commit_oid)
+
+            moved = collections.defaultdict(set)
+            parent_nodes = [self.commit_node(parent) for parent in node.parents]
+            for path in commit_paths:
+                # Bloom filters are computed against the first parent
+                if (
+                    graph is not None
+                    and len(node.parents) > 0
+                    and not graph.maybe_changed(commit_oid, keys[path])
+                ):
+                    moved[node.parents[0]].add(path)
+                    continue
+                for parent_node in parent_nodes:
+                    if parent_node is not None and same(
+                        node.tree, parent_node.tree, path
+                    ):
+                        moved[parent_node.oid].add(path)
+                        break
+                else:
+                    # NOTE: a root commit changed everything it contains
+                    if len(node.parents) > 0 or entry(node.tree, path) is not None:
+                        result[path] = self[commit_oid]
+                    else:
+                        result[path] = None
+
+            entries.pop(node.tree, None)
+            for parent, parent_paths in moved.items():
+                push(parent, parent_paths)
+        return result
+
+    def _tree_entries(self, oid):
+        if oid is None:
+            return []
+        tree = self[oid]
+        if not isinstance(tree, Tree):
+            return []
+        return [(key, raw, tree, pos) for key, raw, pos in tree._raw_entries()]
+
+    def _diff_added(self, path, entry, status):
+        # Everything below an added (or deleted) directory changes with it
+        if entry.isdir():
+            if status == "A":
+                yield from self.diff_trees(None, entry.oid, path + "/")
+            else:
+                yield from self.diff_trees(entry.oid, None, path + "/")
+        elif status == "A":
+            yield TreeChange("A", path, None, entry.mode, None, entry.oid)
         else:
-            # Found object on disk
+            yield TreeChange("D", path, entry.mode, None, entry.oid, None)
+
+    def diff_trees(self, old_oid, new_oid, prefix=""):
+        """Find the files that differ between two trees
+
+        Both trees are walked side by side in git's sort order. Entries whose
+        raw bytes are the same (same name, mode and object ID) are skipped, so
+        unchanged subtrees are never even read and the cost depends on the
+        size of the change, not on the size of the trees.
+
+        Args:
+            old_oid: object ID of the old tree, None for an empty tree.
+            new_oid: object ID of the new tree, None for an empty tree.
+            prefix: path prepended to every changed path.
+
+        Yields:
+            TreeChange for every changed file, in path order.
+        """
+        old = self._tree_entries(old_oid)
+        new = self._tree_entries(new_oid)
+        i = j = 0
+        while i < len(old) or j < len(new):
+            # NOTE: a file and a directory with the same name have different
+            # sort keys, so they show up as a deletion and an addition
+            if j == len(new) or (i < len(old) and old[i][0] < new[j][0]):
+                _, _, tree, pos = old[i]
+                entry = tree._entry_at(pos)
+                yield from self._diff_added(prefix + entry.name, entry, "D")
+                i += 1
+                continue
+            if i == len(old) or new[j][0] < old[i][0]:
+                _, _, tree, pos = new[j]
+                entry = tree._entry_at(pos)
+                yield from self._diff_added(prefix + entry.name, entry, "A")
+                j += 1
+                continue
+
+            _, old_raw, old_tree, old_pos = old[i]
+            _, new_raw, new_tree, new_pos = new[j]
+            i += 1
+            j += 1
+            if old_raw == new_raw:
+                continue
+            old_entry = old_tree._entry_at(old_pos)
+            new_entry = new_tree._entry_at(new_pos)
+            path = prefix + new_entry.name
+            if old_entry.isdir():
+                yield from self.diff_trees(old_entry.oid, new_entry.oid, path + "/")
+                continue
+            if (old_entry.mode & S_IFMT) == (new_entry.mode & S_IFMT):
+                status = "M"
+            else:
+                status = "T"
+            yield TreeChange(
+                status,
+                path,
+                old_entry.mode,
+                new_entry.mode,
+                old_entry.oid,
+                new_entry.oid,
+            )
+
+    def __getitem__(self, oid):
+        """Lookup an object ID in the repository"""
+        obj = self.object_cache.get(oid, self._cache_owner)
+        if obj is None:
+            obj = self._lookup(oid)
+            if obj is not None:
+                self.object_cache.put(obj, self._cache_owner)
+        return obj
+
+    def _lookup(self, oid):
+        # Commits in the commit-graph are only read once something missing
+        # from the graph (e.g. the message) is actually used
+        graph = self.commit_graph
+        if graph is not None and len(oid) == 40:
+            node = graph.get(oid)
+            if node is not None:
+                return Commit.from_node(node, lambda: self._read_raw(oid)[1])
+
+        obj_path, pack, offs = self._find(oid)
+        if pack is not None:
+            return _make_object(oid, *pack._get_object(oid, offs))
+        elif obj_path is not None:
             obj_hdr, obj_data = zlib.decompress(obj_path.read_bytes()).split(b"\x00", 1)
             obj_type, obj_size = obj_hdr.split(b" ")
-
-            if obj_type == b"blob":
-                return Blob(oid, obj_data)
-            elif obj_type == b"tree":
-                return Tree(oid, obj_data)
-            elif obj_type == b"commit":
-                return Commit(oid, obj_data)
+            return _make_object(oid, _LOOSE_TYPES.get(obj_type), obj_data)
 
         return None
+
+
+class RepositoryRegistry:
+    """Long-lived repositories shared by everyone opening the same path
+
+    Opening a repository reads the index of every pack, so rather than doing
+    that on every request the same Repository is handed out each time, after
+    checking (with a few stats) whether it needs to pick up new packs.
+
+    Only the most recently used repositories are kept open. All of them share
+    the same object and delta base caches, and their files are all mapped
+    through the same PackMappingPool, so memory and file descriptors are
+    bounded in total however many repositories are open.
+    """
+
+    def __init__(self, limit=64, cache_limits=None):
+        self.limit = limit
+        self.object_cache = ObjectCache(cache_limits)
+        self.base_cache = DeltaBaseCache()
+        self._lock = threading.Lock()
+        self._repos = collections.OrderedDict()
+
+    def get(self, path):
+        """Get the repository at a path, opening it if needed"""
+        key = pathlib.Path(path).resolve()
+        evicted = []
+        with self._lock:
+            repo = self._repos.get(key)
+            opened = repo is None
+            if opened:
+                repo = Repository(
+                    key, object_cache=self.object_cache, base_cache=self.base_cache
+                )
+                self._repos[key] = repo
+                while len(self._repos) > self.limit:
+                    evicted.append(self._repos.popitem(last=False)[1])
+            else:
+                self._repos.move_to_end(key)
+        # NOTE: requests still using an evicted repository keep it (and the
+        # mappings they are reading from) alive until they are done
+        for old_repo in evicted:
+            old_repo.close()
+        if not opened:
+            repo.refresh()
+        return repo
+
+    def discard(self, path):
+        """Forget the repository at a path, e.g. once it has been removed"""
+        with self._lock:
+            repo = self._repos.pop(pathlib.Path(path).resolve(), None)
+        if repo is not None:
+            repo.close()
+
+
+_registry = RepositoryRegistry()
+
+
+def open_repository(path):
+    """Get the shared, long-lived repository at a path"""
+    return _registry.get(path)
+
+
+def close_repository(path):
+    """Drop the shared repository at a path, if it was ever opened"""
+    _registry.discard(path)
@@ -6,6 +6,9 @@ REPO_SIMPLE=$TEST_REPO_DIR/simple
 REPO_N_MERGE=$TEST_REPO_DIR/n_merge
 REPO_DIRS=$TEST_REPO_DIR/dirs
 REPO_FILES=$TEST_REPO_DIR/files
+REPO_PACKED=$TEST_REPO_DIR/packed
+REPO_CHANGES=$TEST_REPO_DIR/changes
+REPO_DEEP=$TEST_REPO_DIR/deep
 
 # create simple repository
 #   consists of no files
@@ -70,6 +73,8 @@ if [ ! -d $REPO_DIRS ]; then
     touch dir2/.keep
     git add .
     git commit -m "add dir2"
+    # exercise path-limited walks through changed-path Bloom filters
+    git commit-graph write --reachable --changed-paths
     popd
 fi
 
@@ -86,6 +91,92 @@ if [ ! -d $REPO_FILES ]; then
     popd
 fi
 
+# create packed repository
+#   objects are spread over two packs covered by a multi-pack-index, a pack
+#   written after it and loose objects, and refs are both packed and loose
+if [ ! -d $REPO_PACKED ]; then
+    git init $REPO_PACKED
+    pushd $REPO_PACKED
+    git checkout -b master
+    for i in {1..30}; do
+        # editing a file a line at a time makes for chains of deltas
+        [ $i == 1 ] && seq -f "line %g" 1 200 > file
+        sed -i "$((i * 7 % 200 + 1))s/.*/edit $i/" file
+        echo "#$i" > file$((i % 5))
+        git add .
+        git commit -m "commit #$i"
+        if [ $i == 10 ]; then
+            git repack -a -d --depth=50
+        elif [ $i == 20 ]; then
+            git repack -d --depth=50
+            git multi-pack-index write
+        elif [ $i == 25 ]; then
+            git repack -d
+        fi
+    done
+    git tag -a v1.0 -m "version 1.0" HEAD~20
+    git tag light HEAD~10
+    git branch feature/nested/deep HEAD~5
+    git pack-refs --all
+    # loose refs, one of them taking precedence over a packed one
+    git branch loose/only HEAD~2
+    git update-ref refs/heads/feature/nested/deep HEAD~3
+    popd
+fi
+
+# create changes repository
+#   the last commit has every kind of change a diff can show
+if [ ! -d $REPO_CHANGES ]; then
+    git init $REPO_CHANGES
+    pushd $REPO_CHANGES
+    git checkout -b master
+    mkdir dir other
+    for name in a b c d; do
+        seq -f "$name line %g" 0 99 > dir/$name
+    done
+    echo "file" > file
+    echo "x" > other/x
+    git add .
+    git commit -m "initial"
+    # an exact rename, a rename with edits, a copy, a mode change, a file
+    # replaced by a directory and a symlink
+    mkdir moved
+    mv dir/a moved/a
+    sed "s/^b line 50$/edited/" dir/b > dir/b2
+    git rm -q dir/b
+    cp dir/c dir/c_copy
+    echo "tail" >> dir/c
+    chmod 755 dir/d
+    git rm -q file
+    mkdir file
+    echo "inner" > file/inner
+    ln -s x other/link
+    # only newlines end lines, not form feeds or carriage returns
+    printf "a\fb\nc\r\n" > formfeed
+    git add -A
+    git commit -m "changes"
+    popd
+fi
+
+# create deep repository
+#   hundreds of versions of a file, packed into delta chains over a hundred
+#   objects deep
+if [ ! -d $REPO_DEEP ]; then
+    git init $REPO_DEEP
+    pushd $REPO_DEEP
+    seq -f "line %g" 1 300 > file
+    for i in {1..600}; do
+        sed -i "$((i * 7 % 300 + 1))s/.*/edit $i/" file
+        printf "commit refs/heads/master\ncommitter test <test@test> $((1000000000 + i)) +0000\ndata 0\n"
+        printf "M 100644 inline file\ndata $(wc -c < file)\n"
+        cat file
+        echo
+    done | git fast-import --quiet
+    git repack -a -d -f --depth=4095 --window=10
+    git reset -q --hard
+    popd
+fi
+
 if [[ "$OSTYPE" == "msys" ]]; then
     py manage.py test
 else
@@ -0,0 +1,177 @@
+"""Micro-benchmark for mpygit delta application.
+
+Builds multi-megabyte synthetic files, deltifies successive revisions of them
+the way git does for small line edits, then times the delta applicator against
+the previous implementation (which grew its result with `result += ...`).
+
+Run from the repository root with
+    $ python3 -m tests.bench_delta
+"""
+import random
+import time
+
+from mpygit import mpygit
+
+
+def encode_varint(num):
+    out = bytearray()
+    while True:
+        b = num & 0x7F
+        num >>= 7
+        if num:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return out
+
+
+def encode_copy(offs, size):
+    op = 0x80
+    args = bytearray()
+    for i in range(4):
+        if (offs >> (i * 8)) & 0xFF:
+            op |= 1 << i
+            args.append((offs >> (i * 8)) & 0xFF)
+    for i in range(3):
+        if (size >> (i * 8)) & 0xFF:
+            op |= 1 << (4 + i)
+            args.append((size >> (i * 8)) & 0xFF)
+    return bytes([op]) + args
+
+
+def make_delta(base, n_edits, rng):
+    """Replace n_edits random 32 byte regions of base, returns (result, delta)
+    """
+    cuts = sorted(rng.sample(range(0, len(base) - 32, 32), n_edits))
+    delta = encode_varint(len(base))
+    body = bytearray()
+    result = bytearray()
+    prev = 0
+    for cut in cuts:
+        # copy operands are limited to 24 bits of size
+        while prev < cut:
+            size = min(cut - prev, 0xFFFFFF)
+            body += encode_copy(prev, size)
+            result += base[prev : prev + size]
+            prev += size
+        insert = bytes(rng.randrange(32, 127) for _ in range(32))
+        body += bytes([len(insert)]) + insert
+        result += insert
+        prev = cut + 32
+    while prev < len(base):
+        size = min(len(base) - prev, 0xFFFFFF)
+        body += encode_copy(prev, size)
+        result += base[prev : prev + size]
+        prev += size
+    delta += encode_varint(len(result)) + body
+    return bytes(result), bytes(delta)
+
+
+def legacy_apply_delta(base_data, delta_data):
+    """Delta applicator mpygit used before the rewrite"""
+    idx = 0
+
+    def decode_varint():
+        nonlocal idx
+        num = 0
+        shift = 0
+        while True:
+            b = delta_data[idx]
+            idx += 1
+            num |= (b & 0x7F) << shift
+            shift += 7
+            if (b & 0x80) == 0:
+                break
+        return num
+
+    def decode_copy_delta(mask):
+        nonlocal idx
+        bit = 1
+        num = 0
+        shift = 0
+        while bit <= mask:
+            if (mask & bit) != 0:
+                num |= delta_data[idx] << shift
+                idx += 1
+            shift += 8
+            bit <<= 1
+        return num
+
+    decode_varint()
+    decode_varint()
+    result = b""
+    while idx < len(delta_data):
+        op = delta_data[idx]
+        idx += 1
+        if op & 0x80 != 0:
+            offs = decode_copy_delta(op & 0xF)
+            size = decode_copy_delta((op & 0x70) >> 4)
+            if size == 0:
+                size = 0x10000
+            result += base_data[offs : offs + size]
+        else:
+            result += delta_data[idx : idx + op]
+            idx += op
+    return result
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def random_bytes(size, rng):
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+
+def bench_single(size, n_edits, rng):
+    base = random_bytes(size, rng)
+    expected, delta = make_delta(base, n_edits, rng)
+
+    legacy, out = timed(legacy_apply_delta, base, delta, repeat=1)
+    assert out == expected
+    new, out = timed(mpygit.apply_delta, base, delta)
+    assert out == expected
+    print(
+        f"apply  {size >> 20:3d} MiB {n_edits:5d} edits: "
+        f"legacy {legacy * 1000:9.1f} ms  new {new * 1000:7.1f} ms  "
+        f"({legacy / new:.0f}x)"
+    )
+
+
+def bench_chain(size, depth, n_edits, rng):
+    base = random_bytes(size, rng)
+    deltas = []
+    cur = base
+    for _ in range(depth):
+        cur, delta = make_delta(cur, n_edits, rng)
+        deltas.append(delta)
+
+    def sequential():
+        data = base
+        for delta in deltas:
+            data = mpygit.apply_delta(data, delta)
+        return data
+
+    seq, out = timed(sequential)
+    assert out == cur
+    comp, out = timed(mpygit.apply_delta_chain, base, deltas)
+    assert out == cur
+    print(
+        f"chain  {size >> 20:3d} MiB depth {depth:3d}:     "
+        f"sequential {seq * 1000:7.1f} ms  composed {comp * 1000:7.1f} ms  "
+        f"({seq / comp:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    for size, n_edits in ((1 << 20, 100), (4 << 20, 1000), (16 << 20, 2000)):
+        bench_single(size, n_edits, rng)
+    for size, depth in ((4 << 20, 10), (16 << 20, 50)):
+        bench_chain(size, depth, 50, rng)
@@ -0,0 +1,154 @@
+"""Micro-benchmark for the commit page's line diff.
+
+Edits realistic files (source code, a lockfile and generated code, the last
+two being mostly repeated lines) then times the Myers line diff against
+difflib's unified_diff, which the commit page used before. Both patches are
+applied back to the old file to check them, and their sizes are compared.
+
+Run from the repository root with
+    $ python3 -m tests.bench_diff
+"""
+import difflib
+import pathlib
+import random
+import time
+
+from mpygit import mpygit
+
+from mfgd_app import diff
+
+
+def source_file():
+    return pathlib.Path(mpygit.__file__).read_text()
+
+
+def lock_file(rng, n_packages=3000):
+    lines = []
+    for i in range(n_packages):
+        version = f"{rng.randrange(5)}.{rng.randrange(20)}.{rng.randrange(10)}"
+        lines += [
+            f'"node_modules/package-{i}": {{\n',
+            f'  "version": "{version}",\n',
+            '  "dev": true,\n',
+            '  "license": "MIT",\n',
+            "  \"dependencies\": {\n",
+            f'    "package-{rng.randrange(n_packages)}": "^{version}"\n',
+            "  }\n",
+            "},\n",
+        ]
+    return "".join(lines)
+
+
+def generated_file(rng, n_tables=400):
+    lines = []
+    for i in range(n_tables):
+        lines.append(f"static const uint8_t table_{i}[] = {{\n")
+        for _ in range(16):
+            lines.append("    " + ", ".join(f"0x{rng.randrange(4):02x}" for _ in range(8)) + ",\n")
+        lines.append("};\n\n")
+    return "".join(lines)
+
+
+def edit(text, n_edits, rng):
+    """Replace, insert and delete n_edits random lines"""
+    lines = text.splitlines(True)
+    for _ in range(n_edits):
+        pos = rng.randrange(len(lines))
+        op = rng.randrange(3)
+        if op == 0:
+            lines[pos] = f"edited line {rng.random()}\n"
+        elif op == 1:
+            lines.insert(pos, lines[rng.randrange(len(lines))])
+        else:
+            del lines[pos]
+    return "".join(lines)
+
+
+def apply_patch(old_lines, patch):
+    result = []
+    i = 0
+    for line in patch[2:]:
+        if line.startswith("@@"):
+            start, _, length = line.split()[1][1:].partition(",")
+            start = int(start) if length == "0" else int(start) - 1
+            result += old_lines[i:start]
+            i = start
+        elif line[0] == "+":
+            result.append(line[1:])
+        else:
+            assert old_lines[i] == line[1:]
+            if line[0] == " ":
+                result.append(old_lines[i])
+            i += 1
+    return result + old_lines[i:]
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def changed_lines(patch):
+    return sum(1 for line in patch[2:] if line[0] in "+-")
+
+
+def bench(name, old, new):
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+
+    def run_difflib():
+        return list(difflib.unified_diff(old_lines, new_lines, "a", "b"))
+
+    def run_myers():
+        return diff.unified_diff(old_lines, new_lines, "a", "b", timeout=60)
+
+    legacy, legacy_patch = timed(run_difflib, repeat=1)
+    assert apply_patch(old_lines, legacy_patch) == new_lines
+    new_time, patch = timed(run_myers)
+    assert apply_patch(old_lines, patch) == new_lines
+    print(
+        f"{name:12s} {len(old_lines):6d} lines: "
+        f"difflib {legacy * 1000:8.1f} ms ({changed_lines(legacy_patch):5d} +/-)  "
+        f"myers {new_time * 1000:7.1f} ms ({changed_lines(patch):5d} +/-)  "
+        f"({legacy / new_time:.1f}x)"
+    )
+
+
+def bench_timeout(name, old, new):
+    """A diff that blows the budget, which difflib would have spent on"""
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+
+    def run_difflib():
+        return list(difflib.unified_diff(old_lines, new_lines, "a", "b"))
+
+    legacy, _ = timed(run_difflib, repeat=1)
+    start = time.perf_counter()
+    try:
+        diff.unified_diff(old_lines, new_lines, "a", "b")
+        outcome = "finished"
+    except diff.DiffTooLarge:
+        outcome = "gave up"
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:12s} {len(old_lines):6d} lines: "
+        f"difflib {legacy * 1000:8.1f} ms  myers {outcome} after {elapsed * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    source = source_file()
+    bench("source", source, edit(source, 20, rng))
+    bench("source", source, edit(source, 500, rng))
+    lock = lock_file(rng)
+    bench("lockfile", lock, edit(lock, 50, rng))
+    generated = generated_file(rng)
+    bench("generated", generated, edit(generated, 50, rng))
+    bench("generated", generated, edit(generated, 1000, rng))
+    bench_timeout("rewrite", generated_file(rng, 2000), generated_file(rng, 2000))
@@ -0,0 +1,48 @@
+import shutil
+import subprocess
+import tempfile
+
+
+def git(path, *args, **kwargs):
+    """Run git in a repository and return what it printed"""
+    return subprocess.run(
+        ["git", "-C", path, "-c", "user.name=test", "-c", "user.email=test@test",
+         *args],
+        check=True, capture_output=True, **kwargs
+    ).stdout
+
+
+def git_objects(path):
+    """Read every object of a repository with git cat-file
+
+    Returns:
+        {oid: (type, data)} for every object, packed or loose.
+    """
+    listing = git(path, "cat-file", "--batch-all-objects", "--batch-check").decode()
+    oids = [line.split()[0] for line in listing.splitlines()]
+    contents = git(path, "cat-file", "--batch", input="\n".join(oids).encode())
+    objects = {}
+    pos = 0
+    for oid in oids:
+        header_end = contents.index(b"\n", pos)
+        _, obj_type, size = contents[pos:header_end].decode().split()
+        data = contents[header_end + 1 : header_end + 1 + int(size)]
+        objects[oid] = obj_type, data
+        pos = header_end + 1 + int(size) + 1
+    return objects
+
+
+class RepoCopy:
+    """Scratch copy of a fixture repository, for tests that modify it"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        copy = f"{self._tmpdir.name}/repo"
+        shutil.copytree(self.path, copy, symlinks=True)
+        return copy
+
+    def __exit__(self, *exc_info):
+        self._tmpdir.cleanup()
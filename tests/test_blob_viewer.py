@@ -1,3 +1,4 @@
+import pathlib
 import re
 
 from mpygit import mpygit, gitutil
@@ -6,6 +7,9 @@ from django.test import TestCase, Client
 
 from mfgd_app.models import Repository
 from mfgd_app.utils import resolve_path
+from mfgd_app.views import MAX_BLOB_SIZE
+
+from tests.helpers import git, RepoCopy
 
 class BlobViewerTestCase(TestCase):
     def setUp(self):
@@ -100,3 +104,55 @@ class BlobViewerTestCase(TestCase):
             r"""\s*</div>"""
         )
         self.assertTrue(re.search(HEXDUMP_REGEX, content))
+
+    def test_raw_download(self):
+        ENDPOINT = "/files/raw/master/small_binary_file"
+        response = self.client.get(ENDPOINT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+
+        files = mpygit.Repository(Repository.objects.get(name="files").path)
+        commit = [c for c in gitutil.walk(files, files.HEAD, 2)][-2]
+        fs_blob = resolve_path(files, commit.tree, "small_binary_file")
+
+        content = b"".join(response.streaming_content)
+        self.assertEqual(content, fs_blob.data)
+        self.assertEqual(int(response["Content-Length"]), len(fs_blob.data))
+
+    def test_sniffing(self):
+        SNIFF = mpygit.BINARY_SNIFF_SIZE
+        files = {
+            # only the start of a blob is checked for NUL bytes, like git
+            "early_nul": (b"a" * (SNIFF - 1) + b"\x00", True),
+            "late_nul": (b"a" * SNIFF + b"\x00", False),
+            "large_late_nul": (b"a\n" * MAX_BLOB_SIZE + b"\x00", False),
+            "large_early_nul": (b"\x00" + b"a" * MAX_BLOB_SIZE, True),
+            "latin1": ("caf\xe9\n".encode("iso-8859-1"), False),
+            "truncated_utf8": ("\u2615".encode()[:2], False),
+        }
+        with RepoCopy("tests/repo/files") as path:
+            for name, (data, _) in files.items():
+                pathlib.Path(path, name).write_bytes(data)
+            git(path, "add", *files)
+            git(path, "commit", "-m", "sniffing")
+            Repository.objects.create(name="sniffing", path=path, isPublic=True)
+
+            repo = mpygit.Repository(path)
+            tree = repo[repo[repo.resolve("HEAD")].tree]
+            listing = self.client.get("/sniffing/view/master/")
+            listed = {entry.name: entry.is_binary for entry in listing.context["entries"]}
+            for name, (data, is_binary) in files.items():
+                with self.subTest(name=name):
+                    blob = repo[tree[name].oid]
+                    self.assertEqual(blob.is_binary, is_binary)
+                    self.assertEqual(listed[name], is_binary)
+                    response = self.client.get(f"/sniffing/view/master/{name}")
+                    self.assertEqual(response.status_code, 200)
+                    template = "blob_binary.html" if is_binary else "blob.html"
+                    self.assertIn(template, [t.name for t in response.templates])
+
+            # bytes that aren't UTF-8 are replaced rather than failing
+            self.assertEqual(repo[tree["latin1"].oid].text, "caf\ufffd\n")
+            self.assertEqual(repo[tree["truncated_utf8"].oid].text, "\ufffd")
+            content = self._get_content("/sniffing/view/master/latin1")
+            self.assertIn("caf\ufffd", content)
@@ -0,0 +1,84 @@
+from mpygit import mpygit
+
+from django.test import SimpleTestCase
+
+
+def blob(i, size=200):
+    return mpygit.Blob(f"{i:040x}", b"x" * size)
+
+
+class ObjectCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = mpygit.ObjectCache({"commit": 1000, "tree": 1000, "blob": 1000})
+
+    def test_budgets(self):
+        tree = mpygit.Tree("t" * 40, b"100644 file\x00" + b"\x00" * 20)
+        self.cache.put(tree)
+        for i in range(10):
+            self.cache.put(blob(i))
+        stats = self.cache.stats()
+        # blobs only ever push out other blobs
+        self.assertEqual(stats["blob"]["entries"], 5)
+        self.assertEqual(stats["blob"]["size"], 1000)
+        self.assertEqual(stats["blob"]["evictions"], 5)
+        self.assertIs(self.cache.get(tree.oid), tree)
+        self.assertEqual(stats["tree"]["evictions"], 0)
+
+        # objects taking over a quarter of the budget aren't cached at all
+        large = blob(10, size=251)
+        self.cache.put(large)
+        self.assertIsNone(self.cache.get(large.oid))
+        self.assertEqual(self.cache.stats()["blob"]["evictions"], 5)
+
+    def test_lru(self):
+        blobs = [blob(i) for i in range(6)]
+        for obj in blobs[:5]:
+            self.cache.put(obj)
+        # using the oldest blob makes the next oldest the one to go
+        self.assertIs(self.cache.get(blobs[0].oid), blobs[0])
+        self.cache.put(blobs[5])
+        self.assertIsNone(self.cache.get(blobs[1].oid))
+        for obj in (blobs[0], *blobs[2:]):
+            self.assertIs(self.cache.get(obj.oid), obj)
+
+    def test_owners(self):
+        # repositories share the budget, but not each other's objects
+        first, second = object(), object()
+        for i in range(3):
+            self.cache.put(blob(i), first)
+        for i in range(3):
+            self.cache.put(blob(i), second)
+        self.assertEqual(self.cache.stats()["blob"]["entries"], 5)
+        self.assertIsNone(self.cache.get(blob(0).oid, first))
+        self.assertIsNotNone(self.cache.get(blob(0).oid, second))
+        self.assertIsNone(self.cache.get(blob(0).oid))
+
+        self.cache.discard(second)
+        stats = self.cache.stats()["blob"]
+        self.assertEqual((stats["entries"], stats["size"]), (2, 400))
+        self.assertIsNotNone(self.cache.get(blob(2).oid, first))
+
+    def test_stats(self):
+        tree = mpygit.Tree("t" * 40, b"")
+        self.assertIsNone(self.cache.get(tree.oid))
+        self.assertIsNone(self.cache.get(blob(0).oid))
+        self.cache.put(tree)
+        self.cache.put(blob(0))
+        self.assertIs(self.cache.get(tree.oid), tree)
+        self.assertIsNotNone(self.cache.get(blob(0).oid))
+        self.assertIsNotNone(self.cache.get(blob(0).oid))
+
+        # misses are counted on the failed lookups, not on what gets cached
+        self.assertEqual(self.cache.misses, 2)
+        stats = self.cache.stats()
+        self.assertEqual(stats["tree"]["hits"], 1)
+        self.assertEqual(stats["blob"]["hits"], 2)
+        self.assertEqual(stats["commit"]["hits"], 0)
+
+    def test_repository(self):
+        repo = mpygit.Repository("tests/repo/linear", object_cache=self.cache)
+        head = repo.resolve("HEAD")
+        commit = repo[head]
+        self.assertIs(repo[head], commit)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.stats()["commit"]["hits"], 1)
@@ -0,0 +1,108 @@
+from mpygit import mpygit
+
+from django.test import SimpleTestCase
+
+from tests.helpers import git, RepoCopy
+
+TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+def commit(*headers, body=None):
+    data = b"".join(header + b"\n" for header in (b"tree " + TREE.encode(), *headers))
+    if body is not None:
+        data += b"\n" + body
+    return mpygit.Commit("c" * 40, data)
+
+
+class CommitTestCase(SimpleTestCase):
+    def test_parents(self):
+        # merges of more than two parents, read from the commit-graph and not
+        with RepoCopy("tests/repo/n_merge") as path:
+            heads = git(path, "rev-list", "--max-count=3", "HEAD").decode().split()
+            parents = [arg for head in heads for arg in ("-p", head)]
+            octopus = git(path, "commit-tree", *parents, "-m", "octopus", "HEAD^{tree}")
+            git(path, "update-ref", "refs/heads/octopus", octopus.decode().strip())
+            listing = git(path, "rev-list", "--all", "--parents").decode().splitlines()
+            self.assertEqual(max(len(line.split()) for line in listing), 4)
+            for graph in (False, True):
+                if graph:
+                    git(path, "commit-graph", "write", "--reachable")
+                repo = mpygit.Repository(path)
+                self.assertEqual(repo.commit_graph is not None, graph)
+                for line in listing:
+                    oid, *parents = line.split()
+                    self.assertEqual(repo[oid].parents, parents)
+                    raw = git(path, "cat-file", "commit", oid)
+                    self.assertEqual(mpygit.Commit(oid, raw).parents, parents)
+
+        parents = [f"{i:040x}" for i in range(1, 4)]
+        obj = commit(*(b"parent " + parent.encode() for parent in parents),
+                     b"author A <a@example.com> 1 +0000",
+                     b"committer C <c@example.com> 2 +0000",
+                     body=b"merge\n")
+        self.assertEqual(obj.tree, TREE)
+        self.assertEqual(obj.parents, parents)
+        self.assertEqual(obj.commit_time, 2)
+
+    def test_stamps(self):
+        obj = commit(b"author A U Thor <author@example.com> 1600000000 -0530",
+                     b"committer Jane <Q> Doe <jane@example.com> 0 +1400",
+                     body=b"message\n")
+        author, committer = obj.author, obj.committer
+        self.assertEqual((author.name, author.email), ("A U Thor", "author@example.com"))
+        self.assertEqual((author.timestamp, author.tz), (1600000000, "-0530"))
+        # only the last "<" starts the email
+        self.assertEqual((committer.name, committer.email), ("Jane <Q> Doe", "jane@example.com"))
+        self.assertEqual((committer.timestamp, committer.tz), (0, "+1400"))
+        self.assertEqual(obj.commit_time, 0)
+
+        obj = commit(b"author  <> 5 +0100", b"committer C <c@example.com> 5 +0100")
+        self.assertEqual((obj.author.name, obj.author.email), ("", ""))
+
+    def test_encoding(self):
+        # the encoding header says how names and message are encoded
+        obj = commit(b"author Ren\xe9 <rene@example.com> 1 +0100",
+                     b"committer Ren\xe9 <rene@example.com> 1 +0100",
+                     b"encoding ISO-8859-1",
+                     body=b"caf\xe9\n")
+        self.assertEqual(obj.author.name, "Ren\xe9")
+        self.assertEqual(obj.committer.name, "Ren\xe9")
+        self.assertEqual(obj.message, "caf\xe9")
+
+        # without one (or with one that's unknown), anything that isn't UTF-8
+        # is replaced instead of failing
+        for headers in ((), (b"encoding no-such-encoding",)):
+            obj = commit(b"author Ren\xe9 <rene@example.com> 1 +0100",
+                         b"committer J\xc3\xb6rg <jorg@example.com> 1 +0100",
+                         *headers, body=b"caf\xe9 \xe2\x98\x95\n")
+            self.assertEqual(obj.author.name, "Ren�")
+            self.assertEqual(obj.committer.name, "J\xf6rg")
+            self.assertEqual(obj.message, "caf� ☕")
+
+        # and the same for commits written by git
+        with RepoCopy("tests/repo/linear") as path:
+            message = "caf\xe9\n".encode("iso-8859-1")
+            oid = git(path, "-c", "i18n.commitEncoding=ISO-8859-1",
+                      "commit-tree", TREE, input=message).decode().strip()
+            repo = mpygit.Repository(path)
+            self.assertEqual(repo[oid].message, "caf\xe9")
+
+    def test_missing_body(self):
+        headers = (b"author A <a@example.com> 1 +0000",
+                   b"committer C <c@example.com> 2 +0000")
+        for body in (None, b"", b"\n"):
+            with self.subTest(body=body):
+                obj = commit(*headers, body=body)
+                self.assertEqual(obj.message, "")
+                self.assertEqual(obj.author.name, "A")
+                self.assertEqual(obj.committer.timestamp, 2)
+
+        # headers after the parents, like gpgsig, are skipped
+        obj = commit(b"author A <a@example.com> 1 +0000",
+                     b"committer C <c@example.com> 2 +0000",
+                     b"gpgsig -----BEGIN PGP SIGNATURE-----",
+                     b" ",
+                     b" -----END PGP SIGNATURE-----",
+                     body=b"signed\n")
+        self.assertEqual(obj.message, "signed")
+        self.assertEqual(obj.committer.name, "C")
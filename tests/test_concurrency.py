@@ -0,0 +1,146 @@
+import os
+import random
+import threading
+import unittest
+from unittest import mock
+
+from mpygit import mpygit
+
+from django.test import SimpleTestCase
+
+from tests.helpers import git, git_objects, RepoCopy
+
+REPO_PACKED = "tests/repo/packed"
+
+
+class ConcurrentReadTestCase(SimpleTestCase):
+    N_THREADS = 8
+    N_ROUNDS = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # packs full of deltas, plus some loose objects
+        cls.expected = git_objects(REPO_PACKED)
+        cls.oids = list(cls.expected)
+
+    def _open_repo(self):
+        # tiny caches and a single mapping force constant eviction
+        repo = mpygit.Repository(
+            REPO_PACKED, cache_limits={"commit": 4096, "tree": 4096, "blob": 4096}
+        )
+        repo.base_cache.limit = 4096
+        pool = mpygit.PackMappingPool(limit=1)
+        for pack in repo.packs:
+            pack.mapping_pool = pool
+        return repo
+
+    def _read(self, repo, oid):
+        obj_type, _ = self.expected[oid]
+        if obj_type == "blob":
+            with repo.open_blob(oid) as blob:
+                streamed = blob.read()
+            return repo[oid].data, streamed
+        elif obj_type == "tree":
+            return repo[oid]._data, None
+        elif obj_type == "commit":
+            return repo[oid].message, None
+        return None, None
+
+    def _check(self, repo, oid, result):
+        obj_type, data = self.expected[oid]
+        if obj_type == "blob":
+            self.assertEqual(bytes(result[0]), data)
+            self.assertEqual(result[1], data)
+        elif obj_type == "tree":
+            self.assertEqual(bytes(result[0]), data)
+        elif obj_type == "commit":
+            self.assertEqual(result[0], data.split(b"\n\n", 1)[1].decode()[:-1])
+
+    def _run_threads(self, work):
+        errors = []
+
+        def run(seed):
+            try:
+                work(random.Random(seed))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(self.N_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def test_concurrent_reads(self):
+        repo = self._open_repo()
+        self.assertEqual(len(repo.packs), 3)
+        results = []
+
+        def work(rng):
+            oids = list(self.oids)
+            for _ in range(self.N_ROUNDS):
+                rng.shuffle(oids)
+                results.extend((oid, self._read(repo, oid)) for oid in oids)
+
+        self._run_threads(work)
+        self.assertEqual(len(results), len(self.oids) * self.N_THREADS * self.N_ROUNDS)
+        for oid, result in results:
+            self._check(repo, oid, result)
+
+    def test_concurrent_batches(self):
+        repo = self._open_repo()
+        results = []
+
+        def work(rng):
+            for _ in range(self.N_ROUNDS):
+                oids = rng.sample(self.oids, len(self.oids) // 2)
+                results.extend(repo.get_many(oids))
+
+        self._run_threads(work)
+        for oid, obj in results:
+            obj_type, data = self.expected[oid]
+            if obj_type == "blob":
+                self.assertEqual(bytes(obj.data), data)
+
+
+@unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc/self/fd")
+class DescriptorTestCase(SimpleTestCase):
+    N_REPOS = 3
+    N_PACKS = 40
+    POOL_LIMIT = 16
+
+    def _open_fds(self):
+        return len(os.listdir("/proc/self/fd"))
+
+    def test_bounded(self):
+        objects = git_objects(REPO_PACKED)
+        oids = list(objects)[: self.N_PACKS]
+        copies = [RepoCopy(REPO_PACKED) for _ in range(self.N_REPOS)]
+        paths = [copy.__enter__() for copy in copies]
+        try:
+            # one more pack per object, on top of the multi-pack-index and the
+            # commit-graph every repository has
+            for path in paths:
+                for oid in oids:
+                    git(path, "pack-objects", "-q", ".git/objects/pack/pack",
+                        input=oid.encode())
+                git(path, "commit-graph", "write", "--reachable")
+
+            pool = mpygit.PackMappingPool(limit=self.POOL_LIMIT)
+            before = self._open_fds()
+            with mock.patch.object(mpygit, "_mapping_pool", pool):
+                registry = mpygit.RepositoryRegistry()
+                for path in paths:
+                    repo = registry.get(path)
+                    self.assertGreater(len(repo.packs), self.N_PACKS)
+                    self.assertIsNotNone(repo.commit_graph)
+                    for oid, (obj_type, data) in objects.items():
+                        self.assertEqual(repo.object_info(oid), (obj_type, len(data)))
+                    repo.last_change(repo.resolve("HEAD"), ("file",))
+                    self.assertLessEqual(self._open_fds() - before, self.POOL_LIMIT)
+        finally:
+            for copy in copies:
+                copy.__exit__(None, None, None)
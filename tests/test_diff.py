@@ -0,0 +1,157 @@
+import difflib
+from unittest import mock
+
+from mpygit import mpygit
+
+from django.test import SimpleTestCase
+
+from mfgd_app import diff
+
+from tests.helpers import git
+
+REPO_CHANGES = "tests/repo/changes"
+
+
+class DiffTestCase(SimpleTestCase):
+    def _git_changes(self, *args):
+        changes = []
+        for line in git(REPO_CHANGES, "-c", "core.quotepath=false", "diff-tree", "-r",
+                        *args, "HEAD~", "HEAD").decode().splitlines():
+            meta, *paths = line.split("\t")
+            changes.append((meta.split()[-1][0], paths[0], paths[-1]))
+        return changes
+
+    def test_diff_trees(self):
+        repo = mpygit.Repository(REPO_CHANGES)
+        commit = repo[repo.resolve("HEAD")]
+        parent = repo[commit.parents[0]]
+        changes = [
+            (change.status, change.old_path, change.path)
+            for change in repo.diff_trees(parent.tree, commit.tree)
+        ]
+        self.assertEqual(changes, self._git_changes("--no-renames"))
+
+    def test_renames(self):
+        repo = mpygit.Repository(REPO_CHANGES)
+        commit = repo[repo.resolve("HEAD")]
+        parent = repo[commit.parents[0]]
+        diffs = diff.diff_commits(repo, parent, commit)
+        changes = [
+            (file_diff.change.status, file_diff.change.old_path, file_diff.change.path)
+            for file_diff in diffs
+        ]
+        self.assertEqual(sorted(changes), sorted(self._git_changes("-M", "-C")))
+
+        patches = {file_diff.change.path: file_diff.patch for file_diff in diffs}
+        self.assertEqual(
+            patches["moved/a"],
+            "similarity index 100%\nrename from dir/a\nrename to moved/a\n",
+        )
+        self.assertIn("--- a/dir/b\n+++ b/dir/b2\n", patches["dir/b2"])
+        self.assertIn("-b line 50\n+edited\n", patches["dir/b2"])
+        self.assertIn("old mode 100644\nnew mode 100755\n", patches["dir/d"])
+
+    def test_line_counts(self):
+        repo = mpygit.Repository(REPO_CHANGES)
+        commit = repo[repo.resolve("HEAD")]
+        parent = repo[commit.parents[0]]
+        expected = {}
+        for line in git(REPO_CHANGES, "-c", "core.quotepath=false", "diff", "--numstat",
+                        "-M", "-C", "HEAD~", "HEAD").decode().splitlines():
+            insertions, deletions, path = line.split("\t")
+            # renames are shown as "dir/{b => b2}"
+            expected[path] = int(insertions), int(deletions)
+        self.assertEqual(expected["formfeed"], (2, 0))
+
+        patches = {}
+        for stat_only in (False, True):
+            diffs = diff.diff_commits(repo, parent, commit, stat_only=stat_only)
+            counts = {}
+            for file_diff in diffs:
+                change = file_diff.change
+                path = change.path
+                if change.old_path != path:
+                    old_dir, old_name = change.old_path.rsplit("/", 1)
+                    new_dir, new_name = path.rsplit("/", 1)
+                    if old_dir == new_dir:
+                        path = f"{old_dir}/{{{old_name} => {new_name}}}"
+                    else:
+                        path = f"{{{old_dir} => {new_dir}}}/{new_name}"
+                counts[path] = file_diff.insertions, file_diff.deletions
+                if stat_only:
+                    # the patch is only worked out when it's asked for
+                    self.assertIsNone(file_diff.hunks)
+                    self.assertEqual(file_diff.patch, patches[change.path])
+                else:
+                    patches[change.path] = file_diff.patch
+            self.assertEqual(counts, expected)
+
+    def test_rename_limit(self):
+        repo = mpygit.Repository(REPO_CHANGES)
+        commit = repo[repo.resolve("HEAD")]
+        parent = repo[commit.parents[0]]
+        # exact renames are still found without estimating similarity
+        changes = {
+            file_diff.change.path: file_diff.change.status
+            for file_diff in diff.diff_commits(repo, parent, commit, rename_limit=0)
+        }
+        self.assertEqual(changes["moved/a"], "R")
+        self.assertEqual(changes["dir/c_copy"], "C")
+        self.assertEqual(changes["dir/b2"], "A")
+
+    def test_rename_budget(self):
+        repo = mpygit.Repository(REPO_CHANGES)
+        commit = repo[repo.resolve("HEAD")]
+        parent = repo[commit.parents[0]]
+        changes = list(repo.diff_trees(parent.tree, commit.tree))
+        blobs = dict(repo.get_many(
+            oid for change in changes for oid in (change.old_oid, change.new_oid)
+            if oid is not None
+        ))
+        # once out of time only exact renames are kept
+        changes = {
+            change.path: change.status
+            for change in diff.detect_renames(changes, blobs, timeout=-1)
+        }
+        self.assertEqual(changes["moved/a"], "R")
+        self.assertEqual(changes["dir/b2"], "A")
+        self.assertEqual(changes["dir/b"], "D")
+
+        # and files too large to diff are never compared
+        with mock.patch.object(diff, "MAX_DIFF_SIZE", 100):
+            changes = {
+                change.path: change.status
+                for change in diff.detect_renames(
+                    list(repo.diff_trees(parent.tree, commit.tree)), blobs
+                )
+            }
+        self.assertEqual(changes["moved/a"], "R")
+        self.assertEqual(changes["dir/b2"], "A")
+
+    def test_unified_diff(self):
+        old = [f"line {i}\n" for i in range(20)] + ["no newline"]
+        new = list(old)
+        new[2] = "edited\n"
+        del new[10]
+        new.insert(15, "inserted\n")
+        new[-1] = "still no newline"
+        self.assertEqual(
+            "".join(diff.unified_diff(old, new, "a/file", "b/file")),
+            "".join(difflib.unified_diff(old, new, "a/file", "b/file"))
+                .replace("no newline", "no newline\n"),
+        )
+        self.assertEqual(diff.unified_diff(old, old, "a/file", "b/file"), [])
+
+    def test_minimal_diff(self):
+        # difflib only keeps 2 of these lines as it grows its longest match
+        old = ["b\n", "}\n", "b\n", "a\n"]
+        new = ["b\n", "a\n", "b\n", "a\n"]
+        blocks = diff.matching_blocks(old, new)
+        self.assertEqual(sum(size for _, _, size in blocks), 3)
+        self.assertEqual(blocks[-1], (len(old), len(new), 0))
+
+    def test_diff_budget(self):
+        old = [f"{i % 7}\n" for i in range(1000)]
+        new = [f"{i * 3 % 7}\n" for i in range(1000)]
+        with self.assertRaises(diff.DiffTooLarge):
+            diff.unified_diff(old, new, "a/file", "b/file", timeout=-1)
@@ -1,12 +1,17 @@
+import pathlib
 import re
 from datetime import datetime as dt
+from unittest import mock
 
 from mpygit import mpygit, gitutil
 
 from django.test import TestCase, Client
 
+from mfgd_app import utils, views
 from mfgd_app.models import Repository
 
+from tests.helpers import git, RepoCopy
+
 
 class InfoTestCase(TestCase):
     def setUp(self):
@@ -130,3 +135,31 @@ class InfoTestCase(TestCase):
 
         response = self.client.get(ENDPOINT)
         self.assertTrue(response.status_code, 404)
+
+    def test_large_commit(self):
+        with RepoCopy("tests/repo/linear") as path:
+            pathlib.Path(path, "big").write_text("".join(f"{i}\n" for i in range(50)))
+            pathlib.Path(path, "small").write_text("small\n")
+            git(path, "add", "big", "small")
+            git(path, "commit", "-m", "large")
+            oid = git(path, "rev-parse", "HEAD").decode().strip()
+            Repository.objects.create(name="large", path=path, isPublic=True)
+
+            # patches past the limit are only built once asked for
+            with mock.patch.object(views, "MAX_INLINE_DIFF_LINES", 10), \
+                 mock.patch.object(utils, "highlight_code",
+                                   wraps=utils.highlight_code) as highlight_code:
+                content = self.client.get(f"/large/info/{oid}").content.decode()
+                self.assertEqual(highlight_code.call_count, 1)
+                self.assertIn("+++ b/small", content)
+                self.assertNotIn("+++ b/big", content)
+                self.assertIn('<a class="button commit_load" href="?path=big#diff-1">Load diff</a>',
+                              content)
+                # the line counts of every file are still shown
+                self.assertIn("<td>++50</td>", content)
+
+                content = self.client.get(f"/large/info/{oid}?path=big").content.decode()
+                self.assertEqual(highlight_code.call_count, 3)
+                self.assertIn("+++ b/big", content)
+                self.assertIn("+++ b/small", content)
+                self.assertNotIn("Load diff", content)
@@ -0,0 +1,500 @@
+import errno
+import hashlib
+import io
+import os
+import pathlib
+import zlib
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from mpygit import mpygit
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase
+from mfgd_app.models import Repository
+
+from tests.helpers import git, git_objects, RepoCopy
+
+REPO_PACKED = "tests/repo/packed"
+REPO_DEEP = "tests/repo/deep"
+
+
+class MapFileTestCase(SimpleTestCase):
+    def test_fallbacks(self):
+        with RepoCopy(REPO_PACKED) as path:
+            empty = pathlib.Path(path, "empty")
+            empty.write_bytes(b"")
+            self.assertEqual(mpygit._map_file(empty), b"")
+
+            # files that can't be mapped at all are read instead
+            idx = next(pathlib.Path(path, ".git/objects/pack").glob("*.idx"))
+            error = OSError(errno.ENODEV, "no mmap here")
+            with mock.patch("mmap.mmap", side_effect=error):
+                self.assertEqual(mpygit._map_file(idx), idx.read_bytes())
+
+    def test_out_of_resources(self):
+        # but running out of descriptors isn't papered over by reading the
+        # whole file, and doesn't make a pack look broken either
+        error = OSError(errno.EMFILE, "too many open files")
+        with mock.patch("mmap.mmap", side_effect=error):
+            with self.assertRaises(OSError):
+                mpygit.Repository(REPO_PACKED)
+
+
+class DeltaBaseCacheTestCase(SimpleTestCase):
+    def test_eviction(self):
+        cache = mpygit.DeltaBaseCache(limit=100)
+        for offset in range(4):
+            cache.put("pack", offset, 3, b"x" * 30)
+        # the least recently used base made room for the last one
+        self.assertEqual(cache.size, 90)
+        self.assertIsNone(cache.get("pack", 0))
+        self.assertEqual(cache.get("pack", 1), (3, b"x" * 30))
+        cache.put("pack", 4, 3, b"y" * 30)
+        self.assertIsNone(cache.get("pack", 2))
+        self.assertIsNotNone(cache.get("pack", 1))
+
+        # bases larger than the whole cache are never cached
+        cache.put("pack", 5, 3, b"z" * 101)
+        self.assertIsNone(cache.get("pack", 5))
+        self.assertEqual(cache.size, 90)
+
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def test_discard(self):
+        cache = mpygit.DeltaBaseCache(limit=100)
+        cache.put("first", 0, 3, b"x" * 10)
+        cache.put("second", 0, 3, b"y" * 20)
+        cache.discard(["second"])
+        self.assertEqual(cache.size, 10)
+        self.assertIsNone(cache.get("second", 0))
+        self.assertIsNotNone(cache.get("first", 0))
+
+    def _resolve(self, pack, obj_offs, resolved):
+        """Build an object by recursing down its delta chain"""
+        if obj_offs not in resolved:
+            obj_type, obj_size, pos = pack._read_header(obj_offs)
+            if obj_type != 6 and obj_type != 7:
+                resolved[obj_offs] = obj_type, pack._inflate(pos, obj_size)[0]
+            else:
+                base_offs, pos = pack._read_delta_base(obj_type, obj_offs, pos)
+                base_type, base_data = self._resolve(pack, base_offs, resolved)
+                delta_data, _ = pack._inflate(pos, obj_size)
+                resolved[obj_offs] = base_type, mpygit.apply_delta(base_data, delta_data)
+        return resolved[obj_offs]
+
+    def test_deep_chains(self):
+        repo = mpygit.Repository(REPO_DEEP)
+        (pack,) = repo.packs
+        spans = pack._object_spans()
+        depth = max(len(pack._chain_offsets(offs)) for _, offs, _ in spans)
+        self.assertGreater(depth, 100)
+        expected = {}
+        for _, offs, _ in spans:
+            self._resolve(pack, offs, expected)
+
+        # however little of the chains fits in the cache, and with the
+        # deltas composed instead of applied one by one
+        for limit, compose_deltas in ((96 << 20, False), (4096, False),
+                                      (96 << 20, True)):
+            pack.base_cache = mpygit.DeltaBaseCache(limit)
+            pack.compose_deltas = compose_deltas
+            for idx, offs, _ in reversed(spans):
+                oid = pack._oids[idx].hex()
+                obj_type, obj_data = pack._get_object(oid, offs)
+                self.assertEqual((obj_type, bytes(obj_data)),
+                                 (expected[offs][0], bytes(expected[offs][1])))
+            if limit > 0 and not compose_deltas:
+                self.assertGreater(pack.base_cache.hits, 0)
+
+
+def _varint(num):
+    out = bytearray()
+    while True:
+        out.append(num & 0x7F | (0x80 if num > 0x7F else 0))
+        num >>= 7
+        if not num:
+            return bytes(out)
+
+
+def _make_delta(base_len, ops):
+    """Encode a delta, copies are (offset, size) tuples, inserts are bytes"""
+    result_len = sum(op[1] if type(op) is tuple else len(op) for op in ops)
+    delta = bytearray(_varint(base_len) + _varint(result_len))
+    for op in ops:
+        if type(op) is not tuple:
+            delta.append(len(op))
+            delta += op
+            continue
+        offs, size = op
+        operands = bytearray()
+        opcode = 0x80
+        for i in range(4):
+            if (offs >> (8 * i)) & 0xFF:
+                opcode |= 1 << i
+                operands.append((offs >> (8 * i)) & 0xFF)
+        if size != 0x10000:
+            for i in range(3):
+                if (size >> (8 * i)) & 0xFF:
+                    opcode |= 0x10 << i
+                    operands.append((size >> (8 * i)) & 0xFF)
+        delta.append(opcode)
+        delta += operands
+    return bytes(delta)
+
+
+class DeltaTestCase(SimpleTestCase):
+    def _check_chain(self, base, deltas):
+        expected = base
+        for delta in deltas:
+            expected = mpygit.apply_delta(expected, delta)
+        self.assertEqual(mpygit.apply_delta_chain(base, deltas), expected)
+        return bytes(expected)
+
+    def test_compose(self):
+        base = bytes(range(256)) * 4
+        # copies spanning several operations of the delta below, and
+        # ending right at the end of the intermediate object
+        first = _make_delta(1024, [(0, 10), b"inserted", (500, 100), (1000, 24)])
+        second = _make_delta(142, [(5, 20), b"new", (100, 42), (0, 142)])
+        result = self._check_chain(base, [first, second])
+        self.assertEqual(result[:5], base[5:10])
+        self.assertEqual(result[-24:], base[1000:])
+
+        # a copy of 0x10000 bytes is encoded without a size
+        big = bytes(range(251)) * 300
+        first = _make_delta(len(big), [(1, 0x10000), b"tail"])
+        second = _make_delta(0x10004, [(0x10000, 4), (0, 0x10000)])
+        result = self._check_chain(big, [first, second])
+        self.assertEqual(result[:4], b"tail")
+
+    def test_insert_only(self):
+        base = b"the base object"
+        first = _make_delta(len(base), [b"replaced ", b"entirely"])
+        second = _make_delta(17, [(9, 8), b" and ", (0, 8)])
+        self.assertEqual(self._check_chain(base, [first, second]),
+                         b"entirely and replaced")
+        # an insert-only delta on top throws away everything below it
+        third = _make_delta(21, [b"fresh"])
+        self.assertEqual(self._check_chain(base, [first, second, third]),
+                         b"fresh")
+        # and an empty result
+        empty = _make_delta(len(base), [])
+        self.assertEqual(self._check_chain(base, [empty]), b"")
+
+    def test_copy_past_end(self):
+        base = b"0123456789"
+        past_end = _make_delta(len(base), [(5, 6)])
+        with self.assertRaises(AssertionError):
+            mpygit.apply_delta(base, past_end)
+        with self.assertRaises(AssertionError):
+            mpygit.apply_delta_chain(base, [past_end])
+
+        # a copy past the end of the intermediate object
+        first = _make_delta(len(base), [(0, 4)])
+        second = _make_delta(4, [(2, 3)])
+        with self.assertRaises(AssertionError):
+            mpygit.apply_delta_chain(base, [first, second])
+
+    def test_pack_chains(self):
+        (pack,) = mpygit.Repository(REPO_DEEP).packs
+        spans = pack._object_spans()
+        obj_offs = max((offs for _, offs, _ in spans),
+                       key=lambda offs: len(pack._chain_offsets(offs)))
+        deltas = []
+        while True:
+            obj_type, obj_size, pos = pack._read_header(obj_offs)
+            if obj_type != 6 and obj_type != 7:
+                break
+            obj_offs, pos = pack._read_delta_base(obj_type, obj_offs, pos)
+            deltas.append(pack._inflate(pos, obj_size)[0])
+        base, _ = pack._inflate(pos, obj_size)
+        deltas.reverse()
+        for length in (1, 2, len(deltas) // 2, len(deltas)):
+            with self.subTest(length=length):
+                self._check_chain(base, deltas[:length])
+
+
+class MultiPackIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.repo = mpygit.Repository(REPO_PACKED)
+
+    def _show_index(self, pack):
+        """{oid: offset} of a pack, as listed by git"""
+        with open(pack.idxpath, "rb") as f:
+            listing = git(REPO_PACKED, "show-index", stdin=f).decode()
+        return {line.split()[1]: int(line.split()[0]) for line in listing.splitlines()}
+
+    def test_covered_packs(self):
+        midx = self.repo.midx
+        self.assertIsNotNone(midx)
+        # the pack written after the multi-pack-index is searched on its own
+        self.assertEqual(len(midx.pack_names), 2)
+        self.assertEqual(len(self.repo.packs), 3)
+        unindexed = self.repo._pack_set.unindexed_packs
+        self.assertEqual(len(unindexed), 1)
+        self.assertNotIn(unindexed[0].idxpath.name, midx.pack_names)
+        self.assertEqual(sorted(midx.pack_names), midx.pack_names)
+
+    def test_lookup(self):
+        midx = self.repo.midx
+        count = 0
+        for pack in self.repo.packs:
+            offsets = self._show_index(pack)
+            if pack.idxpath.name not in midx.pack_names:
+                for oid in offsets:
+                    self.assertIsNone(midx.lookup(oid))
+                continue
+            pack_id = midx.pack_names.index(pack.idxpath.name)
+            for oid, offset in offsets.items():
+                self.assertEqual(midx.lookup(oid), (pack_id, offset))
+            count += len(offsets)
+        self.assertEqual(midx.count, count)
+        self.assertIsNone(midx.lookup("0" * 40))
+
+    def test_prefix_matches(self):
+        midx = self.repo.midx
+        oid = midx._oids[midx.count // 2].hex()
+        self.assertIn(oid, midx.prefix_matches(oid[:4]))
+        self.assertEqual(midx.prefix_matches(oid), [oid])
+
+    def test_read_objects(self):
+        # packed objects, in or out of the multi-pack-index, and loose ones
+        expected = git_objects(REPO_PACKED)
+        for oid, (obj_type, data) in expected.items():
+            self.assertEqual(self.repo.object_info(oid), (obj_type, len(data)))
+            self.assertEqual(bytes(self.repo._read_raw(oid)[1]), data)
+
+    def test_blob_head(self):
+        expected = git_objects(REPO_PACKED)
+        for oid, (obj_type, data) in expected.items():
+            for size in (0, 10, 700, len(data) + 1):
+                head = self.repo.blob_head(oid, size)
+                self.assertEqual(head, data[:size] if obj_type == "blob" else None)
+        self.assertIsNone(self.repo.blob_head("0" * 40, 10))
+
+        # deltas are only applied as far as needed, down a long chain
+        oid = git(REPO_PACKED, "rev-parse", "HEAD~20:file").decode().strip()
+        with mock.patch.object(mpygit, "apply_delta") as apply_delta, \
+             mock.patch.object(mpygit, "_parse_delta",
+                               wraps=mpygit._parse_delta) as parse_delta:
+            self.assertEqual(self.repo.blob_head(oid, 10), expected[oid][1][:10])
+        apply_delta.assert_not_called()
+        self.assertGreater(parse_delta.call_count, 1)
+
+    def test_corrupt(self):
+        expected = git_objects(REPO_PACKED)
+        with RepoCopy(REPO_PACKED) as path:
+            midx_path = pathlib.Path(path, ".git/objects/pack/multi-pack-index")
+            data = midx_path.read_bytes()
+            for corrupt in (b"", data[:100], data[:-200], b"XIDX" + data[4:]):
+                midx_path.write_bytes(corrupt)
+                # the index of every pack is searched instead
+                repo = mpygit.Repository(path)
+                self.assertIsNone(repo.midx)
+                for oid, (obj_type, obj_data) in expected.items():
+                    self.assertEqual(repo.object_info(oid), (obj_type, len(obj_data)))
+                self.assertIn("multi-pack-index", repo._pack_set.broken)
+
+            # an entry pointing at a pack that doesn't exist
+            midx_path.write_bytes(data)
+            repo = mpygit.Repository(path)
+            midx = repo.midx
+            oid = midx._oids[0].hex()
+            ooff = bytearray(data)
+            ooff[midx._off_base : midx._off_base + 4] = b"\x00\x00\x01\x00"
+            midx_path.write_bytes(bytes(ooff))
+            repo = mpygit.Repository(path)
+            with self.assertRaises(mpygit.PackError):
+                repo.midx.lookup(oid)
+            obj_type, obj_data = expected[oid]
+            self.assertEqual(repo.object_info(oid), (obj_type, len(obj_data)))
+
+
+def _loose_blob(path, data):
+    """Write a blob as a loose object by hand, git won't write one for an
+    object that is already packed
+    """
+    raw = b"blob %d\x00" % len(data) + data
+    oid = hashlib.sha1(raw).hexdigest()
+    obj_path = pathlib.Path(path, ".git/objects", oid[:2], oid[2:])
+    obj_path.parent.mkdir(exist_ok=True)
+    obj_path.write_bytes(zlib.compress(raw))
+    return oid
+
+
+class LooseObjectTestCase(SimpleTestCase):
+    def test_new_objects(self):
+        with RepoCopy(REPO_PACKED) as path:
+            repo = mpygit.Repository(path)
+            oid = git(path, "hash-object", "--stdin", input=b"new object").decode().strip()
+            self.assertIsNone(repo[oid])
+            self.assertEqual(repo._prefix_matches(oid[:6]), set())
+
+            git(path, "hash-object", "-w", "--stdin", input=b"new object")
+            repo.refresh()
+            self.assertEqual(bytes(repo[oid].data), b"new object")
+            self.assertEqual(repo._prefix_matches(oid[:6]), {oid})
+
+    def test_coarse_mtimes(self):
+        with RepoCopy(REPO_PACKED) as path:
+            first = _loose_blob(path, b"first")
+            fanout = pathlib.Path(path, ".git/objects", first[:2])
+            # another object in the same fan-out directory
+            i = 0
+            while hashlib.sha1(b"blob %d\x00%d" % (len(str(i)), i)).hexdigest()[:2] != first[:2]:
+                i += 1
+            second_data = str(i).encode()
+
+            repo = mpygit.Repository(path)
+            mtime = fanout.stat().st_mtime_ns
+            self.assertIsNotNone(repo[first])
+            # written in the same tick of a coarse clock as the listing
+            second = _loose_blob(path, second_data)
+            os.utime(fanout, ns=(mtime, mtime))
+            repo.refresh()
+            self.assertEqual(bytes(repo[second].data), second_data)
+
+            # listings older than that are trusted until the mtime changes
+            os.remove(fanout / second[2:])
+            old = mtime - 10 ** 10
+            os.utime(fanout, ns=(old, old))
+            repo.refresh()
+            self.assertNotIn(second, repo._loose)
+            with mock.patch.object(mpygit.os, "listdir", wraps=os.listdir) as listdir:
+                for _ in range(3):
+                    repo.refresh()
+                    self.assertIn(first, repo._loose)
+            listdir.assert_not_called()
+
+    def test_lookup_order(self):
+        with RepoCopy(REPO_PACKED) as path:
+            packed = git(path, "rev-parse", "HEAD~20:file").decode().strip()
+            data = git(path, "cat-file", "blob", packed)
+            self.assertEqual(_loose_blob(path, data), packed)
+            loose = _loose_blob(path, b"only loose")
+            loose_path = pathlib.Path(path, ".git/objects", packed[:2], packed[2:])
+
+            # packs are searched first, so loose objects aren't even listed
+            repo = mpygit.Repository(path)
+            with mock.patch.object(mpygit.os, "listdir", wraps=os.listdir) as listdir:
+                obj_path, pack, offs = repo._find(packed)
+            listdir.assert_not_called()
+            self.assertIsNone(obj_path)
+            self.assertIsNotNone(pack)
+            self.assertEqual(repo._find(loose)[0].name, loose[2:])
+
+            repo = mpygit.Repository(path, packs_first=False)
+            self.assertEqual(repo._find(packed), (loose_path, None, None))
+            self.assertEqual(repo._find(loose)[0].name, loose[2:])
+
+            # either way both are read the same
+            for packs_first in (True, False):
+                repo = mpygit.Repository(path, packs_first=packs_first)
+                self.assertEqual(bytes(repo[packed].data), data)
+                self.assertEqual(bytes(repo[loose].data), b"only loose")
+
+
+class VerifyTestCase(TestCase):
+    def _verify(self, path, full=True):
+        repo = mpygit.Repository(path)
+        with ThreadPoolExecutor() as executor:
+            verifications = repo.verify(executor, full)
+            return {
+                pack_name: verification.problems()
+                for pack_name, verification in verifications.items()
+            }
+
+    def test_healthy(self):
+        problems = self._verify(REPO_PACKED)
+        self.assertEqual(len(problems), 3)
+        self.assertEqual(list(problems.values()), [[], [], []])
+
+    def test_corrupt_delta_base(self):
+        with RepoCopy(REPO_PACKED) as path:
+            # find the delta base with the most objects depending on it
+            bases = {}
+            offsets = {}
+            for pack_path in pathlib.Path(path, ".git/objects/pack").glob("*.pack"):
+                listing = git(path, "verify-pack", "-v", str(pack_path)).decode()
+                for line in listing.splitlines():
+                    fields = line.split()
+                    if len(fields) >= 5 and len(fields[0]) == 40:
+                        offsets[fields[0]] = pack_path, int(fields[4])
+                    if len(fields) == 7:
+                        bases.setdefault(fields[6], []).append(fields[0])
+            base = max(bases, key=lambda oid: len(bases[oid]))
+
+            # only the base and the objects whose delta chain goes through it
+            # are broken, however they are spread over the pack
+            broken = {base}
+            pending = [base]
+            while pending:
+                for oid in bases.get(pending.pop(), []):
+                    broken.add(oid)
+                    pending.append(oid)
+
+            # give the base an invalid type, so no delta chain through it can
+            # even be followed
+            pack_path, offset = offsets[base]
+            with open(pack_path, "r+b") as f:
+                f.seek(offset)
+                byte = f.read(1)[0]
+                f.seek(offset)
+                f.write(bytes([byte & 0x8f | 5 << 4]))
+
+            problems = self._verify(path)
+            self.assertIn("pack checksum mismatch", problems[pack_path.name])
+            reported = {
+                problem.split(":")[0]
+                for problem in problems[pack_path.name]
+                if problem != "pack checksum mismatch"
+            }
+            self.assertEqual(reported, broken)
+            for pack_name, pack_problems in problems.items():
+                if pack_name != pack_path.name:
+                    self.assertEqual(pack_problems, [])
+
+    def test_unreadable_packs(self):
+        with RepoCopy(REPO_PACKED) as path:
+            packs = sorted(pathlib.Path(path, ".git/objects/pack").glob("*.pack"))
+            # a bad header, a truncated pack and a missing one
+            data = packs[0].read_bytes()
+            packs[0].write_bytes(b"XACK" + data[4:])
+            packs[1].write_bytes(packs[1].read_bytes()[:20])
+            packs[2].unlink()
+
+            problems = self._verify(path)
+            self.assertEqual(sorted(problems), [pack.name for pack in packs])
+            for pack in packs:
+                self.assertEqual(len(problems[pack.name]), 1)
+                self.assertTrue(problems[pack.name][0].startswith("unreadable ("))
+
+    def test_command(self):
+        with RepoCopy(REPO_PACKED) as path:
+            Repository.objects.create(name="healthy", path=REPO_PACKED, isPublic=True)
+            Repository.objects.create(name="broken", path=path, isPublic=True)
+            # a file where the repository should be can't even be opened
+            Repository.objects.create(name="file", path=f"{path}/file", isPublic=True)
+            pack = sorted(pathlib.Path(path, ".git/objects/pack").glob("*.pack"))[0]
+            pack.write_bytes(b"XACK" + pack.read_bytes()[4:])
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with self.assertRaises(CommandError):
+                call_command("verify_packs", "--jobs=2", stdout=stdout, stderr=stderr)
+            self.assertIn("healthy: ok (3 pack(s))", stdout.getvalue())
+            self.assertIn(f"broken: 1 problem(s)\n  {pack.name}: unreadable (",
+                          stderr.getvalue())
+            self.assertIn("file: 1 problem(s)\n  cannot open repository", stderr.getvalue())
+
+    def test_command_releases_repositories(self):
+        with RepoCopy(REPO_PACKED) as path:
+            for i in range(3):
+                Repository.objects.create(name=f"repo{i}", path=path, isPublic=True)
+            pool = mpygit.PackMappingPool()
+            with mock.patch.object(mpygit, "_mapping_pool", pool):
+                call_command("verify_packs", "--jobs=2", stdout=io.StringIO())
+            # every repository was closed once its checks were queued
+            self.assertGreater(pool.maps, 0)
+            self.assertEqual(len(pool._mappings), 0)
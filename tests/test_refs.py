@@ -0,0 +1,200 @@
+import os
+import pathlib
+import re
+from unittest import mock
+
+from mpygit import mpygit
+
+from django.test import Client, SimpleTestCase, TestCase
+from mfgd_app.models import Repository
+
+from tests.helpers import git, git_objects, RepoCopy
+
+REPO_PACKED = "tests/repo/packed"
+
+
+def rev_parse(path, revspec):
+    return git(path, "rev-parse", revspec).decode().strip()
+
+
+class RefDatabaseTestCase(SimpleTestCase):
+    def _git_refs(self, path):
+        listing = git(path, "for-each-ref", "--format=%(refname) %(objectname)")
+        return dict(line.split() for line in listing.decode().splitlines())
+
+    def test_refs(self):
+        repo = mpygit.Repository(REPO_PACKED)
+        # packed and loose refs, nested ones and a loose one that takes
+        # precedence over its packed value
+        expected = self._git_refs(REPO_PACKED)
+        self.assertIn("refs/heads/feature/nested/deep", expected)
+        self.assertIn("refs/heads/loose/only", expected)
+        self.assertEqual(repo.refs.list("refs/"), {
+            name[5:]: oid for name, oid in expected.items()
+        })
+        self.assertEqual(
+            repo.refs.get("refs/heads/feature/nested/deep"),
+            rev_parse(REPO_PACKED, "HEAD~3"),
+        )
+        self.assertEqual(repo.heads["master"], rev_parse(REPO_PACKED, "master"))
+        self.assertEqual(repo.refs.get("HEAD"), rev_parse(REPO_PACKED, "HEAD"))
+        self.assertEqual(repo.HEAD, "refs/heads/master")
+        self.assertIsNone(repo.refs.get("refs/heads/feature"))
+        self.assertNotIn("refs/heads/missing", repo.refs)
+
+    def test_peeled(self):
+        repo = mpygit.Repository(REPO_PACKED)
+        tag = repo.refs.get("refs/tags/v1.0")
+        self.assertEqual(tag, rev_parse(REPO_PACKED, "v1.0"))
+        self.assertEqual(repo.refs.peeled("refs/tags/v1.0"),
+                         rev_parse(REPO_PACKED, "v1.0^{commit}"))
+        self.assertNotEqual(tag, repo.refs.peeled("refs/tags/v1.0"))
+        # lightweight tags have nothing to peel
+        self.assertIsNone(repo.refs.peeled("refs/tags/light"))
+
+    def test_loose_ref_changes(self):
+        with RepoCopy(REPO_PACKED) as path:
+            repo = mpygit.Repository(path)
+            loose = pathlib.Path(path, ".git/refs/heads/feature/nested/deep")
+            self.assertEqual(repo.refs.get("refs/heads/feature/nested/deep"),
+                             rev_parse(path, "HEAD~3"))
+
+            # the packed value is used again once the loose ref is gone
+            os.remove(loose)
+            repo.refresh()
+            self.assertEqual(repo.refs.get("refs/heads/feature/nested/deep"),
+                             rev_parse(path, "HEAD~5"))
+
+            # new loose refs are found
+            git(path, "branch", "feature/nested/new", "HEAD~1")
+            repo.refresh()
+            self.assertEqual(repo.heads["feature/nested/new"], rev_parse(path, "HEAD~1"))
+
+    def test_vanishing_loose_ref(self):
+        with RepoCopy(REPO_PACKED) as path:
+            repo = mpygit.Repository(path)
+            read_text = pathlib.Path.read_text
+
+            # the ref is deleted (e.g. by git pack-refs) between listing its
+            # directory and reading it
+            def racy_read_text(self, *args, **kwargs):
+                if self.name == "deep":
+                    os.remove(self)
+                return read_text(self, *args, **kwargs)
+
+            with mock.patch.object(pathlib.Path, "read_text", racy_read_text):
+                self.assertEqual(repo.refs.get("refs/heads/feature/nested/deep"),
+                                 rev_parse(path, "HEAD~5"))
+
+
+    def test_coarse_mtimes(self):
+        with RepoCopy(REPO_PACKED) as path:
+            heads = pathlib.Path(path, ".git/refs/heads/feature/nested")
+            packed_refs = pathlib.Path(path, ".git/packed-refs")
+            for recent in (heads, packed_refs):
+                os.utime(recent)
+            repo = mpygit.Repository(path)
+            self.assertIsNone(repo.refs.get("refs/heads/feature/nested/new"))
+
+            # changed in the same tick of a coarse clock as they were read
+            mtimes = {p: p.stat().st_mtime_ns for p in (heads, packed_refs)}
+            git(path, "branch", "feature/nested/new", "HEAD~1")
+            git(path, "tag", "packed", "HEAD~2")
+            git(path, "pack-refs", "--no-prune")
+            for changed, mtime in mtimes.items():
+                os.utime(changed, ns=(mtime, mtime))
+            repo.refresh()
+            self.assertEqual(repo.heads["feature/nested/new"], rev_parse(path, "HEAD~1"))
+            os.remove(pathlib.Path(path, ".git/refs/tags/packed"))
+            repo.refresh()
+            self.assertEqual(repo.refs.get("refs/tags/packed"), rev_parse(path, "HEAD~2"))
+
+            # refs read well after their last change are trusted until their
+            # mtime changes
+            old = min(mtimes.values()) - 10 ** 10
+            for changed in (packed_refs, *pathlib.Path(path, ".git/refs").glob("**")):
+                os.utime(changed, ns=(old, old))
+            repo.refresh()
+            repo.refs.get("HEAD")
+            with mock.patch.object(mpygit.os, "scandir", wraps=os.scandir) as scandir, \
+                 mock.patch.object(pathlib.Path, "read_text",
+                                   wraps=pathlib.Path.read_text, autospec=True) as read_text:
+                repo.refresh()
+                self.assertIn("refs/tags/packed", repo.refs)
+            scandir.assert_not_called()
+            self.assertEqual([call.args[0].name for call in read_text.call_args_list],
+                             ["HEAD"])
+
+
+class ResolveTestCase(SimpleTestCase):
+    def setUp(self):
+        self.repo = mpygit.Repository(REPO_PACKED)
+
+    def test_refs(self):
+        for revspec in ("HEAD", "master", "light", "feature/nested/deep",
+                        "heads/loose/only", "refs/tags/v1.0", "v1.0"):
+            self.assertEqual(self.repo.resolve(revspec), rev_parse(REPO_PACKED, revspec))
+        # annotated tags are peeled down to the commit on request
+        self.assertEqual(self.repo.resolve("v1.0", peel=True),
+                         rev_parse(REPO_PACKED, "v1.0^{}"))
+        self.assertIsNone(self.repo.resolve("missing"))
+
+    def test_object_ids(self):
+        head = rev_parse(REPO_PACKED, "HEAD")
+        self.assertEqual(self.repo.resolve(head), head)
+        self.assertEqual(self.repo.resolve(head.upper()), head)
+        tag = rev_parse(REPO_PACKED, "v1.0")
+        self.assertEqual(self.repo.resolve(tag[:12], peel=True),
+                         rev_parse(REPO_PACKED, "v1.0^{}"))
+        # abbreviations need a minimum number of hex digits
+        self.assertIsNone(self.repo.resolve(head[:self.repo.MIN_ABBREV - 1]))
+        self.assertIsNone(self.repo.resolve("not-hex"))
+
+    def test_abbreviations(self):
+        # every object can be found by the abbreviation git gives it,
+        # whether it's loose, in a pack, or in the multi-pack-index
+        oids = sorted(git_objects(REPO_PACKED))
+        for oid in oids:
+            short = git(REPO_PACKED, "rev-parse", "--short", oid).decode().strip()
+            self.assertEqual(self.repo.resolve(short), oid)
+
+        # the longest prefix two objects share is ambiguous
+        prefix = max(
+            (os.path.commonprefix(pair) for pair in zip(oids, oids[1:])), key=len
+        )
+        candidates = [oid for oid in oids if oid.startswith(prefix)]
+        with mock.patch.object(self.repo, "MIN_ABBREV", min(len(prefix), 4)):
+            with self.assertRaises(mpygit.AmbiguousRevision) as cm:
+                self.repo.resolve(prefix)
+        self.assertEqual(cm.exception.candidates, candidates)
+
+    def test_refs_win(self):
+        with RepoCopy(REPO_PACKED) as path:
+            repo = mpygit.Repository(path)
+            oid = rev_parse(path, "HEAD~4")
+            # a branch named like an abbreviated object ID shadows the object
+            git(path, "branch", oid[:8], "HEAD~6")
+            repo.refresh()
+            self.assertEqual(repo.resolve(oid[:8]), rev_parse(path, "HEAD~6"))
+            self.assertEqual(repo.resolve(oid[:9]), oid)
+
+
+class BranchLinksTestCase(TestCase):
+    def test_nested_branches(self):
+        Repository.objects.create(name="packed", path=REPO_PACKED, isPublic=True)
+        response = Client().get("/packed/view/master/")
+        self.assertEqual(response.status_code, 200)
+        options = dict(
+            (name, url) for url, name in re.findall(
+                r'<option class="branch" value="([^"]+)"[^>]*>([^<]+)</option>',
+                response.content.decode()
+            )
+        )
+        self.assertIn("feature/nested/deep", options)
+        self.assertIn("loose/only", options)
+        # every branch, nested or not, links to a page showing its commit
+        for name, url in options.items():
+            response = Client().get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context["commit_oid"],
+                             rev_parse(REPO_PACKED, name))
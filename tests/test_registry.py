@@ -0,0 +1,56 @@
+from mpygit import mpygit
+
+from django.test import SimpleTestCase
+
+from tests.helpers import git, RepoCopy
+
+REPO_PACKED = "tests/repo/packed"
+
+
+class RegistryTestCase(SimpleTestCase):
+    def test_shared(self):
+        registry = mpygit.RepositoryRegistry()
+        repo = registry.get(REPO_PACKED)
+        self.assertIs(registry.get(REPO_PACKED + "/"), repo)
+        self.assertIs(registry.get(f"tests/../{REPO_PACKED}"), repo)
+
+    def test_refresh_new_packs(self):
+        with RepoCopy(REPO_PACKED) as path:
+            registry = mpygit.RepositoryRegistry()
+            repo = registry.get(path)
+            packs = list(repo.packs)
+            self.assertEqual(len(packs), 3)
+
+            # a push (or a gc) adds a pack behind the repository's back
+            with open(f"{path}/new_file", "w") as f:
+                f.write("new\n")
+            git(path, "add", "new_file")
+            git(path, "commit", "-m", "new commit")
+            git(path, "repack", "-d")
+            head = git(path, "rev-parse", "HEAD").decode().strip()
+
+            self.assertIs(registry.get(path), repo)
+            self.assertEqual(len(repo.packs), 4)
+            # packs that were already open are kept as they are
+            for pack in packs:
+                self.assertIn(pack, repo.packs)
+            self.assertEqual(repo.resolve("master"), head)
+            self.assertEqual(repo[head].message, "new commit")
+            # nothing changed since, so there is nothing to reload
+            self.assertFalse(repo.refresh())
+
+    def test_eviction(self):
+        registry = mpygit.RepositoryRegistry(limit=2)
+        repos = {}
+        for path in (REPO_PACKED, "tests/repo/dirs", "tests/repo/linear"):
+            repo = registry.get(path)
+            repo[repo.resolve("HEAD")]
+            repos[path] = repo
+        # all of them share the same caches
+        self.assertIs(repos["tests/repo/dirs"].object_cache, registry.object_cache)
+        self.assertIs(repos["tests/repo/dirs"].base_cache, registry.base_cache)
+        self.assertEqual(registry.object_cache.stats()["commit"]["entries"], 2)
+
+        # the least recently used repository was closed
+        self.assertIsNot(registry.get(REPO_PACKED), repos[REPO_PACKED])
+        self.assertIsNot(registry.get("tests/repo/dirs"), repos["tests/repo/dirs"])
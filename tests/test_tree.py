@@ -1,7 +1,14 @@
+import os
+import pathlib
 import re
+
+from mpygit import mpygit
+
 from django.test import TestCase, Client
 from mfgd_app.models import Repository
 
+from tests.helpers import git, RepoCopy
+
 # \s*<a href="([\s\S]+?)">[\s\S]+?</a>\s*
 
 REGEX_DIR_ENTS = re.compile(
@@ -34,3 +41,116 @@ class TreeTestCase(TestCase):
             name = name.rstrip("/")
             self.assertEquals(name, ENTS[i])
             self.assertEquals(last_change, f"add {ENTS[i]}")
+
+    def test_last_changes(self):
+        # the history of n_merge forks, so paths follow different parents
+        for path in ("tests/repo/dirs", "tests/repo/n_merge"):
+            repo = mpygit.Repository(path)
+            head = repo.resolve("HEAD")
+            names = git(path, "ls-tree", "-r", "-t", "--name-only", head).decode().split()
+            paths = [tuple(name.split("/")) for name in names] + [("missing",)]
+
+            last_changes = repo.last_changes(head, paths)
+            for name, path_tuple in zip(names + ["missing"], paths):
+                expected = git(path, "log", "-1", "--format=%H", head, "--", name).decode().strip()
+                commit = last_changes[path_tuple]
+                self.assertEqual(commit.oid if commit else "", expected)
+                self.assertEqual(repo.last_change(head, path_tuple), commit)
+
+    def test_missing_blob(self):
+        with RepoCopy("tests/repo/dirs") as path:
+            Repository.objects.create(name="broken", path=path, isPublic=True)
+            oid = git(path, "rev-parse", "HEAD:file1").decode().strip()
+            os.remove(f"{path}/.git/objects/{oid[:2]}/{oid[2:]}")
+            # the rest of the listing is still shown
+            content = self._get_tree("broken")
+            names = [match.group(1).rstrip("/")
+                     for match in REGEX_DIR_ENTS.finditer(content)]
+            self.assertEqual(names, ["dir1", "dir2", "file1", "file2"])
+
+    def test_corrupt_commit_graph(self):
+        def truncate(graph):
+            graph.write_bytes(graph.read_bytes()[:100])
+
+        def chunk_past_end(graph):
+            # the offset of the first chunk
+            data = bytearray(graph.read_bytes())
+            data[12:20] = (len(data) + 100).to_bytes(8, "big")
+            graph.write_bytes(bytes(data))
+
+        def bad_fanout(graph):
+            data = bytearray(graph.read_bytes())
+            offs = data.index(b"OIDF")
+            oidf = int.from_bytes(data[offs + 4 : offs + 12], "big")
+            data[oidf : oidf + 4] = b"\xff\xff\xff\xff"
+            graph.write_bytes(bytes(data))
+
+        corruptions = {
+            "empty": lambda graph: graph.write_bytes(b""),
+            "truncated": truncate,
+            "chunk past end": chunk_past_end,
+            "bad fan-out": bad_fanout,
+        }
+        for split in (False, True):
+            for name, corrupt in corruptions.items():
+                with self.subTest(split=split, corruption=name), \
+                     RepoCopy("tests/repo/dirs") as path:
+                    info = pathlib.Path(path, ".git/objects/info")
+                    if split:
+                        (info / "commit-graph").unlink()
+                        git(path, "commit-graph", "write", "--reachable", "--split")
+                        graph = next((info / "commit-graphs").glob("*.graph"))
+                    else:
+                        graph = info / "commit-graph"
+                    corrupt(graph)
+
+                    # like git, the commit-graph is ignored
+                    repo = mpygit.Repository(path)
+                    self.assertIsNone(repo.commit_graph)
+                    head = repo.resolve("HEAD")
+                    expected = git(path, "log", "-1", "--format=%H", "--", "dir1")
+                    self.assertEqual(repo.last_change(head, ("dir1",)).oid,
+                                     expected.decode().strip())
+
+        with RepoCopy("tests/repo/dirs") as path:
+            info = pathlib.Path(path, ".git/objects/info")
+            (info / "commit-graph").unlink()
+            git(path, "commit-graph", "write", "--reachable", "--split")
+            (info / "commit-graphs/commit-graph-chain").write_text("not a hash\n")
+            self.assertIsNone(mpygit.Repository(path).commit_graph)
+
+    def test_lookup_order(self):
+        # git compares a directory as if its name ended in "/", so "foo/"
+        # sorts between "foo.c" and "foo0", unlike a file named "foo"
+        with RepoCopy("tests/repo/dirs") as path:
+            blob = git(path, "rev-parse", "HEAD:file1").decode().strip()
+            subtree = git(path, "rev-parse", "HEAD:dir1").decode().strip()
+            commit = git(path, "rev-parse", "HEAD").decode().strip()
+            names = {
+                "fo": ("100644", "blob", blob),
+                "foo": ("040000", "tree", subtree),
+                "foo-bar": ("100644", "blob", blob),
+                "foo.c": ("100755", "blob", blob),
+                "foo0": ("120000", "blob", blob),
+                "foo1": ("160000", "commit", commit),
+                "foo1.c": ("040000", "tree", subtree),
+            }
+            listing = "".join(f"{mode} {obj_type} {oid}\t{name}\n"
+                              for name, (mode, obj_type, oid) in names.items())
+            oid = git(path, "mktree", input=listing.encode()).decode().strip()
+            tree = mpygit.Repository(path)[oid]
+            self.assertEqual([entry.name for entry in tree],
+                             ["fo", "foo-bar", "foo.c", "foo", "foo0",
+                              "foo1", "foo1.c"])
+
+            for name, expected in names.items():
+                entry = tree[name]
+                mode, _, expected_oid = expected
+                self.assertEqual((entry.name, entry.mode, entry.oid),
+                                 (name, int(mode, 8), expected_oid))
+                self.assertIn(name, tree)
+            self.assertTrue(tree["foo"].isdir())
+            self.assertTrue(tree["foo1"].issubmod())
+            for name in ("", "f", "foo/", "foo.", "foo0/sub", "foo2", "zzz"):
+                self.assertIsNone(tree[name])
+                self.assertNotIn(name, tree)